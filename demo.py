@@ -1,9 +1,15 @@
 
-#import time
+import time
+import random
 import asyncio
 from queue import Queue
 
 import serial
+from serialthread import SerialThread
+from scheduler import Scheduler
+from espatcontrol.espatcontrol_cmd import quote
+from espatcontrol.espatcontrol_topics import SubscriptionTable
+from espatcontrol.espatcontrol_telemetry import Schema, TelemetryEncoder
 
 
 # Get wifi details and more from a secrets.py file
@@ -23,7 +29,128 @@ except ImportError:
         }
     
 
-DELAY_BETWEEN_AT_COMMANDS = 1
+AT_REPLY_TIMEOUT = 10  # seconds the writer waits for a reply before sending the next command
+STATS_INTERVAL = 60  # seconds between scheduler reports
+STATUS_INTERVAL = 30  # seconds between status samples
+TELEMETRY_BATCH = 5  # status samples per publish
+RECONNECT_BACKOFF_MAX = 60  # seconds
+RECONNECT_STABLE_PERIOD = 120  # seconds up before backoff starts from scratch again
+
+# Everything we want from the broker, resubscribed whenever it (re)connects
+subscriptions = SubscriptionTable()
+
+# Periodic jobs on absolute deadlines, plus loop lag and per task timings
+scheduler = Scheduler()
+
+# AT+HTTPCLIENT requests in flight, oldest first, see http_get_offload
+http_bodies = []
+
+# Lines that finish the reply to whatever the writer last sent
+REPLY_TERMINATORS = ("OK", "ERROR", "FAIL", "SEND OK", "SEND FAIL", "ready", "+MQTTPUB:OK", "+MQTTPUB:FAIL")
+
+
+class ReplyWaiter:
+    """Lets the writer wait for the reply to the command it just sent. The
+    module echoes each command (ATE1, the default after a reset), so a
+    terminator only counts once the echo of our command has gone by: a
+    late OK to a command that already timed out comes before it and is
+    ignored instead of being taken as the next command's reply"""
+
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.reply = None
+        self.unanswered = 0  # commands that timed out waiting for a reply
+        self._command = None
+        self._echoed = True
+        self._prompt = False
+
+    def sent(self, command, echo=True, prompt=False):
+        # echo=False for data the module doesn't echo back. prompt=True for
+        # a command that asks for data: it's answered by the '>', not the OK
+        self._command = command.strip() if echo else None
+        self._echoed = not echo
+        self._prompt = prompt
+        self.reply = None
+        self.done.clear()
+
+    def expect_more(self):
+        # Another reply to the same command, AT+RST's 'ready' after its OK
+        self.reply = None
+        self.done.clear()
+
+    def line(self, response):
+        text = response.strip()
+        if not self._echoed:
+            self._echoed = text == self._command
+            return
+        if self._prompt:
+            finished = text in (">", "ERROR", "FAIL")
+        else:
+            finished = text in REPLY_TERMINATORS
+        if finished:
+            self.reply = text
+            self.done.set()
+
+    async def wait(self, label):
+        try:
+            await asyncio.wait_for(self.done.wait(), AT_REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"uart_write_loop: no reply to {label}")
+            self.unanswered += 1
+            return None
+        return self.reply
+
+
+class HttpBody(ReplyWaiter):
+    """The body of one AT+HTTPCLIENT request. uart_read_loop hands it the
+    '+HTTPCLIENT:' frames and, like any reply, it's done on the OK or
+    ERROR after the command's echo"""
+
+    def __init__(self, command):
+        super().__init__()
+        self.data = bytearray()
+        self.sent(command)
+
+    def frame(self, data):
+        self.data += data
+
+
+class DongleStats:
+    """What update_status samples, the fields STATUS_SCHEMA sends"""
+
+    def __init__(self, name):
+        self.name = name
+        self.time = int(time.time())
+        self.rssi = None  # from the +CWJAP: replies, see handle_response
+        self.errors = 0  # commands that went unanswered
+        self._started = time.monotonic()
+
+    @property
+    def uptime(self):
+        return int(time.monotonic() - self._started)
+
+    def update_time(self, delay):
+        self.time += delay
+
+    def __str__(self):
+        return f"time={self.time} rssi={self.rssi} uptime={self.uptime} errors={self.errors}"
+
+
+# Sampled by update_status, kept up to date by handle_response
+dongle_stats = DongleStats(secrets.get("device_name", "dongle"))
+
+# Status samples go out binary packed and batched, the backend reads them
+# with TelemetryDecoder([STATUS_SCHEMA]). Fields the stats object doesn't
+# have are simply left out of the frame
+STATUS_SCHEMA = Schema(1, (
+    ("time", "u"),
+    ("rssi", "i"),
+    ("temperature", "i", 10),
+    ("battery", "u"),
+    ("uptime", "u"),
+    ("errors", "u"),
+))
+telemetry = TelemetryEncoder(STATUS_SCHEMA, batch_size=TELEMETRY_BATCH)
 
 
 def build_mqtt_subscribe_message(data_string):
@@ -57,61 +184,112 @@ def build_mqtt_subscribe_message(data_string):
             
 # Demonstrate scheduler is operational.
 async def heartbeat(led):
-    print("Start Heartbeat")
-    while True:
-        await asyncio.sleep(1)
-        if (led):
-            led.value = not led.value
+    if (led):
+        led.value = not led.value
+
+async def report_stats():
+    scheduler.report()
 
 def uart_write(uart, message):
     #uart.write(message.encode('utf-8'))  # Write message to UART
-    uart.write(bytes(message, 'utf-8'))
-
-async def uart_write_loop(uart, message_queue):
+    uart.write(message if isinstance(message, bytes) else bytes(message, 'utf-8'))
+
+async def uart_write_loop(uart, message_queue, replies):
+    # Sends the next command as soon as the module has answered the last
+    # one, rather than a fixed second later. AT+RST answers OK first and
+    # 'ready' once it has booted, so that one waits for both
+    # A (command, payload) pair is an AT+MQTTPUBRAW: the payload bytes go
+    # once the module has prompted for them with '>'
     print("uart_write_loop", message_queue)
     while True:
         message = await message_queue.get()  # Wait for a message from the queue
-        uart_write(uart,message)  # Write message to UART
-        await asyncio.sleep(1)  # Wait for 2 seconds between messages
+        command, payload = message if isinstance(message, tuple) else (message, None)
+        with scheduler.timed("uart_write_loop"):
+            # ATE changes the echo itself, so don't wait to see one
+            replies.sent(command, echo=not command.startswith("ATE"), prompt=payload is not None)
+            uart_write(uart,command)  # Write message to UART
+        reply = await replies.wait(command.strip())
+        if reply and command.startswith("AT+RST"):
+            replies.expect_more()
+            reply = await replies.wait("AT+RST, no 'ready'")
+        if reply != ">":
+            continue
+        with scheduler.timed("uart_write_loop"):
+            replies.sent(payload, echo=False)
+            uart_write(uart, payload)
+        await replies.wait(f"{len(payload)} byte payload")
      
 
 async def uart_read_loop(uart, response_queue):
+    # uart is a SerialThread, readline() waits on the loop, not on the device.
+    # Nothing else reads it, HTTP body frames included
     print(f"uart_read_loop queue = {response_queue}")
     while True:
-        if uart.in_waiting > 0:
-            data = uart.readline()
-            response = data.decode('utf-8')
+        data = await uart.readline(prompt=b">")
+        if data.startswith(b"+HTTPCLIENT:") and http_bodies:
+            # '+HTTPCLIENT:<len>,<data>', the data is binary and can hold
+            # newlines, so it's read by length rather than by line
+            head, _, frame = data.partition(b",")
+            size = int(head[12:])
+            if len(frame) < size:
+                frame += await uart.readexactly(size - len(frame))
+            http_bodies[0].frame(frame[:size])
+            data = frame[size:]
+            if not data.strip():
+                continue
+        with scheduler.timed("uart_read_loop"):
+            response = data.decode('utf-8', 'replace')
             await response_queue.put(response)
-            #print(f"uart_read_loop: response = {response} added to response queue - size = {response_queue.qsize()}")
-            
-        await asyncio.sleep(0.1)  # Wait for 1 mseconds between messages
+        #print(f"uart_read_loop: response = {response} added to response queue - size = {response_queue.qsize()}")
 
 
-async def response_handler(response_queue, message_queue):
+async def response_handler(response_queue, message_queue, link_lost=None, replies=None):
     print(f"response_handler queue = {response_queue}")
     while True:
         response = await response_queue.get()
-        #await parse_responses(response, message_queue)
-        params=response.split(',')
-        print(f"debugESPAT - parse_responses:-------> {params}")
-
-        if '+MQTTSUBRECV:' in params[0]:
-            topic, sub_message = build_mqtt_subscribe_message(response)
-            print(f"Received topic {topic}", sub_message)
-
-        if '+MQTTCONNECTED:' in params[0]:
-            pass
-            
-        if '+CWJAP:' in params[0]:
+        with scheduler.timed("response_handler"):
+            await handle_response(response, message_queue, link_lost, replies)
+
+
+async def handle_response(response, message_queue, link_lost, replies):
+    #await parse_responses(response, message_queue)
+    if replies:
+        replies.line(response)
+    for body in http_bodies:
+        body.line(response)
+    params=response.split(',')
+    print(f"debugESPAT - parse_responses:-------> {params}")
+
+    if link_lost and (response.startswith('WIFI DISCONNECT') or '+MQTTDISCONNECTED' in params[0]):
+        link_lost.set()
+
+    if '+MQTTSUBRECV:' in params[0]:
+        topic, sub_message = build_mqtt_subscribe_message(response)
+        print(f"Received topic {topic}", sub_message)
+        latency = subscriptions.message_received(topic)
+        if latency is not None:
+            print(f"First message {latency:.2f}s after the broker connection came up")
+
+    if '+MQTTCONNECTED:' in params[0]:
+        # Ours or the firmware's own reconnect (reconnect=1), either way
+        # the broker has forgotten what we subscribed to
+        subscriptions.reconnected()
+        await resubscribe(message_queue)
+        # a frame may have gone missing, don't leave the backend a delta it can't use
+        telemetry.reset()
+        
+    if '+CWJAP:' in params[0] and len(params) > 3:
+        # +CWJAP:<ssid>,<bssid>,<channel>,<rssi>,...
+        try:
+            dongle_stats.rssi = int(params[3])
+        except ValueError:
             pass
-
-        await asyncio.sleep(1)  # Wait for 1 seconds between messages
        
      
 # WiFi Management AT commands
 def form_join_wifi():
     ssid, password = secrets['ssid'], secrets['password']
-    command = f'AT+CWJAP="{ssid}","{password}"\r\n'
+    command = f'AT+CWJAP={quote(ssid)},{quote(password)}\r\n'
     return command
 
 def form_disconnect_wifi():
@@ -131,35 +309,51 @@ def form_at_esp_mqtt_credentials():
     username = secrets["mqtt_username"]
     password = secrets["mqtt_password"]
     client_id = "client_id_12"
-    return f'AT+MQTTUSERCFG=0,1,"{client_id}","{username}","{password}",0,0,""\r\n'
+    return f'AT+MQTTUSERCFG=0,1,{quote(client_id)},{quote(username)},{quote(password)},0,0,""\r\n'
 
 def form_at_esp_mqtt_connect():
     host = secrets["mqtt_host"]
     port = secrets["mqtt_port"]
     reconnect = 1 # 1 or 0
-    return f'AT+MQTTCONN=0,"{host}",{port},{reconnect}\r\n'
+    return f'AT+MQTTCONN=0,{quote(host)},{port},{reconnect}\r\n'
+
+def form_at_esp_subscribe(topic, qos=1):
+    return f'AT+MQTTSUB=0,{quote(topic)},{qos}\r\n'
 
-def form_at_esp_subscribe(topic):
-    return f'AT+MQTTSUB=0,"{topic}",1\r\n'
+def form_at_esp_unsubscribe(topic):
+    return f'AT+MQTTUNSUB=0,{quote(topic)}\r\n'
     
 def form_at_esp_publish(topic,data,qos=1,retain=0):
-    return f'AT+MQTTPUB=0,"{topic}","{data}",{qos},{retain}\r\n'
+    return f'AT+MQTTPUB=0,{quote(topic)},{quote(data)},{qos},{retain}\r\n'
 
+def form_at_esp_publish_raw(topic,length,qos=1,retain=0):
+    # the payload follows on its own, binary safe and without any quoting
+    return f'AT+MQTTPUBRAW=0,{quote(topic)},{length},{qos},{retain}\r\n'
 
 
 
-def update_status_factory(uart, dongle_stats, delay = 30):
+
+def update_status_factory(gsm_command_queue, dongle_stats, replies, delay = 30):
+    # One publish per call, run it with scheduler.every(delay, update_status)
+    # so the period doesn't drift by however long each run takes
     print("update_dongle_status... ")
     count = 1    
          
     async def update_status():
         nonlocal count
-        while True:
-            print(f"Update STATUS time: {dongle_stats.time}  publish:{dongle_stats}")
-            resp = esp.at_response(form_at_esp_publish(f"status/{dongle_stats.name}",f"{dongle_stats}"))
-            count = count + 1
-            dongle_stats.update_time(delay)
-            await asyncio.sleep(delay)
+        dongle_stats.errors = replies.unanswered
+        print(f"Update STATUS time: {dongle_stats.time}  sample:{dongle_stats}")
+        frame = telemetry.add(dongle_stats)
+        if frame:
+            # queue it for uart_write_loop rather than blocking the loop on a reply
+            command = form_at_esp_publish_raw(f"status/{dongle_stats.name}/telemetry", len(frame))
+            await gsm_command_queue.put((command, frame))
+        if len(telemetry) == telemetry.batch_size - 1:
+            # the next sample completes a frame, have a fresh RSSI for it.
+            # Once a frame rather than every tick, wifi_loop doesn't poll
+            await gsm_command_queue.put(form_get_wifi_status())
+        count = count + 1
+        dongle_stats.update_time(delay)
             
     return  update_status
 
@@ -172,7 +366,7 @@ async def http_get(uart, gsm_command_queue, url, port=80):
     path = "/" + path
 
     # Start TCP connection
-    await gsm_command_queue.put(f'AT+CIPSTART="TCP","{host}",{port}\r\n')
+    await gsm_command_queue.put(f'AT+CIPSTART="TCP",{quote(host)},{port}\r\n')
         
     # Formulate the HTTP GET request
     http_request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n"
@@ -184,12 +378,10 @@ async def http_get(uart, gsm_command_queue, url, port=80):
     # Read the HTTP response
     response = []
     while True:
-        if uart.in_waiting > 0:
-            line = uart.readline().decode('utf-8')
-            if any(["0, CLOSE OK" in line , "CLOSED" in line]):  # Connection closed
-                break
-            response.append(line)
-        await asyncio.sleep(1)
+        line = (await uart.readline()).decode('utf-8')
+        if any(["0, CLOSE OK" in line , "CLOSED" in line]):  # Connection closed
+            break
+        response.append(line)
         
     # Close TCP connection
     await gsm_command_queue.put('AT+CIPCLOSE\r\n')
@@ -197,10 +389,28 @@ async def http_get(uart, gsm_command_queue, url, port=80):
     return "\n".join(response)
 
 
-async def fetch_page(uart, gsm_command_queue):
+async def http_get_offload(gsm_command_queue, url, timeout=10):
+    # The firmware makes the request (AT+HTTPCLIENT) and sends back just the
+    # body as '+HTTPCLIENT:<len>,<data>' frames, which uart_read_loop passes
+    # to the oldest HttpBody waiting in http_bodies
+    transport = 2 if url.startswith("https:") else 1
+    command = f'AT+HTTPCLIENT=2,0,{quote(url)},,,{transport}\r\n'
+    body = HttpBody(command)
+    http_bodies.append(body)
+    try:
+        await gsm_command_queue.put(command)
+        await asyncio.wait_for(body.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        print(f"http_get_offload: {url} didn't finish in {timeout}s")
+    finally:
+        http_bodies.remove(body)
+    return body.data.decode('utf-8', 'replace')
+
+
+async def fetch_page(gsm_command_queue):
     url = "http://example.com/index.html"
     print(f"Fetching: {url}")
-    webpage = await http_get(uart, gsm_command_queue, url)
+    webpage = await http_get_offload(gsm_command_queue, url)
     print(f"Web Page Response from {url}:")
     print(webpage)
 
@@ -208,8 +418,20 @@ async def mqtt_init(gsm_command_queue):
     await gsm_command_queue.put(form_at_esp_mqtt_credentials())
     await gsm_command_queue.put(form_at_esp_mqtt_connect())
 
-async def subscribe(gsm_command_queue, topic):
-    await gsm_command_queue.put(form_at_esp_subscribe(topic))
+async def subscribe(gsm_command_queue, topic, qos=1):
+    # Filters a wider one already covers never reach the broker, and the
+    # ones a new wildcard covers are dropped there
+    needed, redundant = subscriptions.add(topic, qos)
+    if needed:
+        await gsm_command_queue.put(form_at_esp_subscribe(topic, qos))
+    for name in redundant:
+        await gsm_command_queue.put(form_at_esp_unsubscribe(name))
+
+async def resubscribe(gsm_command_queue):
+    # The whole table queued in one go; the firmware still runs the
+    # AT+MQTTSUBs one at a time, but nothing else gets in between them
+    for topic, qos in subscriptions.effective().items():
+        await gsm_command_queue.put(form_at_esp_subscribe(topic, qos))
 
 
 async def wifi_init(gsm_command_queue):
@@ -219,31 +441,29 @@ async def wifi_init(gsm_command_queue):
 
 
 
-async def wifi_loop(uart, gsm_response_queue, gsm_command_queue):
-    
-    first_pass = True
-    while True:
-        try:
+async def wifi_loop(uart, gsm_response_queue, gsm_command_queue, link_lost):
+    # Join once, then sleep until the response handler reports a drop and
+    # rejoin with jittered exponential backoff - no periodic AT+CWJAP? polling.
+    print("FIRST PASS ON WIFI LOOP")
+    await wifi_init(gsm_command_queue)
+    await mqtt_init(gsm_command_queue)
 
-            if first_pass:
-                print("FIRST PASS ON WIFI LOOP")
-                await wifi_init(gsm_command_queue)
-                await mqtt_init(gsm_command_queue)
-                await subscribe(gsm_command_queue, "opportunities/111283278/status/#")
-                first_pass = False
-                
-            if (True):
-                print("wifi Loop")
-                await gsm_command_queue.put('AT+CWJAP?\r\n')
-                #await fetch_page(uart,gsm_command_queue)
-                await asyncio.sleep(10)
-                
-
-        except (ValueError, RuntimeError) as e:
-            print("Failed to get data, retrying\n", e)
-            print("Resetting ESP module")
-            await wifi_init(gsm_command_queue)
-            continue
+    attempt = 0
+    last_loss = time.monotonic()
+    while True:
+        await link_lost.wait()
+        link_lost.clear()
+        now = time.monotonic()
+        if now - last_loss > RECONNECT_STABLE_PERIOD:
+            attempt = 0
+        last_loss = now
+        delay = min(RECONNECT_BACKOFF_MAX, 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        attempt += 1
+        print(f"wifi Loop - link lost, reconnecting in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        await wifi_init(gsm_command_queue)
+        await mqtt_init(gsm_command_queue)
         
 
         
@@ -255,19 +475,32 @@ async def main():
         "AT+RST\r\n",
     ]   
 
-    uart = serial.Serial("/dev/tty.usbserial-110", 115200, timeout=1)
+    # Reads and writes happen on SerialThread's own threads, so a device that
+    # stalls mid-line never freezes the event loop
+    uart = SerialThread(serial.Serial("/dev/tty.usbserial-110", 115200))
+    uart.start()
+
+    # Subscribed to as soon as the broker connection is up, see response_handler
+    subscriptions.add("opportunities/111283278/status/#", 1)
 
     gsm_response_queue = Queue()
     gsm_command_queue = Queue()
+    link_lost = asyncio.Event()
+    replies = ReplyWaiter()
 
     led = None
 
     try:
-        asyncio.create_task(heartbeat(led))
-        asyncio.create_task(uart_read_loop(uart, gsm_response_queue))
-        asyncio.create_task(uart_write_loop(uart, gsm_command_queue))
-        asyncio.create_task(response_handler(gsm_response_queue, gsm_command_queue))
-        asyncio.create_task(wifi_loop(uart, gsm_response_queue, gsm_command_queue))
+        scheduler.start()
+        scheduler.every(1, heartbeat, led)
+        scheduler.every(STATS_INTERVAL, report_stats, delay=STATS_INTERVAL)
+        update_status = update_status_factory(gsm_command_queue, dongle_stats, replies, STATUS_INTERVAL)
+        scheduler.every(STATUS_INTERVAL, update_status, delay=STATUS_INTERVAL)
+        scheduler.spawn(uart_read_loop(uart, gsm_response_queue), "uart_read_loop")
+        scheduler.spawn(uart_write_loop(uart, gsm_command_queue, replies), "uart_write_loop")
+        scheduler.spawn(response_handler(gsm_response_queue, gsm_command_queue, link_lost, replies),
+                        "response_handler")
+        scheduler.spawn(wifi_loop(uart, gsm_response_queue, gsm_command_queue, link_lost), "wifi_loop")
 
         for command in start_up_commands:
             await gsm_command_queue.put(command)
@@ -22,25 +22,224 @@ with firmware - AT version:3.3.0.0(3b13d04 - ESP32C3 - May  8 2024 08:21:54)
 """
 
 
-import gc
-import time
-#from digitalio import Direction, DigitalInOut
-from utime import *
 import time
+import json
+try:
+    from digitalio import Direction
+except ImportError:
+    Direction = None  # MicroPython, pins are machine.Pin
+try:
+    from utime import ticks_ms
+
+    def monotonic():
+        return ticks_ms()/1000
+except ImportError:  # CPython, e.g. a Linux host with espatcontrol_hostuart
+    from time import monotonic
 
 
 try:
-    from typing import Optional, Dict, Union, List
+    from typing import Optional, Dict, Union, List, Iterator, Tuple
 except ImportError as ie:
     print(f"*********ImportError******** {ie}")
     pass
 
-def monotonic():
-    return ticks_ms()/1000
+from espatcontrol.espatcontrol_ap import AccessPoint, CWLAP_ALL, CWLAP_COMPACT
+from espatcontrol.espatcontrol_cmd import CommandEncoder, Template, command_verb, quote
+
+# Commands with arguments that need quoting, rendered by CommandEncoder
+_CWJAP = Template("AT+CWJAP=%q,%q")
+_CWJAP_FAST = Template("AT+CWJAP=%q,%q,%q,0,1,3,0,%d")  # bssid, fast scan, jap_timeout
+_CIPSTA = Template("AT+CIPSTA=%q,%q,%q")
+_CIPSTART = Template("AT+CIPSTART=%q,%q,%d")
+_CIPSTART_UDP = Template('AT+CIPSTART="UDP",%q,%d,%d,%d')
+_CIPSEND = Template("AT+CIPSEND=%d")
+_CIPSEND_TO = Template("AT+CIPSEND=%d,%q,%d")
+_CIPDOMAIN = Template("AT+CIPDOMAIN=%q")
+_PING = Template("AT+PING=%q")
+_CWMODE = Template("AT+CWMODE=%d")
+_SNTPCFG = Template("AT+CIPSNTPCFG=%d")
+_SNTPCFG_TZ = Template("AT+CIPSNTPCFG=%d,%d")
+_SNTPCFG_SERVER = Template("AT+CIPSNTPCFG=%d,%d,%q")
+
+def _pin_output(pin) -> None:
+    """Make a CircuitPython DigitalInOut or a MicroPython machine.Pin an output"""
+    if hasattr(pin, "direction"):
+        pin.direction = Direction.OUTPUT
+    else:
+        pin.init(pin.OUT)
+
+def _pin_write(pin, value: bool) -> None:
+    """Drive a CircuitPython DigitalInOut or a MicroPython machine.Pin"""
+    if hasattr(pin, "direction"):
+        pin.value = value
+    else:
+        pin.value(1 if value else 0)
+
+def _ends_with(buf, end: int, suffix: bytes) -> bool:
+    """buf[:end].endswith(suffix), without slicing (and so allocating)"""
+    size = len(suffix)
+    if end < size:
+        return False
+    for j in range(size):
+        if buf[end - size + j] != suffix[j]:
+            return False
+    return True
+
+def _parse_ipd_length(header: bytearray, end: int, start: int = 5) -> int:
+    """The <len> field of a '+IPD,<len>[,...]:' header (or of any other
+    '<prefix><len>,' frame with 'start' past the prefix), without allocating"""
+    length = 0
+    for i in range(start, end):
+        digit = header[i] - 48
+        if not 0 <= digit <= 9:
+            if header[i] in (44, 58):  # ',' ':'
+                return length
+            raise RuntimeError("Parsing error during receive")
+        length = length * 10 + digit
+    return length
+
+_CLOSED = b"CLOSED\r\n"
 
 class OKError(Exception):
     """The exception thrown when we didn't get acknowledgement to an AT command"""
+
+class BufferPool:
+    """Fixed size blocks carved out of one preallocated arena. acquire()
+    hands out a memoryview of a free block and release() takes it back, so
+    once the pool exists, passing buffers around allocates nothing and
+    there's no garbage for the collector to chase"""
+
+    def __init__(self, block_size: int = 2048, blocks: int = 4):
+        if not 0 < blocks <= 30:
+            raise ValueError("blocks must be 1..30")
+        self.block_size = block_size
+        self._arena = bytearray(block_size * blocks)
+        arena = memoryview(self._arena)
+        self._blocks = [
+            arena[i * block_size : (i + 1) * block_size] for i in range(blocks)
+        ]
+        self._free = (1 << blocks) - 1  # bit i set means block i is free
+
+    @property
+    def available(self) -> int:
+        """How many blocks are free"""
+        count = 0
+        free = self._free
+        while free:
+            count += free & 1
+            free >>= 1
+        return count
+
+    def acquire(self) -> memoryview:
+        """A free block, as a memoryview. Raises RuntimeError if none are left"""
+        for i in range(len(self._blocks)):
+            if self._free & (1 << i):
+                self._free &= ~(1 << i)
+                return self._blocks[i]
+        raise RuntimeError("Buffer pool exhausted")
+
+    def release(self, block: memoryview) -> None:
+        """Give back a block that acquire() handed out"""
+        for i in range(len(self._blocks)):
+            if self._blocks[i] is block:
+                self._free |= 1 << i
+                return
+        raise ValueError("Not a block from this pool")
  
+def _is_ip(host: str) -> bool:
+    """True for a dotted-quad or IPv6 literal, which need no lookup"""
+    if ":" in host:
+        return True
+    parts = host.split(".")
+    return len(parts) == 4 and all(part.isdigit() for part in parts)
+
+class DNSCache:
+    """A small LRU of hostname -> address with a TTL per entry. Failed
+    lookups are cached as None for a shorter time, so a dead hostname
+    doesn't cost a round trip on every retry"""
+
+    def __init__(self, size: int = 8, ttl: float = 300, negative_ttl: float = 30):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # host -> (address or None, expiry)
+        self._order = []  # least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, host: str):
+        """(True, address or None) on a hit, (False, None) if we must ask"""
+        entry = self._entries.get(host)
+        if entry is not None:
+            if monotonic() < entry[1]:
+                self._order.remove(host)
+                self._order.append(host)
+                self.hits += 1
+                return True, entry[0]
+            self.forget(host)
+        self.misses += 1
+        return False, None
+
+    def store(self, host: str, address: Optional[str], ttl: Optional[float] = None) -> None:
+        """Remember an answer, None meaning the name didn't resolve"""
+        if ttl is None:
+            ttl = self.ttl if address else self.negative_ttl
+        if host in self._entries:
+            self._order.remove(host)
+        elif len(self._order) >= self.size:
+            del self._entries[self._order.pop(0)]
+        self._entries[host] = (address, monotonic() + ttl)
+        self._order.append(host)
+
+    def forget(self, host: str) -> None:
+        """Drop one entry, e.g. after connecting to its address failed"""
+        if host in self._entries:
+            del self._entries[host]
+            self._order.remove(host)
+
+    def clear(self) -> None:
+        """Drop everything"""
+        self._entries = {}
+        self._order = []
+
+class AdaptiveTimeouts:
+    """Per command timeouts learned from how long the replies take (keyed by
+    command_verb(), so the arguments don't matter), worked
+    out the way TCP does its retransmission timeout (RFC 6298): a smoothed
+    latency plus four times its mean deviation. The timeout a caller passes
+    stays the ceiling, so slow commands keep their generous limit, and the
+    floor keeps a little jitter from looking like a lost reply"""
+
+    def __init__(self, floor: float = 0.25, min_samples: int = 3):
+        self.floor = floor
+        self.min_samples = min_samples
+        self._stats = {}  # verb -> [smoothed, deviation, samples]
+
+    def timeout(self, verb: str, ceiling: float) -> float:
+        """How long to wait for a reply to 'verb'"""
+        stats = self._stats.get(verb)
+        if stats is None or stats[2] < self.min_samples:
+            return ceiling
+        return min(ceiling, max(self.floor, stats[0] + 4 * stats[1]))
+
+    def observe(self, verb: str, seconds: float) -> None:
+        """Feed in how long a reply took"""
+        stats = self._stats.get(verb)
+        if stats is None:
+            self._stats[verb] = [seconds, seconds / 2, 1]
+            return
+        stats[1] += (abs(stats[0] - seconds) - stats[1]) / 4
+        stats[0] += (seconds - stats[0]) / 8
+        stats[2] += 1
+
+    def backoff(self, verb: str) -> None:
+        """A reply didn't come in time: be more patient next time, until a
+        fresh measurement says otherwise"""
+        stats = self._stats.get(verb)
+        if stats is not None:
+            stats[0] *= 2
+            stats[1] *= 2
+
 class ESP_ATcontrol:
     """A wrapper for AT commands to a connected ESP8266 or ESP32 module to do
     some very basic internetting. The ESP module must be pre-programmed with
@@ -68,6 +267,36 @@ class ESP_ATcontrol:
 
     USER_AGENT = "esp-idf/1.0 esp32"
 
+    # AT+HTTPCLIENT <content-type>
+    HTTP_FORM = 0
+    HTTP_JSON = 1
+    HTTP_MULTIPART = 2
+    HTTP_XML = 3
+    _HTTP_METHODS = {"HEAD": 1, "GET": 2, "POST": 3, "PUT": 4, "DELETE": 5}
+
+    # How a command reply ended, see at_response()
+    REPLY_OK = 0
+    REPLY_ERROR = 1  # ERROR or FAIL, the firmware tried and said no
+    REPLY_BUSY = 2  # 'busy p...', still on the last command, this one never ran
+    REPLY_TIMEOUT = 3
+    REPLY_BUSY_SENDING = 4  # 'busy s...', still sending socket data, never ran
+
+    # Commands that mustn't be resent just because their reply went missing,
+    # they either act on the outside world or take so long that a second go
+    # only doubles the wait. A busy reply is still resent, nothing happened
+    NON_IDEMPOTENT = (
+        "AT+CIPSEND",
+        "AT+CIPSTART",
+        "AT+CWJAP=",
+        "AT+HTTPC",
+        "AT+MQTTPUB",
+        "AT+MQTTCONN=",
+        "AT+RST",
+    )
+
+    # Unsolicited lines the firmware sends when the link changes under us
+    URC_LINES = (b"WIFI DISCONNECT", b"WIFI CONNECTED", b"WIFI GOT IP", b"CLOSED")
+
     def __init__(
         self,
         uart,
@@ -78,11 +307,19 @@ class ESP_ATcontrol:
         reset_pin: Optional[int] = None,
         debug: bool = False,
         use_cipstatus: bool = False,
+        buffer_size: int = 2048,
+        buffer_count: int = 4,
+        dns_cache_size: int = 8,
+        dns_ttl: float = 300,
+        capability_cache: Optional[str] = None,
+        timeout_floor: float = 0.25,
     ):
 
         """This function doesn't try to do any sync'ing, just sets up
         # the hardware, that way nothing can unexpectedly fail!"""
         self._uart = uart
+        # a HostUART can block until data arrives, a machine.UART is polled
+        self._uart_wait = getattr(uart, "wait", None)
         if not run_baudrate:
             run_baudrate = default_baudrate
         self._default_baudrate = default_baudrate
@@ -92,26 +329,63 @@ class ESP_ATcontrol:
         self._reset_pin = reset_pin
         self._rts_pin = rts_pin
         if self._reset_pin:
-            self._reset_pin.direction = Direction.OUTPUT
-            self._reset_pin.value = True
+            _pin_output(self._reset_pin)
+            _pin_write(self._reset_pin, True)
         if self._rts_pin:
-            self._rts_pin.direction = Direction.OUTPUT
+            _pin_output(self._rts_pin)
         #self.hw_flow(True)
 
         self._debug = debug
         self._versionstrings = []
         self._version = None
-        self._ipdpacket = bytearray(1500)
+        # Command replies and socket payloads share one preallocated pool,
+        # two blocks are ours for good, the rest are for socket_receive_into()
+        self.buffers = BufferPool(buffer_size, buffer_count + 2)
+        self._replybuf = self.buffers.acquire()
+        self._ipdpacket = self.buffers.acquire()
+        self._ipdheader = bytearray(48)  # room for AT+CIPDINFO=1 addresses
+        self._ipdheader_len = 0
+        # bytes read off the UART but not consumed yet
+        self._carry = bytearray(64)
+        self._carry_pos = 0
+        self._carry_len = 0
         self._ifconfig = []
         self._initialized = False
         self._conntype = None
         self._use_cipstatus = use_cipstatus
+        self._capability_cache = capability_cache
+        self.capabilities = {}
+        self.sntp_timezone = 0  # as last given to sntp_config
+        self._scan_opts = None
+        self._last_AP = None  # (ssid, bssid, channel) of the last good join
+        self._last_ipconfig = None  # (ip, gateway, netmask) handed out by DHCP
+        self._static_ip = False
+        self._socket_args = None  # (conntype, remote, port) of the open socket
+        self._urc_events = []
+        self.dns_cache = DNSCache(dns_cache_size, dns_ttl)
+        self._ssl_settings = {}  # what the firmware has been told, see ssl_config()
+        self._ssl_sni_pinned = False
+        self._peer_closed = False
+        self._ipd_stash = []  # packets that turned up while socket_send() waited
+        self.ssl_handshake_time = None  # seconds the last SSL connect took
+        self.last_reply = self.REPLY_OK  # how the last at_response() ended
+        self.busy_retries = 5
+        self.timeouts = AdaptiveTimeouts(timeout_floor)
+        self._encoder = CommandEncoder()
 
     def begin(self) -> None:
         """Initialize the module by syncing, resetting if necessary, setting up
         the desired baudrate, turning on single-socket mode, and configuring
         SSL support. Required before using the module but we dont do in __init__
-        because this can throw an exception."""
+        because this can throw an exception.
+
+        If a capability_cache file was given and it knows this module (by
+        MAC address), the probing is skipped: AT+CIPSTAMAC? to find the
+        module and AT+GMR to check it hasn't been reflashed since is all
+        that's sent."""
+        if self._capability_cache and self._warm_start():
+            print(f"INITIALIZED FROM CACHE - {self.baudrate}, {self.version}")
+            return
         # Connect and sync
         for _ in range(3):
             try:
@@ -121,31 +395,138 @@ class ESP_ATcontrol:
                 # get and cache versionstring
                 version = self.get_version()
                 print(f"VERSION {version}")
-                try:
-                    self.at_response("AT+CWSTATE?", retries=1, timeout=3)
-                except OKError:
+                if not self._supports("AT+CWSTATE?"):
                     # ESP8285's use CIPSTATUS and have no CWSTATE or CWIPSTATUS functions
                     self._use_cipstatus = True
                     if self._debug:
                         print("No CWSTATE support, using CIPSTATUS, it's ok!")
 
                 self._initialized = True
+                if self._capability_cache:
+                    self.probe_capabilities()
                 print(f"INITIALIZED COMPLETE - {self.baudrate}, {self.version}")
                 return
             except OKError:
                 pass  # retry
+        raise RuntimeError("ESP module isn't answering AT commands")
+
+    def _supports(self, at_cmd: Union[str, Template], *args: Union[str, int]) -> bool:
+        """True if the firmware answers OK to this command"""
+        try:
+            if args:
+                self.at_command(at_cmd, *args, timeout=3, retries=1)
+            else:
+                self.at_response(at_cmd, timeout=3, retries=1)
+        except OKError:
+            return False
+        return True
+
+    @property
+    def mac_address(self) -> Union[str, None]:
+        """The station MAC address as a colon separated string"""
+        reply = self.at_response("AT+CIPSTAMAC?", timeout=3, retries=1)
+        for line in reply.split(b"\r\n"):
+            if line.startswith(b"+CIPSTAMAC:"):
+                return str(line[11:], "utf-8").strip('"')
+        return None
+
+    def probe_capabilities(self) -> Dict[str, Union[str, int, bool, None]]:
+        """Find out what the firmware can do and store it in the
+        capability_cache file under this module's MAC address, so the next
+        begin() can skip all of it"""
+        cwstate = not self._use_cipstatus
+        cipstate = self._supports("AT+CIPSTATE?")
+        self._use_cipstatus = not (cwstate and cipstate)  # status needs both
+        self.capabilities = {
+            "version": self._version,
+            "cwstate": cwstate,
+            "cipstate": cipstate,
+            # AT+HTTPCGET/AT+HTTPCPOST came in with AT+HTTPURLCFG (ESP-AT 2.2)
+            "http": self._supports("AT+HTTPURLCFG?"),
+            "baudrate": self.uart_baudrate(),
+        }
+        mac = self.mac_address
+        if mac and self._capability_cache:
+            cache = self._load_capabilities()
+            if cache.get(mac) != self.capabilities:
+                cache[mac] = self.capabilities
+                try:
+                    with open(self._capability_cache, "w") as cache_file:
+                        json.dump(cache, cache_file)
+                except OSError as err:
+                    print("Couldn't write capability cache", err)
+        return self.capabilities
+
+    def uart_baudrate(self) -> Optional[int]:
+        """The baud rate the module says its UART runs at (AT+UART_CUR?),
+        None on firmware that doesn't have the command"""
+        try:
+            reply = self.at_response("AT+UART_CUR?", timeout=3, retries=1)
+        except OKError:
+            return None
+        for line in reply.split(b"\r\n"):
+            if line.startswith(b"+UART_CUR:"):
+                return int(line[10:].split(b",")[0])
+        return None
+
+    def _load_capabilities(self) -> Dict[str, Dict[str, Union[str, int, bool, None]]]:
+        try:
+            with open(self._capability_cache) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _warm_start(self) -> bool:
+        """Two commands instead of the whole begin() probe, works if the
+        cache knows the module that answers and its firmware is the same"""
+        cache = self._load_capabilities()
+        if not cache:
+            return False
+        try:
+            reply = self.at_response("AT+CIPSTAMAC?", timeout=3, retries=1)
+        except OKError:
+            return False
+        mac = None
+        for line in reply.split(b"\r\n"):
+            if line.startswith(b"+CIPSTAMAC:"):
+                mac = str(line[11:], "utf-8").strip('"')
+        capabilities = cache.get(mac)
+        if not capabilities or capabilities.get("baudrate") not in (None, self._run_baudrate):
+            return False
+        try:
+            if reply.startswith(b"AT+CIPSTAMAC?"):
+                self.echo(False)  # freshly reset modules echo, put that right
+            # a reflashed module keeps its MAC, what it can do may have changed
+            if self.get_version() != capabilities.get("version"):
+                return False
+        except OKError:
+            return False
+        self.capabilities = capabilities
+        self._use_cipstatus = not (capabilities["cwstate"] and capabilities.get("cipstate"))
+        self.baudrate = self._run_baudrate
+        self._initialized = True
+        return True
 
     def connect(
-        self, secrets: Dict[str, Union[str, int]], timeout: int = 15, retries: int = 3
+        self,
+        secrets: Dict[str, Union[str, int]],
+        timeout: int = 15,
+        retries: int = 3,
+        prewarm: Optional[List[str]] = None,
     ) -> None:
         """Repeatedly try to connect to an access point with the details in
         the passed in 'secrets' dictionary. Be sure 'ssid' and 'password' are
         defined in the secrets dict! If 'timezone' is set, we'll also configure
-        SNTP"""
+        SNTP. If 'dns_servers' is set those are used for lookups, and the
+        hostnames in 'prewarm' (or secrets['dns_prewarm']) are resolved into
+        the DNS cache straight away"""
         # Connect to WiFi if not already
         try:
             if not self._initialized:
                 self.begin()
+            # one status query, so a link that's already up (and any open
+            # socket on it) is left alone; join_AP() takes the fast path
+            # with the cached BSSID if it does need to rejoin
             AP = self.remote_AP  # pylint: disable=invalid-name
             if AP[0] != secrets["ssid"]:
                 self.join_AP(
@@ -164,14 +545,34 @@ class ESP_ATcontrol:
                 print("My IP Address:", self.local_ip)
             else:
                 print("Already connected to", AP[0])
+            if "dns_servers" in secrets:
+                self.dns_config(secrets["dns_servers"])
+            for host in prewarm or secrets.get("dns_prewarm", ()):
+                try:
+                    self.nslookup(host)
+                except RuntimeError:
+                    pass  # cached as a failure, that's fine too
             return  # yay!
         except (RuntimeError, OKError) as exp:
             print("Failed to connect\n", exp)
             raise
 
-    def hard_reset(self):
-        print("@TODO hard_reset()")
-        pass
+    def hard_reset(self) -> None:
+        """Perform a hardware reset by pulsing the reset pin low, if it was
+        defined in the initialization of this object, otherwise fall back to
+        a soft AT+RST. Either way begin() has to run again afterwards"""
+        if self._reset_pin:
+            _pin_write(self._reset_pin, False)
+            time.sleep(0.1)
+            _pin_write(self._reset_pin, True)
+        else:
+            self._uart.write(b"AT+RST\r\n")
+        time.sleep(3)  # give it a few seconds to wake up
+        self.reset_input_buffer()
+        self._initialized = False
+        self._conntype = None
+        self._socket_args = None
+        self._ssl_settings = {}  # the firmware forgot them
 
     def echo(self, echo: bool) -> None:
         """Set AT command echo on or off"""
@@ -231,6 +632,7 @@ class ESP_ATcontrol:
         version number"""
         reply = self.at_response("AT+GMR", timeout=3).strip(b"\r\n")
         self._version = None
+        self._versionstrings = []
         for line in reply.split(b"\r\n"):
             if line:
                 self._versionstrings.append(str(line, "utf-8"))
@@ -257,7 +659,7 @@ class ESP_ATcontrol:
             self.begin()
         if not mode in (1, 2, 3):
             raise RuntimeError("Invalid Mode")
-        self.at_response("AT+CWMODE=%d" % mode, timeout=3)
+        self.at_command(_CWMODE, mode, timeout=3)
 
     @property
     def conntype(self) -> Union[str, None]:
@@ -280,7 +682,10 @@ class ESP_ATcontrol:
 
     def ping(self, host: str) -> Union[int, None]:
         """Ping the IP or hostname given, returns ms time or None on failure"""
-        reply = self.at_response('AT+PING="%s"' % host.strip('"'), timeout=5)
+        try:
+            reply = self.at_command(_PING, host.strip('"'), timeout=5, retries=1)
+        except OKError:
+            raise RuntimeError("Couldn't ping")  # pylint: disable=raise-missing-from
         for line in reply.split(b"\r\n"):
             if line and line.startswith(b"+"):
                 try:
@@ -292,27 +697,250 @@ class ESP_ATcontrol:
         raise RuntimeError("Couldn't ping")
 
     def nslookup(self, host: str) -> Union[str, None]:
-        """Return a dotted-quad IP address strings that matches the hostname"""
-        reply = self.at_response('AT+CIPDOMAIN="%s"' % host.strip('"'), timeout=3)
-        for line in reply.split(b"\r\n"):
-            if line and line.startswith(b"+CIPDOMAIN:"):
-                return str(line[11:], "utf-8").strip('"')
-        raise RuntimeError("Couldn't find IP address")
+        """Return a dotted-quad IP address strings that matches the hostname.
+        Answers, including failures, come from dns_cache while they're fresh"""
+        host = host.strip('"')
+        if _is_ip(host):
+            return host
+        hit, address = self.dns_cache.lookup(host)
+        if not hit:
+            address = None
+            try:
+                reply = self.at_command(_CIPDOMAIN, host, timeout=3)
+            except OKError:
+                reply = b""  # no such host, remembered as that for a while
+            for line in reply.split(b"\r\n"):
+                if line and line.startswith(b"+CIPDOMAIN:"):
+                    address = str(line[11:], "utf-8").strip('"')
+                    break
+            self.dns_cache.store(host, address)
+        if address is None:
+            raise RuntimeError("Couldn't find IP address")
+        return address
+
+    def dns_config(self, servers: Optional[List[str]] = None) -> bool:
+        """Use up to three DNS servers for lookups, or go back to the ones
+        DHCP handed out if 'servers' is empty. Clears the DNS cache"""
+        self.dns_cache.clear()
+        if servers:
+            args = "1," + ",".join(quote(server) for server in servers[:3])
+        else:
+            args = "0"
+        # AT+CIPDNS on current firmware, AT+CIPDNS_CUR on older ESP8266 builds
+        for cmd in ("AT+CIPDNS=", "AT+CIPDNS_CUR="):
+            if self._supports(cmd + args):
+                return True
+        return False
 
     def at_response(self, at_cmd: str, timeout: int = 5, retries: int = 3) -> bytes:
-        for _ in range(retries):
-            self._uart.write(bytes(at_cmd, "utf-8"))
-            self._uart.write(b"\x0d\x0a")
+        """Send an AT command and return the whole reply, final OK included.
+
+        A busy reply means the firmware never ran the command, so it's sent
+        again after a growing pause, up to busy_retries times. For 'busy s...'
+        the resend waits for the SEND OK or SEND FAIL of the data the module
+        is still pushing out instead. A timeout is
+        retried up to 'retries' attempts in all, but only for commands not in
+        NON_IDEMPOTENT. ERROR or FAIL is final. Raises OKError when there's no
+        OK in the end; last_reply says which way it went.
+
+        While an idempotent command has attempts to spare 'timeout' is only
+        the ceiling, the wait is learned from earlier replies (see
+        AdaptiveTimeouts), so a lost reply is noticed and the command resent
+        quickly. The last attempt always gets the full 'timeout'
+
+        The command goes out in one UART write with its CRLF, see at_command()
+        for commands with arguments that need quoting"""
+        self._encoder.render_text(at_cmd)
+        return self._transact(at_cmd, command_verb(at_cmd), timeout, retries)
+
+    def at_command(
+        self, template: Template, *args: Union[str, int], timeout: int = 5, retries: int = 3
+    ) -> bytes:
+        """at_response() for a precompiled Template, e.g.
+        at_command(_CWJAP, ssid, password): the arguments are rendered
+        straight into the command buffer, escaped where the template quotes
+        them, so an SSID with a comma or quote in it can't break the command"""
+        self._encoder.render(template, *args)
+        return self._transact(template.fmt, template.verb, timeout, retries)
+
+    def _transact(self, at_cmd: str, verb: str, timeout: float, retries: int) -> bytes:
+        """Send the command rendered in the encoder, retrying as at_response()
+        describes"""
+        idempotent = not at_cmd.startswith(self.NON_IDEMPOTENT)
+        attempts = 0
+        busy = 0
+        pause = 0.05
+        while True:
+            wait = timeout
+            if idempotent and attempts + 1 < retries:
+                wait = self.timeouts.timeout(verb, timeout)
+            self._uart.write(self._encoder.rendered)
             stamp = monotonic()
-            response = b""
-            while (monotonic() - stamp) < timeout:
-                if self._uart.any() > 0:
-                    response += self._uart.readline()
-                    if response[-4:] == b"OK\r\n":
-                        break
-                    if response[-7:] == b"ERROR\r\n":
-                        break
-            return response
+            reply = self._read_reply(wait)
+            result = self._classify(reply)
+            self.last_reply = result
+            if result == self.REPLY_TIMEOUT:
+                self.timeouts.backoff(verb)
+            elif result in (self.REPLY_OK, self.REPLY_ERROR):
+                self.timeouts.observe(verb, monotonic() - stamp)
+            if result == self.REPLY_OK:
+                return reply
+            if result in (self.REPLY_BUSY, self.REPLY_BUSY_SENDING):
+                busy += 1
+                if busy > self.busy_retries:
+                    break
+                if result == self.REPLY_BUSY_SENDING:
+                    # SEND OK or SEND FAIL says the send is over, no need to guess
+                    self._read_reply(timeout)
+                    continue
+            else:
+                attempts += 1
+                if result == self.REPLY_ERROR or not idempotent or attempts >= retries:
+                    break
+                # the late end of the lost reply would confuse the next one
+                self.reset_input_buffer()
+            if self._debug:
+                print("at_response(): %r %s, retrying" % (at_cmd, ("busy", "timed out")[result - 2]))
+            time.sleep(pause)
+            pause = min(pause * 2, 1)
+        raise OKError(
+            "No OK response to %s (%s)"
+            % (at_cmd, ("ERROR", "busy", "timeout", "busy sending")[self.last_reply - 1])
+        )
+
+    @classmethod
+    def _classify(cls, reply: bytes) -> int:
+        """Which REPLY_* a reply from _read_reply() is"""
+        if reply.endswith(b"OK\r\n"):
+            return cls.REPLY_OK
+        if reply.endswith(b"ERROR\r\n") or reply.endswith(b"FAIL\r\n"):
+            return cls.REPLY_ERROR
+        start = reply.rfind(b"\n", 0, -1) + 1
+        if reply.endswith(b"\r\n") and reply.rfind(b"busy ") == start:
+            if reply.startswith(b"busy s", start):
+                return cls.REPLY_BUSY_SENDING
+            return cls.REPLY_BUSY
+        return cls.REPLY_TIMEOUT
+
+    def _read_reply(self, timeout: float) -> bytes:
+        """Collect reply lines in the preallocated reply block until OK,
+        ERROR, FAIL or a busy line, then copy the reply out once"""
+        buf = self._replybuf
+        size = len(buf)
+        spill = b""
+        n = 0
+        stamp = monotonic()
+        while (monotonic() - stamp) < timeout:
+            start = n
+            n = self._rx_line(buf, n, stamp, timeout)
+            # socket data that got in ahead of the reply isn't part of it
+            while n - start > 5 and _ends_with(buf, start + 5, b"+IPD,"):
+                n = self._stash_ipd(buf, start, n, stamp, timeout)
+            if n == start:
+                continue
+            if buf[n - 1] == 10:  # a whole line
+                self._note_urc(buf, start, n)
+                if (
+                    _ends_with(buf, n, b"OK\r\n")
+                    or _ends_with(buf, n, b"ERROR\r\n")
+                    or _ends_with(buf, n, b"FAIL\r\n")
+                    or (n - start > 5 and _ends_with(buf, start + 5, b"busy "))
+                ):
+                    break
+            if n > size - 128:
+                # a long reply such as a full AT+CWLAP, keep the block for the tail
+                spill += bytes(buf[:n])
+                n = 0
+        return spill + bytes(buf[:n])
+
+    # *************************** UART RECEIVE ****************************
+
+    def _rx_fill(self) -> bool:
+        """Make sure there's something in the carry buffer, topping it up
+        from the UART if needed. False if nothing is waiting at all"""
+        if self._carry_pos < self._carry_len:
+            return True
+        avail = self._uart.any()
+        if avail <= 0:
+            return False
+        self._carry_len = self._uart.readinto(self._carry, min(avail, len(self._carry))) or 0
+        self._carry_pos = 0
+        return self._carry_len > 0
+
+    def _rx_any(self) -> int:
+        """Bytes waiting, carried over ones included"""
+        return self._carry_len - self._carry_pos + self._uart.any()
+
+    def _rx_wait(self, stamp: float, timeout: float) -> None:
+        """Nothing waiting: block until something is, or the time's up,
+        if the UART can (see espatcontrol_hostuart)"""
+        if self._uart_wait:
+            self._uart_wait(timeout - (monotonic() - stamp))
+
+    def _rx_byte(self) -> int:
+        """Next byte, only call after _rx_fill() said there is one"""
+        byte = self._carry[self._carry_pos]
+        self._carry_pos += 1
+        return byte
+
+    def _rx_readinto(self, buf: memoryview, start: int, nbytes: int) -> int:
+        """Read up to nbytes into buf at 'start', returns how many we got"""
+        if self._carry_pos < self._carry_len:
+            count = min(nbytes, self._carry_len - self._carry_pos)
+            carry = self._carry
+            pos = self._carry_pos
+            for j in range(count):
+                buf[start + j] = carry[pos + j]
+            self._carry_pos += count
+            return count
+        if nbytes <= 0:
+            return 0
+        if start:
+            buf = buf[start:]
+        return self._uart.readinto(buf, nbytes) or 0
+
+    def _rx_line(self, buf: memoryview, start: int, stamp: float, timeout: float) -> int:
+        """Read into buf from 'start' up to and including the next newline,
+        or until buf is full or we time out. Returns the end offset"""
+        i = start
+        size = len(buf)
+        while i < size and (monotonic() - stamp) < timeout:
+            if not self._rx_fill():
+                self._rx_wait(stamp, timeout)
+                continue
+            while i < size and self._carry_pos < self._carry_len:
+                byte = self._rx_byte()
+                buf[i] = byte
+                i += 1
+                if byte == 10:
+                    return i
+        return i
+
+    def _note_urc(self, buf: memoryview, start: int, end: int) -> None:
+        """Remember link change notifications for poll_urc()"""
+        if end - start > 17 or buf[start] not in (67, 87):  # 'C'losed, 'W'IFI
+            return
+        line = bytes(buf[start:end]).rstrip(b"\r\n")
+        if line == b"CLOSED":
+            self._peer_closed = True
+        if line in self.URC_LINES:
+            if len(self._urc_events) > 8:
+                self._urc_events.pop(0)
+            self._urc_events.append(line)
+
+    def poll_urc(self) -> List[bytes]:
+        """Pick up any unsolicited lines ('WIFI DISCONNECT', 'CLOSED', ...)
+        waiting in the UART without sending a command, plus any seen inside
+        earlier command replies. Returns them oldest first and forgets them.
+        Only call this when no socket data is expected, it consumes lines"""
+        buf = self._replybuf
+        while self._rx_any() > 0:
+            end = self._rx_line(buf, 0, monotonic(), 0.1)
+            if end:
+                self._note_urc(buf, 0, end)
+        events = self._urc_events
+        self._urc_events = []
+        return events
 
     # *************************** SNTP SETUP ****************************
 
@@ -321,16 +949,18 @@ class ESP_ATcontrol:
     ) -> None:
         """Configure the built in ESP SNTP client with a UTC-offset number (timezone)
         and server as IP or hostname."""
-        cmd = "AT+CIPSNTPCFG="
-        if enable:
-            cmd += "1"
+        enable = 1 if enable else 0
+        if server is not None:
+            # the server comes after the timezone, it can't go on its own
+            if timezone is None:
+                timezone = self.sntp_timezone
+            self.at_command(_SNTPCFG_SERVER, enable, timezone, server, timeout=3)
+        elif timezone is not None:
+            self.at_command(_SNTPCFG_TZ, enable, timezone, timeout=3)
         else:
-            cmd += "0"
+            self.at_command(_SNTPCFG, enable, timeout=3)
         if timezone is not None:
-            cmd += ",%d" % timezone
-        if server is not None:
-            cmd += ',"%s"' % server
-        self.at_response(cmd, timeout=3)
+            self.sntp_timezone = timezone
 
     @property
     def sntp_time(self) -> Union[bytes, None]:
@@ -343,6 +973,57 @@ class ESP_ATcontrol:
         return None
 
 
+    def scan_options(
+        self,
+        sort_rssi: bool = True,
+        rssi_min: Optional[int] = None,
+        mask: int = CWLAP_COMPACT,
+    ) -> bool:
+        """Set which fields AT+CWLAP prints (see CWLAP_* in espatcontrol_ap),
+        whether results are sorted by RSSI and the weakest RSSI the firmware
+        should report at all. Returns False if the firmware rejected it"""
+        cmd = "AT+CWLAPOPT=%d,%d" % (1 if sort_rssi else 0, mask)
+        if rssi_min is not None:
+            cmd += ",%d" % rssi_min
+        if not self._supports(cmd):
+            self._scan_opts = None
+            return False
+        self._scan_opts = (sort_rssi, rssi_min, mask)
+        return True
+
+    def iter_APs(  # pylint: disable=invalid-name
+        self, rssi_min: Optional[int] = None, sort_rssi: bool = True, timeout: int = 10
+    ) -> Iterator[AccessPoint]:
+        """Scan for access points, yielding an AccessPoint as each +CWLAP line
+        arrives instead of buffering the whole reply. Networks weaker than
+        rssi_min are dropped. Stopping early drains the rest of the scan so
+        the next command starts clean"""
+        if self.mode != self.MODE_STATION:
+            self.mode = self.MODE_STATION
+        if self._scan_opts != (sort_rssi, rssi_min, CWLAP_COMPACT):
+            self.scan_options(sort_rssi, rssi_min)
+        self._uart.write(b"AT+CWLAP\r\n")
+        buf = self._replybuf
+        done = False
+        stamp = monotonic()
+        try:
+            while (monotonic() - stamp) < timeout:
+                end = self._rx_line(buf, 0, stamp, timeout)
+                if _ends_with(buf, end, b"OK\r\n") or _ends_with(buf, end, b"ERROR\r\n"):
+                    done = True
+                    return
+                if end < 9 or buf[1] != 67:  # not a '+CWLAP:(' line
+                    continue
+                access_point = AccessPoint.from_cwlap(buf[:end])
+                if access_point is None:
+                    continue
+                if rssi_min is None or access_point.rssi >= rssi_min:
+                    yield access_point
+        finally:
+            while not done and (monotonic() - stamp) < timeout:
+                end = self._rx_line(buf, 0, stamp, timeout)
+                done = _ends_with(buf, end, b"OK\r\n") or _ends_with(buf, end, b"ERROR\r\n")
+
     def scan_APs(  # pylint: disable=invalid-name
         self, retries: int = 3
     ) -> Union[List[List[bytes]], None]:
@@ -352,8 +1033,12 @@ class ESP_ATcontrol:
             try:
                 if self.mode != self.MODE_STATION:
                     self.mode = self.MODE_STATION
+                if self._scan_opts is not None:
+                    # iter_APs() trimmed the print mask, put the full one back
+                    self.scan_options(False, None, CWLAP_ALL)
+                    self._scan_opts = None
                 scan = self.at_response("AT+CWLAP", timeout=5).split(b"\r\n")
-            except RuntimeError:
+            except (RuntimeError, OKError):
                 continue
             routers = []
             for line in scan:
@@ -373,12 +1058,12 @@ class ESP_ATcontrol:
     def remote_AP(self) -> List[Union[int, str, None]]:  # pylint: disable=invalid-name
         """The name of the access point we're connected to, as a string"""
         stat = self.status
-        if stat != self.STATUS_APCONNECTED:
+        # an open or just closed socket is still on the access point
+        if stat not in (self.STATUS_APCONNECTED, self.STATUS_SOCKETOPEN, self.STATUS_SOCKETCLOSED):
             return [None] * 4
         replies = self.at_response("AT+CWJAP?", timeout=10).split(b"\r\n")
         for reply in replies:
-            #print("REPLY ", type(reply), str(reply))
-            if not str(reply).startswith("+CWJAP:"):
+            if not reply.startswith(b"+CWJAP:"):
                 continue
             reply = reply[7:].split(b",")
             for i, val in enumerate(reply):
@@ -391,10 +1076,29 @@ class ESP_ATcontrol:
         return [None] * 4
 
     def join_AP(  # pylint: disable=invalid-name
-        self, ssid: str, password: str, timeout: int = 15, retries: int = 3
+        self,
+        ssid: str,
+        password: str,
+        timeout: int = 15,
+        retries: int = 3,
+        *,
+        fast: bool = True,
+        reuse_ip: bool = False,
     ) -> None:
         """Try to join an access point by name and password, will return
-        immediately if we're already connected and won't try to reconnect"""
+        immediately if we're already connected and won't try to reconnect.
+
+        If we have joined this ssid before and 'fast' is set, the mode and
+        remote_AP checks are skipped and the cached BSSID is passed to the
+        extended AT+CWJAP so the firmware does not scan every channel. With
+        'reuse_ip' the last DHCP lease is set statically to skip DHCP too"""
+        if fast and self._last_AP and self._last_AP[0] == ssid:
+            if self._fast_join(ssid, password, timeout, reuse_ip):
+                return
+            if self._debug:
+                print("join_AP(): fast path failed, doing a full join")
+            self._last_AP = None
+
         # First make sure we're in 'station' mode so we can connect to AP's
         if self._debug:
             print("In join_AP()")
@@ -404,19 +1108,73 @@ class ESP_ATcontrol:
         router = self.remote_AP
         if router and router[0] == ssid:
             return  # we're already connected!
-        reply = self.at_response(
-            'AT+CWJAP="' + ssid + '","' + password + '"',
-            timeout=timeout,
-            retries=retries,
-        )
+        if self._static_ip:
+            # a previous fast join pinned the address, go back to DHCP
+            self.at_response("AT+CWDHCP=1,1", timeout=3, retries=1)
+            self._static_ip = False
+        try:
+            reply = self.at_command(_CWJAP, ssid, password, timeout=timeout, retries=retries)
+        except OKError:
+            reply = b""
         if b"WIFI CONNECTED" not in reply:
             print("no CONNECTED")
             raise RuntimeError("Couldn't connect to WiFi")
         if b"WIFI GOT IP" not in reply:
             print("no IP")
             raise RuntimeError("Didn't get IP address")
+        self._remember_AP(ssid)
         return
 
+    def _fast_join(
+        self, ssid: str, password: str, timeout: int, reuse_ip: bool
+    ) -> bool:
+        """Rejoin a known AP by BSSID with a fast (first match) scan"""
+        if reuse_ip and self._last_ipconfig:
+            self._static_ip = self._supports(_CIPSTA, *self._last_ipconfig)
+        # ssid, pwd, bssid, pci_en, reconn_interval, listen_interval, scan_mode=fast, jap_timeout
+        try:
+            reply = self.at_command(
+                _CWJAP_FAST, ssid, password, self._last_AP[1], timeout, timeout=timeout, retries=1
+            )
+        except OKError:
+            return False
+        if b"WIFI CONNECTED" in reply and (
+            self._static_ip or b"WIFI GOT IP" in reply
+        ):
+            return True
+        return False
+
+    def _remember_AP(self, ssid: str) -> None:  # pylint: disable=invalid-name
+        """Cache the BSSID, channel and IP config of the AP we just joined"""
+        self._last_AP = None
+        for reply in self.at_response("AT+CWJAP?", timeout=5).split(b"\r\n"):
+            if not reply.startswith(b"+CWJAP:"):
+                continue
+            # the BSSID is the last quoted field, channel comes right after it
+            end = reply.rfind(b'"')
+            start = reply.rfind(b'"', 0, end)
+            try:
+                channel = int(reply[end + 2 :].split(b",", 1)[0])
+            except ValueError:
+                return
+            self._last_AP = (ssid, str(reply[start + 1 : end], "utf-8"), channel)
+        ipconfig = {}
+        for reply in self.at_response("AT+CIPSTA?", timeout=3).split(b"\r\n"):
+            if reply.startswith(b"+CIPSTA:"):
+                key, _, value = reply[8:].partition(b":")
+                ipconfig[key] = str(value, "utf-8").strip('"')
+        if b"ip" in ipconfig and b"gateway" in ipconfig and b"netmask" in ipconfig:
+            self._last_ipconfig = (
+                ipconfig[b"ip"],
+                ipconfig[b"gateway"],
+                ipconfig[b"netmask"],
+            )
+
+    def reconnect_config(self, interval: int = 1, repeat: int = 0) -> None:
+        """Let the firmware reconnect by itself after it loses the AP, every
+        'interval' seconds, 'repeat' times (0 means forever)"""
+        self.at_response("AT+CWRECONNCFG=%d,%d" % (interval, repeat), timeout=3)
+
     # *************************** WIFI SETUP ****************************
 
     @property
@@ -551,6 +1309,49 @@ class ESP_ATcontrol:
                 return int(reply[8:])
         raise RuntimeError("Bad response to CIPMUX?")
 
+    def ssl_config(
+        self,
+        *,
+        auth_mode: Optional[int] = None,
+        pki_number: int = 0,
+        ca_number: int = 0,
+        sni: Optional[str] = None,
+        alpn: Optional[List[str]] = None,
+        buffer_size: Optional[int] = None,
+    ) -> None:
+        """Configure TYPE_SSL connections. auth_mode is the AT+CIPSSLCCONF
+        mode: 0 no certificates, 1 send our client cert, 2 verify the server
+        against the CA, 3 both, using the PKI/CA slots given. 'sni' pins the
+        server name (by default socket_connect() sends the hostname it is
+        connecting to, an empty string goes back to that), 'alpn' is a list
+        of protocols such as ["http/1.1"] and 'buffer_size' is the
+        AT+CIPSSLSIZE buffer (ESP8266 firmware only). Only settings that
+        changed are sent to the module."""
+        if auth_mode is not None:
+            if auth_mode:
+                args = "%d,%d,%d" % (auth_mode, pki_number, ca_number)
+            else:
+                args = "0"
+            self._ssl_set("CIPSSLCCONF", args)
+        if sni is not None:
+            self._ssl_sni_pinned = bool(sni)
+            if sni:
+                self._ssl_set("CIPSSLCSNI", quote(sni))
+        if alpn is not None:
+            self._ssl_set(
+                "CIPSSLCALPN",
+                ",".join([str(len(alpn))] + [quote(proto) for proto in alpn]),
+            )
+        if buffer_size is not None:
+            self._ssl_set("CIPSSLSIZE", str(buffer_size))
+
+    def _ssl_set(self, command: str, args: str) -> None:
+        if self._ssl_settings.get(command) == args:
+            return
+        if not self._supports("AT+%s=%s" % (command, args)):
+            raise RuntimeError("Firmware rejected AT+" + command)
+        self._ssl_settings[command] = args
+
     def socket_connect(  # pylint: disable=too-many-branches
         self,
         conntype: str,
@@ -559,11 +1360,18 @@ class ESP_ATcontrol:
         *,
         keepalive: int = 10,
         retries: int = 1,
+        reuse: bool = False,
     ) -> bool:
         """Open a socket. conntype can be TYPE_TCP, TYPE_UDP, or TYPE_SSL. Remote
         can be an IP address or DNS (we'll do the lookup for you. Remote port
         is integer port on other side. We can't set the local port.
 
+        With 'reuse', a socket that is still open to the same remote and port
+        is kept instead of being torn down, which saves the whole TLS
+        handshake when several requests go to one HTTPS host (send them with
+        'Connection: keep-alive'). ssl_handshake_time records how long the
+        last SSL connect took.
+
         Note that this method is usually called by the requests-package, which
         does not know anything about conntype. So it is mandatory to set
         the conntype manually before calling this method if the conntype-parameter
@@ -587,6 +1395,11 @@ class ESP_ATcontrol:
             elif remote_port == 1883:
                 conntype = self.TYPE_TCP
 
+        if reuse and self._socket_args == (conntype, remote, remote_port):
+            # a CLOSED waiting in the UART is picked up by the CIPSTATE reply
+            if self.status_socket == self.STATUS_SOCKET_OPEN and not self._peer_closed:
+                return True
+
         # lets just do one connection at a time for now
         if conntype == self.TYPE_UDP:
             # always disconnect for TYPE_UDP
@@ -601,19 +1414,32 @@ class ESP_ATcontrol:
                 time.sleep(1)
         if not conntype in (self.TYPE_TCP, self.TYPE_UDP, self.TYPE_SSL):
             raise RuntimeError("Connection type must be TCP, UDL or SSL")
-        cmd = (
-            'AT+CIPSTART="'
-            + conntype
-            + '","'
-            + remote
-            + '",'
-            + str(remote_port)
-            #+ ","
-            #+ str(keepalive)
-        )
+        address = remote
+        if conntype != self.TYPE_SSL:
+            # SSL keeps the hostname so the firmware can do SNI/cert checks
+            try:
+                address = self.nslookup(remote)
+            except RuntimeError:
+                pass  # let the firmware have a go itself
+        elif not self._ssl_sni_pinned and not _is_ip(remote):
+            try:
+                self._ssl_set("CIPSSLCSNI", quote(remote))
+            except RuntimeError:
+                self._ssl_sni_pinned = True  # no SNI support, stop asking
         if self._debug is True:
-            print(f"socket_connect(): Going to send command '{cmd}'")
-        replies = self.at_response(cmd, timeout=10, retries=retries).split(b"\r\n")
+            print(f"socket_connect(): Going to connect {conntype} to {address}:{remote_port}")
+        self._peer_closed = False
+        stamp = monotonic()
+        try:
+            replies = self.at_command(
+                _CIPSTART, conntype, address, remote_port, timeout=10, retries=retries
+            ).split(b"\r\n")
+        except OKError:
+            replies = []  # ERROR, or ALREADY CONNECTED then ERROR
+        if conntype == self.TYPE_SSL:
+            self.ssl_handshake_time = monotonic() - stamp
+            if self._debug:
+                print("socket_connect(): SSL handshake took %.2fs" % self.ssl_handshake_time)
         for reply in replies:
             if reply == b"CONNECT" and (
                 conntype in (self.TYPE_TCP, self.TYPE_SSL)
@@ -621,128 +1447,392 @@ class ESP_ATcontrol:
                 or conntype == self.TYPE_UDP
             ):
                 self._conntype = conntype
+                self._socket_args = (conntype, remote, remote_port)
                 return True
 
+        if address != remote:
+            self.dns_cache.forget(remote)  # maybe it moved, ask again next time
         return False
     
-    def reset_input_buffer(self):
-        print("@TODO  reset_input_buffer(uart)")
-        _uart = self._uart
-        
-    def socket_send(self, buffer: bytes, timeout: int = 1) -> bool:
-        """Send data over the already-opened socket, buffer must be bytes"""
-        cmd = f"AT+CIPSEND={len(buffer)}"
-        self.at_response(cmd, timeout=5, retries=1)
-        prompt = b""
-        stamp = monotonic()
-        while (monotonic() - stamp) < timeout:
-            if self._uart.any():
-                prompt += self._uart.read(1)
-                self.hw_flow(False)
-                # print(prompt)
-                if prompt[-1:] == b">":
-                    break
-            else:
-                self.hw_flow(True)
-        if not prompt or (prompt[-1:] != b">"):
-            raise RuntimeError("Didn't get data prompt for sending")
+    def reset_input_buffer(self) -> None:
+        """Throw away anything waiting in the UART receive buffer"""
+        self._carry_pos = self._carry_len = 0
+        while self._uart.any() > 0:
+            self._uart.readinto(self._carry, min(self._uart.any(), len(self._carry)))
 
-        self.reset_input_buffer()
-        
+    def socket_send(
+        self,
+        buffer: bytes,
+        timeout: int = 1,
+        *,
+        address: Optional[Tuple[str, int]] = None,
+    ) -> bool:
+        """Send data over the already-opened socket, buffer must be bytes.
+        For a UDP socket opened in mode 2 'address' = (ip, port) picks the
+        destination of this one datagram, and we wait for the SEND OK"""
+        if address is None:
+            self.at_command(_CIPSEND, len(buffer), timeout=5, retries=1)
+        else:
+            host = self.nslookup(address[0])
+            self.at_command(_CIPSEND_TO, len(buffer), host, address[1], timeout=5, retries=1)
+        stamp = monotonic()
+        learned = self.timeouts.timeout(">", timeout)
+        try:
+            self._wait_prompt(learned)
+        except RuntimeError:
+            if learned >= timeout:
+                raise
+            # late rather than lost, the firmware is still waiting to be
+            # given the data: keep waiting up to the ceiling
+            self.timeouts.backoff(">")
+            self._wait_prompt(timeout - (monotonic() - stamp))
+        self.timeouts.observe(">", monotonic() - stamp)
         self._uart.write(buffer)
-        if self._conntype == self.TYPE_UDP:
+        if self._conntype == self.TYPE_UDP and address is None:
             return True
+        buf = self._replybuf
+        end = line = 0
         stamp = monotonic()
-        response = b""
-        while (monotonic() - stamp) < timeout:
-            if self._uart.any():
-                response += self._uart.read(self._uart.any())
-                if response[-9:] == b"SEND OK\r\n":
-                    break
-                if response[-7:] == b"ERROR\r\n":
-                    break
+        while (monotonic() - stamp) < timeout and end < len(buf):
+            end = self._rx_line(buf, end, stamp, timeout)
+            # the far end may already be answering, keep what it says
+            while end - line > 5 and _ends_with(buf, line + 5, b"+IPD,"):
+                end = self._stash_ipd(buf, line, end, stamp, timeout)
+            if end == line or buf[end - 1] != 10:
+                continue
+            if _ends_with(buf, end, b"SEND OK\r\n") or _ends_with(buf, end, b"ERROR\r\n"):
+                break
+            line = end
         if self._debug:
-            print("<---", response)
-        # Get newlines off front and back, then split into lines
+            print("<---", bytes(buf[:end]))
+        if address is not None:
+            return _ends_with(buf, end, b"SEND OK\r\n")
         return True
 
-    def socket_receive(self, timeout: int = 5) -> bytearray:
-        # pylint: disable=too-many-nested-blocks, too-many-branches
-        """Check for incoming data over the open socket, returns bytes"""
-        incoming_bytes = None
-        bundle = []
-        toread = 0
-        gc.collect()
-        i = 0  # index into our internal packet
+    def _stash_ipd(
+        self, buf: memoryview, line: int, end: int, stamp: float, timeout: float
+    ) -> int:
+        """The start of a +IPD packet turned up at buf[line:end] while we
+        were waiting for a command reply or SEND OK. Read the rest of it and
+        keep it for the next socket_receive_into(). Anything read past the
+        packet is moved to buf[line:], returns where that ends"""
+        colon = line + 5
+        while colon < end and buf[colon] != 58:  # ':'
+            colon += 1
+        if colon == end:
+            return line  # cut short inside the header, nothing to keep
+        size = _parse_ipd_length(buf, colon + 1, line + 5)
+        in_line = min(size, end - colon - 1)
+        packet = bytearray(size)
+        packet[:in_line] = buf[colon + 1 : colon + 1 + in_line]
+        view = memoryview(packet)
+        have = in_line
+        while have < size and (monotonic() - stamp) < timeout:
+            if not self._rx_fill():
+                self._rx_wait(stamp, timeout)
+                continue
+            have += self._rx_readinto(view, have, min(size - have, self._rx_any()))
+        if have == size:
+            self._ipd_stash.append(packet)
+        elif self._debug:
+            print("Dropped a +IPD packet cut short at", have, "of", size)
+        rest = end - (colon + 1 + in_line)
+        if rest > 0:
+            buf[line : line + rest] = buf[end - rest : end]
+            return line + rest
+        return line
+
+    @property
+    def in_waiting(self) -> int:
+        """Bytes received from the module that haven't been read yet, so
+        a caller can check for socket data without blocking"""
+        return len(self._ipd_stash) + self._rx_any()
+
+    def _wait_prompt(self, timeout: float) -> None:
+        """Wait for the '>' the firmware sends when it's ready for data"""
         stamp = monotonic()
-        ipd_start = b"+IPD,"
         while (monotonic() - stamp) < timeout:
-            if self._uart.any():
-                stamp = monotonic()  # reset timestamp when there's data!
-                if not incoming_bytes:
-                    self.hw_flow(False)  # stop the flow
-                    # read one byte at a time
-                    self._ipdpacket[i] = self._uart.read(1)[0]
-                    if chr(self._ipdpacket[0]) != "+":
-                        i = 0  # keep goin' till we start with +
-                        continue
-                    i += 1
-                    # look for the IPD message
-                    if (ipd_start in self._ipdpacket) and chr(
-                        self._ipdpacket[i - 1]
-                    ) == ":":
-                        try:
-                            ipd = str(self._ipdpacket[5 : i - 1], "utf-8")
-                            incoming_bytes = int(ipd)
-                            if self._debug:
-                                print("Receiving:", incoming_bytes)
-                        except ValueError as err:
-                            raise RuntimeError(
-                                "Parsing error during receive", ipd
-                            ) from err
-                        i = 0  # reset the input buffer now that we know the size
-                    elif i > 20:
-                        i = 0  # Hmm we somehow didnt get a proper +IPD packet? start over
-                else:
-                    self.hw_flow(False)  # stop the flow
-                    # read as much as we can!
-                    toread = min(incoming_bytes - i, self._uart.any())
-                    # print("i ", i, "to read:", toread)
-                    self._ipdpacket[i : i + toread] = self._uart.read(toread)
-                    i += toread
-                    if i == incoming_bytes:
-                        # print(self._ipdpacket[0:i])
-                        gc.collect()
-                        bundle.append(self._ipdpacket[0:i])
-                        gc.collect()
-                        i = incoming_bytes = 0
-                        break  # We've received all the data. Don't wait until timeout.
-            else:  # no data waiting
+            if self._rx_fill():
+                self.hw_flow(False)
+                if self._rx_byte() == 62:  # '>'
+                    return
+            else:
+                self.hw_flow(True)
+                self._rx_wait(stamp, timeout)
+        raise RuntimeError("Didn't get data prompt for sending")
+
+    def socket_receive_into(self, buffer: memoryview, timeout: int = 5) -> int:
+        # pylint: disable=too-many-branches
+        """Wait for the next +IPD packet and read its payload straight into
+        'buffer', normally a block from self.buffers. Returns the payload
+        length, 0 if nothing arrived before the timeout or the far end closed
+        the socket"""
+        if self._ipd_stash:
+            packet = self._ipd_stash.pop(0)
+            if len(packet) > len(buffer):
+                raise RuntimeError("Packet bigger than buffer", len(packet))
+            buffer[: len(packet)] = packet
+            return len(packet)
+        header = self._ipdheader
+        incoming_bytes = 0
+        i = 0  # index into the header, then into the payload
+        closed = 0  # how much of a CLOSED line we've seen between packets
+        stamp = monotonic()
+        while (monotonic() - stamp) < timeout:
+            if not self._rx_fill():
                 self.hw_flow(True)  # start the floooow
-        totalsize = sum(len(x) for x in bundle)
-        ret = bytearray(totalsize)
-        i = 0
-        for x in bundle:
-            for char in x:
-                ret[i] = char
+                self._rx_wait(stamp, timeout)
+                continue
+            stamp = monotonic()  # reset timestamp when there's data!
+            self.hw_flow(False)  # stop the flow
+            if not incoming_bytes:
+                byte = self._rx_byte()
+                if i == 0 and byte != 43:  # keep goin' till we start with +
+                    if byte == _CLOSED[closed]:
+                        closed += 1
+                        if closed == len(_CLOSED):
+                            self._peer_closed = True
+                            return 0  # no more packets are coming
+                    else:
+                        closed = 1 if byte == 67 else 0
+                    continue
+                header[i] = byte
                 i += 1
-        del bundle
-        gc.collect()
-        return ret
+                if i == 5 and not _ends_with(header, 5, b"+IPD,"):
+                    i = 0
+                elif byte == 58 and i > 5:  # ':' ends the +IPD header
+                    self._ipdheader_len = i
+                    incoming_bytes = _parse_ipd_length(header, i)
+                    if incoming_bytes > len(buffer):
+                        raise RuntimeError("Packet bigger than buffer", incoming_bytes)
+                    if self._debug:
+                        print("Receiving:", incoming_bytes)
+                    i = 0  # reset the index now that we know the size
+                elif i >= len(header):
+                    i = 0  # Hmm we somehow didnt get a proper +IPD packet? start over
+            else:
+                # read as much as we can!
+                toread = min(incoming_bytes - i, self._rx_any())
+                i += self._rx_readinto(buffer, i, toread)
+                if i == incoming_bytes:
+                    return i  # We've received all the data. Don't wait until timeout.
+        return 0
+
+    def socket_receive(self, timeout: int = 5) -> bytearray:
+        """Check for incoming data over the open socket, returns bytes"""
+        size = self.socket_receive_into(self._ipdpacket, timeout)
+        return bytearray(self._ipdpacket[:size])
+
+    def socket_remote(self) -> Union[Tuple[str, int], None]:
+        """(ip, port) the last +IPD packet came from, if AT+CIPDINFO=1 is
+        on so the firmware reports it"""
+        fields = bytes(self._ipdheader[5 : self._ipdheader_len - 1]).split(b",")
+        if len(fields) < 3:
+            return None
+        return str(fields[-2], "utf-8").strip('"'), int(fields[-1])
+
+    def udp_open(
+        self, remote: str, remote_port: int, local_port: int, mode: int = 2
+    ) -> "UDPSocket":
+        """Open a long lived UDP socket bound to 'local_port'. In mode 2 the
+        far end follows whoever last sent to us and sendto() can address
+        every datagram on its own, so one socket serves any number of peers
+        without a connection setup per packet"""
+        self.at_response("AT+CIPDINFO=1", timeout=3, retries=1)
+        self.socket_disconnect()
+        try:
+            self.at_command(
+                _CIPSTART_UDP,
+                self.nslookup(remote),
+                remote_port,
+                local_port,
+                mode,
+                timeout=10,
+                retries=1,
+            )
+        except OKError:
+            raise RuntimeError("Couldn't open UDP socket")  # pylint: disable=raise-missing-from
+        self._conntype = self.TYPE_UDP
+        self._socket_args = (self.TYPE_UDP, remote, remote_port)
+        return UDPSocket(self, local_port)
 
     def socket_disconnect(self) -> None:
         """Close any open socket, if there is one"""
         self._conntype = None
+        self._socket_args = None
+        self._ipd_stash = []
         try:
             self.at_response("AT+CIPCLOSE", retries=1)
         except OKError:
             pass  # this is ok, means we didn't have an open socket
 
+    # *************************** HTTP CLIENT ****************************
 
+    def http_request(
+        self,
+        method: str,
+        url: str,
+        data: Optional[str] = None,
+        *,
+        content_type: int = HTTP_FORM,
+        headers: Optional[List[str]] = None,
+        timeout: int = 10,
+    ) -> Iterator[memoryview]:
+        """Have the firmware make the whole HTTP(S) request with
+        AT+HTTPCLIENT: it builds the request, does TLS and strips the
+        response headers. Yields the body in chunks as it arrives, each a
+        view of a pool block that's only valid until the next one. 'data' is
+        sent on the command line, so keep it short, or use http_post() if
+        the response body isn't needed"""
+        cmd = "AT+HTTPCLIENT=%d,%d,%s,,,%d" % (
+            self._HTTP_METHODS[method],
+            content_type,
+            quote(url),
+            2 if url.startswith("https:") else 1,
+        )
+        if data is not None:
+            cmd += "," + quote(data)
+        for header in headers or ():
+            cmd += "," + quote(header)
+        self._send_command(cmd)
+        return self._http_body(b"+HTTPCLIENT:", timeout)
+
+    def http_get(self, url: str, *, timeout: int = 10) -> Iterator[memoryview]:
+        """GET with AT+HTTPCGET, chunks are asked for no bigger than a pool
+        block. See http_request()"""
+        # AT+HTTPCGET=<"url">[,<tx size>][,<rx size>][,<timeout>], the rx
+        # size is what bounds the +HTTPCGET chunks
+        self._need_httpc()
+        block = self.buffers.block_size
+        self._send_command(
+            "AT+HTTPCGET=%s,%d,%d,%d" % (quote(url), block, block, timeout * 1000)
+        )
+        return self._http_body(b"+HTTPCGET:", timeout)
+
+    def http_post(
+        self,
+        url: str,
+        data: bytes,
+        *,
+        headers: Optional[List[str]] = None,
+        timeout: int = 10,
+    ) -> bool:
+        """POST a body of any size with AT+HTTPCPOST, it goes over after the
+        '>' prompt rather than on the command line. The firmware answers
+        with just SEND OK or SEND FAIL, no response body, so this returns
+        whether the POST went through. Use http_request("POST", ...) when
+        the response matters"""
+        self._need_httpc()
+        cmd = "AT+HTTPCPOST=%s,%d" % (quote(url), len(data))
+        if headers:
+            cmd += ",%d" % len(headers)
+            for header in headers:
+                cmd += "," + quote(header)
+        self.at_response(cmd, timeout=5, retries=1)
+        self._wait_prompt(timeout)
+        self._uart.write(data)
+        return self._classify(self._read_reply(timeout)) == self.REPLY_OK
+
+    def _need_httpc(self) -> None:
+        """Fail straight away when probe_capabilities() found no
+        AT+HTTPCGET/AT+HTTPCPOST, rather than after the reply times out"""
+        if self.capabilities.get("http") is False:
+            raise RuntimeError("Firmware has no AT+HTTPCGET/AT+HTTPCPOST, use http_request()")
+
+    def _send_command(self, at_cmd: str) -> None:
+        self._uart.write(self._encoder.render_text(at_cmd))
+
+    def _http_body(self, prefix: bytes, timeout: float) -> Iterator[memoryview]:
+        block = self.buffers.acquire()
+        frames = self._http_frames(prefix, block, timeout)
+        try:
+            for chunk in frames:
+                yield chunk
+        finally:
+            for _ in frames:
+                pass  # read the rest so the next command starts clean
+            self.buffers.release(block)
+
+    def _http_frames(  # pylint: disable=too-many-branches
+        self, prefix: bytes, block: memoryview, timeout: float
+    ) -> Iterator[memoryview]:
+        """Split the reply into '<prefix><len>,<data>' frames and plain lines.
+        Frame data is binary and can hold newlines, so it's read by length"""
+        header = self._ipdheader
+        plen = len(prefix)
+        i = 0
+        stamp = monotonic()
+        while (monotonic() - stamp) < timeout:
+            if not self._rx_fill():
+                self.hw_flow(True)
+                self._rx_wait(stamp, timeout)
+                continue
+            self.hw_flow(False)
+            stamp = monotonic()
+            byte = self._rx_byte()
+            if i < len(header):
+                header[i] = byte
+                i += 1
+            if byte == 44 and i > plen and _ends_with(header, plen, prefix):
+                remaining = _parse_ipd_length(header, i, plen)
+                while remaining:
+                    want = min(remaining, len(block))
+                    got = 0
+                    while got < want:
+                        if (monotonic() - stamp) > timeout:
+                            raise RuntimeError("Timed out reading HTTP body")
+                        count = self._rx_readinto(block, got, min(want - got, self._rx_any()))
+                        if count:
+                            stamp = monotonic()
+                            got += count
+                        else:
+                            self._rx_wait(stamp, timeout)
+                    remaining -= got
+                    yield block[:got]
+                i = 0
+            elif byte == 10:
+                self._note_urc(header, 0, i)
+                if _ends_with(header, i, b"OK\r\n"):
+                    return
+                if _ends_with(header, i, b"ERROR\r\n") or _ends_with(header, i, b"FAIL\r\n"):
+                    raise RuntimeError("HTTP request failed")
+                i = 0
+        raise RuntimeError("Timed out waiting for HTTP reply")
 
     def hw_flow(self, flag: bool) -> None:
         """Turn on HW flow control (if available) on to allow data, or off to stop"""
         if self._rts_pin:
-            self._rts_pin.value = not flag
-
-
+            _pin_write(self._rts_pin, not flag)
+
+
+class UDPSocket:
+    """A UDP socket from ESP_ATcontrol.udp_open(), loosely following the
+    sendto()/recvfrom() shape of a regular socket"""
+
+    def __init__(self, esp: ESP_ATcontrol, local_port: int):
+        self._esp = esp
+        self.local_port = local_port
+
+    def sendto(self, buffer: bytes, address: Tuple[str, int], timeout: int = 1) -> bool:
+        """Send one datagram to address = (host, port)"""
+        return self._esp.socket_send(buffer, timeout, address=address)
+
+    def recvfrom_into(
+        self, buffer: memoryview, timeout: int = 5
+    ) -> Tuple[int, Union[Tuple[str, int], None]]:
+        """Read the next datagram into 'buffer', returns (size, (ip, port)),
+        (0, None) on timeout"""
+        size = self._esp.socket_receive_into(buffer, timeout)
+        if not size:
+            return 0, None
+        return size, self._esp.socket_remote()
+
+    def recvfrom(self, timeout: int = 5) -> Tuple[bytes, Union[Tuple[str, int], None]]:
+        """The next datagram as (data, (ip, port)), (b"", None) on timeout"""
+        esp = self._esp
+        size, address = self.recvfrom_into(esp._ipdpacket, timeout)
+        return bytes(esp._ipdpacket[:size]), address
+
+    def close(self) -> None:
+        """Close the socket"""
+        self._esp.socket_disconnect()
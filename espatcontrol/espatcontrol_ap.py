@@ -0,0 +1,74 @@
+"""
+`espatcontrol.espatcontrol_ap`
+====================================================
+
+Compact access point records parsed from AT+CWLAP replies. Shared by the
+MicroPython driver and the host side asyncio wrapper.
+"""
+
+from binascii import hexlify, unhexlify
+
+try:
+    from typing import Optional, Union
+except ImportError:
+    pass
+
+# AT+CWLAPOPT <print mask> bits
+CWLAP_ECN = 1 << 0
+CWLAP_SSID = 1 << 1
+CWLAP_RSSI = 1 << 2
+CWLAP_MAC = 1 << 3
+CWLAP_CHANNEL = 1 << 4
+CWLAP_ALL = 0x7FF  # firmware default, every field
+
+# Just the fields AccessPoint keeps
+CWLAP_COMPACT = CWLAP_SSID | CWLAP_RSSI | CWLAP_MAC | CWLAP_CHANNEL
+
+
+class AccessPoint:
+    """One scanned access point. The BSSID is kept as 6 raw bytes rather
+    than a 17 character string so a dense scan stays small"""
+
+    __slots__ = ("ssid", "rssi", "channel", "bssid")
+
+    def __init__(self, ssid: str, rssi: int, channel: int, bssid: bytes):
+        self.ssid = ssid
+        self.rssi = rssi
+        self.channel = channel
+        self.bssid = bssid
+
+    @property
+    def mac(self) -> str:
+        """The BSSID as a colon separated hex string, as AT+CWJAP expects it"""
+        return str(hexlify(self.bssid, ":"), "utf-8")
+
+    def __repr__(self) -> str:
+        return "AccessPoint(%r, %d, %d, %r)" % (
+            self.ssid,
+            self.rssi,
+            self.channel,
+            self.mac,
+        )
+
+    @classmethod
+    def from_cwlap(cls, line: Union[bytes, bytearray]) -> Optional["AccessPoint"]:
+        """Parse a single '+CWLAP:(...)' line. Works with both the compact
+        CWLAP_COMPACT print mask and the firmware's full default layout, and
+        copes with commas inside the SSID. Returns None for anything else"""
+        line = bytes(line).strip(b"\r\n")
+        if not line.startswith(b"+CWLAP:(") or not line.endswith(b")"):
+            return None
+        body = line[8:-1]
+        # The BSSID is the last quoted field, everything after it is numeric
+        end = body.rfind(b'"')
+        start = body.rfind(b'"', 0, end)
+        if start < 1 or end - start != 18:
+            return None
+        try:
+            bssid = unhexlify(body[start + 1 : end].replace(b":", b""))
+            head, rssi = body[: start - 1].rsplit(b",", 1)
+            channel = body[end + 2 :].split(b",", 1)[0]
+            ssid = head[head.find(b'"') + 1 : head.rfind(b'"')]
+            return cls(str(ssid, "utf-8"), int(rssi), int(channel), bssid)
+        except ValueError:
+            return None
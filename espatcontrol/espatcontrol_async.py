@@ -0,0 +1,846 @@
+"""
+`espatcontrol.espatcontrol_async`
+====================================================
+
+uasyncio flavour of ESP_ATcontrol. Same method names, but every call that
+talks to the module is a coroutine, so sensor loops, LEDs and network I/O
+keep running while a command is in flight.
+
+One background task owns the UART: it splits what arrives into reply lines,
++IPD socket payloads, the '>' send prompt and unsolicited link messages.
+Commands are serialised with a lock, so several tasks can share one module.
+Properties that need a round trip return a coroutine, e.g.
+'await esp.status' or 'await esp.local_ip'.
+
+On MicroPython pass the machine.UART, on CPython pass an asyncio
+StreamReader/StreamWriter pair instead.
+
+start_server() turns the module into a small TCP server (AT+CIPMUX=1 and
+AT+CIPSERVER): every client that connects gets its own task running the
+handler coroutine you give it, e.g. for a local status page:
+
+    async def status_page(conn):
+        await conn.readuntil(b"\r\n\r\n")
+        await conn.write(b"HTTP/1.0 200 OK\r\n\r\nup")
+
+    server = await esp.start_server(status_page, 80, max_clients=3)
+"""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from espatcontrol.espatcontrol import (
+    ESP_ATcontrol,
+    OKError,
+    _pin_write,
+    _CIPDOMAIN,
+    _CIPSTART,
+    _CWJAP,
+    _CWMODE,
+    _PING,
+)
+from espatcontrol.espatcontrol_cmd import CommandEncoder, Template
+from espatcontrol.espatcontrol_ap import AccessPoint, CWLAP_COMPACT
+
+try:
+    from typing import Optional, Dict, Union, List
+except ImportError:
+    pass
+
+
+class AsyncESP_ATcontrol:
+    """A non-blocking wrapper for AT commands to a connected ESP8266 or
+    ESP32 module, see ESP_ATcontrol for what each command does"""
+
+    # pylint: disable=too-many-public-methods, too-many-instance-attributes
+    MODE_STATION = ESP_ATcontrol.MODE_STATION
+    MODE_SOFTAP = ESP_ATcontrol.MODE_SOFTAP
+    MODE_SOFTAPSTATION = ESP_ATcontrol.MODE_SOFTAPSTATION
+    TYPE_TCP = ESP_ATcontrol.TYPE_TCP
+    TYPE_UDP = ESP_ATcontrol.TYPE_UDP
+    TYPE_SSL = ESP_ATcontrol.TYPE_SSL
+    STATUS_APCONNECTED = ESP_ATcontrol.STATUS_APCONNECTED
+    STATUS_SOCKETOPEN = ESP_ATcontrol.STATUS_SOCKETOPEN
+    STATUS_SOCKETCLOSED = ESP_ATcontrol.STATUS_SOCKETCLOSED
+    STATUS_NOTCONNECTED = ESP_ATcontrol.STATUS_NOTCONNECTED
+    URC_LINES = ESP_ATcontrol.URC_LINES
+    REPLY_OK = ESP_ATcontrol.REPLY_OK
+    REPLY_ERROR = ESP_ATcontrol.REPLY_ERROR
+    REPLY_BUSY = ESP_ATcontrol.REPLY_BUSY
+    REPLY_TIMEOUT = ESP_ATcontrol.REPLY_TIMEOUT
+    REPLY_BUSY_SENDING = ESP_ATcontrol.REPLY_BUSY_SENDING
+
+    # Lines that end a command reply, besides a busy line
+    _TERMINATORS = (b"OK\r\n", b"ERROR\r\n", b"FAIL\r\n", b"SEND FAIL\r\n")
+
+    def __init__(
+        self,
+        uart=None,
+        *,
+        reader=None,
+        writer=None,
+        reset_pin=None,
+        debug: bool = False,
+        use_cipstatus: bool = False,
+    ):
+        if uart is not None:
+            reader = asyncio.StreamReader(uart)
+            writer = asyncio.StreamWriter(uart, {})
+        self._reader = reader
+        self._writer = writer
+        self._reset_pin = reset_pin
+        self._debug = debug
+        self._use_cipstatus = use_cipstatus
+        self._lock = asyncio.Lock()
+        self._encoder = CommandEncoder()
+        self._rx = b""
+        self._read_task = None
+        self._reply = None  # lines of the reply in progress
+        self._reply_event = asyncio.Event()
+        self._reply_done = False
+        self._prompt = asyncio.Event()
+        self._want_prompt = False
+        self._ipd = []
+        self._ipd_event = asyncio.Event()
+        self._urc_events = []
+        self._urc_handlers = []
+        self._version = None
+        self._initialized = False
+        self._conntype = None
+        self._socket_args = None
+        self._mux = False  # AT+CIPMUX=1, +IPD and CIPSEND carry a link id
+        self._server = None
+        self.last_reply = self.REPLY_OK  # how the last at_response() ended
+        self.busy_retries = 5
+
+    # *************************** UART READER ****************************
+
+    def _start(self) -> None:
+        if self._read_task is None:
+            self._read_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        """Owns the reader, hands everything that arrives to the right place"""
+        while True:
+            while self._dispatch():
+                pass
+            data = await self._reader.read(512)
+            if not data:
+                return
+            self._rx += data
+
+    def _dispatch(self) -> bool:
+        """Consume one complete item from the receive buffer, if there is one"""
+        rx = self._rx
+        if rx.startswith(b"+IPD,"):
+            colon = rx.find(b":")
+            if colon < 0:
+                return False
+            fields = rx[5:colon].split(b",")
+            length = int(fields[1] if self._mux else fields[0])
+            end = colon + 1 + length
+            if len(rx) < end:
+                return False
+            self._rx = rx[end:]
+            if self._server is not None:
+                self._server._data(int(fields[0]), rx[colon + 1 : end])
+                return True
+            self._ipd.append(rx[colon + 1 : end])
+            self._ipd_event.set()
+            return True
+        newline = rx.find(b"\n")
+        if newline >= 0:
+            self._rx = rx[newline + 1 :]
+            self._on_line(rx[: newline + 1])
+            return True
+        if self._want_prompt and rx.startswith(b">"):
+            self._rx = rx[1:]
+            self._want_prompt = False
+            self._prompt.set()
+            return True
+        return False
+
+    def _on_line(self, line: bytes) -> None:
+        stripped = line.rstrip(b"\r\n")
+        if self._server is not None and stripped and 48 <= stripped[0] <= 57:
+            # '<link id>,CONNECT' and '<link id>,CLOSED' from the server
+            link_id, _, event = stripped.partition(b",")
+            if event == b"CONNECT":
+                self._server._connected(int(link_id))
+                return
+            if event == b"CLOSED":
+                self._server._closed(int(link_id))
+                return
+        if stripped in self.URC_LINES:
+            if len(self._urc_events) > 8:
+                self._urc_events.pop(0)
+            self._urc_events.append(stripped)
+            if stripped == b"CLOSED":
+                self._ipd_event.set()  # wake socket_receive()
+            for handler in self._urc_handlers:
+                handler(stripped)
+        if self._reply is not None and not self._reply_done:
+            self._reply.append(line)
+            if line in self._TERMINATORS or line.endswith(b"OK\r\n") or line.startswith(b"busy "):
+                self._reply_done = True
+            self._reply_event.set()
+        elif self._debug and stripped:
+            print("<-- (unsolicited)", stripped)
+
+    def add_urc_handler(self, handler) -> None:
+        """handler(line) is called from the reader task for WIFI DISCONNECT,
+        CLOSED, etc. Keep it short, it must not await"""
+        self._urc_handlers.append(handler)
+
+    def poll_urc(self) -> List[bytes]:
+        """Unsolicited link messages seen since the last call, oldest first"""
+        events = self._urc_events
+        self._urc_events = []
+        return events
+
+    # *************************** COMMANDS ****************************
+
+    async def _send(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _command(self, at_cmd: str, timeout: float, rendered=None, send: bool = True) -> bytes:
+        """Send one command (already 'rendered' by the encoder, or plain
+        text) and collect its reply, caller holds the lock. With send False
+        just collect the next reply"""
+        self._start()
+        self._reply = []
+        self._reply_done = False
+        self._reply_event.clear()
+        if send:
+            if self._debug:
+                print("--->", at_cmd)
+            if rendered is None:
+                rendered = self._encoder.render_text(at_cmd)
+            await self._send(rendered)
+        try:
+            await asyncio.wait_for(self._wait_reply(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        response = b"".join(self._reply)
+        self._reply = None
+        if self._debug:
+            print("<---", response)
+        return response
+
+    async def _wait_reply(self, line_event=None) -> None:
+        while not self._reply_done:
+            await self._reply_event.wait()
+            self._reply_event.clear()
+            if line_event is not None:
+                line_event.set()
+
+    async def at_response(self, at_cmd: str, timeout: int = 5, retries: int = 3) -> bytes:
+        """Send an AT command and return the reply, without blocking other
+        tasks. Busy replies and lost ones are retried as
+        ESP_ATcontrol.at_response describes; a reply that still has no OK is
+        returned as it is, last_reply says how it ended"""
+        async with self._lock:
+            return await self._transact(at_cmd, timeout, retries)
+
+    async def at_command(
+        self, template: Template, *args: Union[str, int], timeout: int = 5, retries: int = 3
+    ) -> bytes:
+        """at_response() for a precompiled Template, arguments escaped as
+        the template says, see ESP_ATcontrol.at_command"""
+        async with self._lock:
+            return await self._transact(template.fmt, timeout, retries, template, args)
+
+    async def _transact(
+        self, at_cmd: str, timeout: float, retries: int, template: Optional[Template] = None, args=()
+    ) -> bytes:
+        """Send a command and retry it, caller holds the lock"""
+        idempotent = not at_cmd.startswith(ESP_ATcontrol.NON_IDEMPOTENT)
+        attempts = 0
+        busy = 0
+        pause = 0.05
+        while True:
+            # rendered again each time, the encoder's buffer is shared
+            rendered = None if template is None else self._encoder.render(template, *args)
+            reply = await self._command(at_cmd, timeout, rendered)
+            result = ESP_ATcontrol._classify(reply)  # pylint: disable=protected-access
+            self.last_reply = result
+            if result == self.REPLY_OK:
+                return reply
+            if result in (self.REPLY_BUSY, self.REPLY_BUSY_SENDING):
+                busy += 1
+                if busy > self.busy_retries:
+                    return reply
+                if result == self.REPLY_BUSY_SENDING:
+                    # wait for the SEND OK or SEND FAIL, then straight back in
+                    await self._command(at_cmd, timeout, send=False)
+                    continue
+            else:
+                attempts += 1
+                if result == self.REPLY_ERROR or not idempotent or attempts >= retries:
+                    return reply
+            if self._debug:
+                print("at_response(): %r %s, retrying" % (at_cmd, ("busy", "timed out")[result - 2]))
+            await asyncio.sleep(pause)
+            pause = min(pause * 2, 1)
+
+    async def begin(self) -> None:
+        """Sync with the module and cache its version, see ESP_ATcontrol.begin"""
+        self._start()
+        for _ in range(3):
+            try:
+                await self.echo(False)
+                version = await self.get_version()
+                print(f"VERSION {version}")
+                reply = await self.at_response("AT+CWSTATE?", retries=1, timeout=3)
+                if reply[-4:] != b"OK\r\n":
+                    self._use_cipstatus = True
+                self._initialized = True
+                return
+            except OKError:
+                pass  # retry
+
+    async def connect(
+        self, secrets: Dict[str, Union[str, int]], timeout: int = 15, retries: int = 3
+    ) -> None:
+        """Join the access point in 'secrets' unless we're already on it"""
+        if not self._initialized:
+            await self.begin()
+        AP = await self.remote_AP  # pylint: disable=invalid-name
+        if AP[0] != secrets["ssid"]:
+            await self.join_AP(
+                secrets["ssid"], secrets["password"], timeout=timeout, retries=retries
+            )
+            print("Connected to", secrets["ssid"])
+            if "timezone" in secrets:
+                await self.sntp_config(
+                    True, secrets["timezone"], secrets.get("ntp_server")
+                )
+        else:
+            print("Already connected to", AP[0])
+
+    async def hard_reset(self) -> None:
+        """Pulse the reset pin, or send AT+RST if there isn't one"""
+        async with self._lock:
+            if self._reset_pin:
+                _pin_write(self._reset_pin, False)
+                await asyncio.sleep(0.1)
+                _pin_write(self._reset_pin, True)
+            else:
+                await self._send(b"AT+RST\r\n")
+            await asyncio.sleep(3)
+            self._rx = b""
+            self._ipd = []
+            self._initialized = False
+            self._conntype = None
+            self._socket_args = None
+
+    async def echo(self, echo: bool) -> None:
+        """Set AT command echo on or off"""
+        await self.at_response("ATE1" if echo else "ATE0", timeout=1)
+
+    @property
+    def version(self) -> Union[str, None]:
+        """The cached version string retrieved via the AT+GMR command"""
+        return self._version
+
+    async def get_version(self) -> Union[str, None]:
+        """Request and cache the AT firmware version string"""
+        reply = await self.at_response("AT+GMR", timeout=3)
+        self._version = None
+        for line in reply.split(b"\r\n"):
+            if b"AT version:" in line:
+                self._version = str(line, "utf-8")
+        return self._version
+
+    @property
+    def conntype(self) -> Union[str, None]:
+        """The configured connection-type"""
+        return self._conntype
+
+    @conntype.setter
+    def conntype(self, conntype: str) -> None:
+        self._conntype = conntype
+
+    @property
+    def mode(self):
+        """Coroutine, MODE_STATION, MODE_SOFTAP or MODE_SOFTAPSTATION"""
+        return self._get_mode()
+
+    async def _get_mode(self) -> int:
+        for reply in (await self.at_response("AT+CWMODE?")).split(b"\r\n"):
+            if reply.startswith(b"+CWMODE:"):
+                return int(reply[8:])
+        raise RuntimeError("Bad response to CWMODE?")
+
+    async def set_mode(self, mode: int) -> None:
+        """Station or AP mode selection, the awaitable form of 'mode = ...'"""
+        if not mode in (1, 2, 3):
+            raise RuntimeError("Invalid Mode")
+        await self.at_command(_CWMODE, mode, timeout=3)
+
+    @property
+    def local_ip(self):
+        """Coroutine, our local IP address as a dotted-quad string"""
+        return self._get_local_ip()
+
+    async def _get_local_ip(self) -> str:
+        for line in (await self.at_response("AT+CIFSR")).split(b"\r\n"):
+            if line.startswith(b'+CIFSR:STAIP,"'):
+                return str(line[14:-1], "utf-8")
+        raise RuntimeError("Couldn't find IP address")
+
+    async def ping(self, host: str) -> Union[int, None]:
+        """Ping the IP or hostname given, returns ms time or None on failure"""
+        reply = await self.at_command(_PING, host.strip('"'), timeout=5)
+        for line in reply.split(b"\r\n"):
+            if line.startswith(b"+"):
+                try:
+                    if line[1:5] == b"PING":
+                        return int(line[6:])
+                    return int(line[1:])
+                except ValueError:
+                    return None
+        raise RuntimeError("Couldn't ping")
+
+    async def nslookup(self, host: str) -> Union[str, None]:
+        """Return a dotted-quad IP address strings that matches the hostname"""
+        reply = await self.at_command(_CIPDOMAIN, host.strip('"'), timeout=3)
+        for line in reply.split(b"\r\n"):
+            if line.startswith(b"+CIPDOMAIN:"):
+                return str(line[11:], "utf-8").strip('"')
+        raise RuntimeError("Couldn't find IP address")
+
+    # *************************** SNTP SETUP ****************************
+
+    async def sntp_config(
+        self, enable: bool, timezone: Optional[int] = None, server: Optional[str] = None
+    ) -> None:
+        """Configure the built in ESP SNTP client"""
+        cmd = "AT+CIPSNTPCFG=%d" % (1 if enable else 0)
+        if timezone is not None:
+            cmd += ",%d" % timezone
+        if server is not None:
+            cmd += ',"%s"' % server
+        await self.at_response(cmd, timeout=3)
+
+    @property
+    def sntp_time(self):
+        """Coroutine, the raw AT+CIPSNTPTIME? date string"""
+        return self._get_sntp_time()
+
+    async def _get_sntp_time(self) -> Union[bytes, None]:
+        for reply in (await self.at_response("AT+CIPSNTPTIME?")).split(b"\r\n"):
+            if reply.startswith(b"+CIPSNTPTIME:"):
+                return reply[13:]
+        return None
+
+    # *************************** WIFI SETUP ****************************
+
+    def iter_APs(  # pylint: disable=invalid-name
+        self, rssi_min: Optional[int] = None, sort_rssi: bool = True, timeout: int = 10
+    ) -> "_APScan":
+        """Scan for access points, 'async for' over the result gets each
+        AccessPoint as its line arrives. Breaking out early is fine, the scan
+        still runs to completion in the background before the next command"""
+        return _APScan(self, rssi_min, sort_rssi, timeout)
+
+    async def _run_scan(self, scan: "_APScan") -> None:
+        try:
+            if await self.mode != self.MODE_STATION:
+                await self.set_mode(self.MODE_STATION)
+            cmd = "AT+CWLAPOPT=%d,%d" % (1 if scan.sort_rssi else 0, CWLAP_COMPACT)
+            if scan.rssi_min is not None:
+                cmd += ",%d" % scan.rssi_min
+            await self.at_response(cmd, timeout=3)
+            async with self._lock:
+                self._reply = scan.lines
+                self._reply_done = False
+                self._reply_event.clear()
+                await self._send(b"AT+CWLAP\r\n")
+                try:
+                    await asyncio.wait_for(self._wait_reply(scan.event), scan.timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._reply = None
+        finally:
+            scan.done = True
+            scan.event.set()
+
+    async def scan_APs(  # pylint: disable=invalid-name
+        self, rssi_min: Optional[int] = None
+    ) -> List[AccessPoint]:
+        """Every access point iter_APs() finds, as a list"""
+        routers = []
+        async for access_point in self.iter_APs(rssi_min):
+            routers.append(access_point)
+        return routers
+
+    @property
+    def remote_AP(self):  # pylint: disable=invalid-name
+        """Coroutine, [ssid, bssid, channel, rssi] of the AP we're on"""
+        return self._get_remote_AP()
+
+    async def _get_remote_AP(self) -> List[Union[int, str, None]]:  # pylint: disable=invalid-name
+        # an open or just closed socket is still on the access point
+        if await self.status not in (self.STATUS_APCONNECTED, self.STATUS_SOCKETOPEN, self.STATUS_SOCKETCLOSED):
+            return [None] * 4
+        for reply in (await self.at_response("AT+CWJAP?", timeout=10)).split(b"\r\n"):
+            if not reply.startswith(b"+CWJAP:"):
+                continue
+            reply = reply[7:].split(b",")
+            for i, val in enumerate(reply):
+                reply[i] = str(val, "utf-8")
+                try:
+                    reply[i] = int(reply[i])
+                except ValueError:
+                    reply[i] = reply[i].strip('"')  # its a string!
+            return reply
+        return [None] * 4
+
+    async def join_AP(  # pylint: disable=invalid-name
+        self, ssid: str, password: str, timeout: int = 15, retries: int = 3
+    ) -> None:
+        """Join an access point by name and password"""
+        if await self.mode != self.MODE_STATION:
+            await self.set_mode(self.MODE_STATION)
+        reply = await self.at_command(
+            _CWJAP, ssid, password, timeout=timeout, retries=retries
+        )
+        if b"WIFI CONNECTED" not in reply:
+            raise RuntimeError("Couldn't connect to WiFi")
+        if b"WIFI GOT IP" not in reply:
+            raise RuntimeError("Didn't get IP address")
+
+    @property
+    def is_connected(self):
+        """Coroutine, True if we're connected to an access point"""
+        return self._get_is_connected()
+
+    async def _get_is_connected(self) -> bool:
+        if not self._initialized:
+            await self.begin()
+        try:
+            return await self.status in (
+                self.STATUS_APCONNECTED,
+                self.STATUS_SOCKETOPEN,
+                self.STATUS_SOCKETCLOSED,
+            )
+        except (OKError, RuntimeError):
+            return False
+
+    @property
+    def status(self):
+        """Coroutine, a CIPSTATUS compatible connection status number"""
+        return self._get_status()
+
+    async def _get_status(self) -> Union[int, None]:
+        if self._use_cipstatus:
+            for reply in (await self.at_response("AT+CIPSTATUS")).split(b"\r\n"):
+                if reply.startswith(b"STATUS:"):
+                    return int(reply[7:8])
+            return None
+        status_w = None
+        for reply in (await self.at_response("AT+CWSTATE?")).split(b"\r\n"):
+            if reply.startswith(b"+CWSTATE:"):
+                status_w = int(reply[9:10])
+        socket_open = b"+CIPSTATE:" in await self.at_response("AT+CIPSTATE?")
+        # same mapping as ESP_ATcontrol.status
+        if status_w in (1, 4):
+            return self.STATUS_NOTCONNECTED
+        if socket_open:
+            return self.STATUS_SOCKETOPEN
+        if status_w == 2:
+            return self.STATUS_APCONNECTED
+        if status_w == 0:
+            return 1
+        if status_w == 3:
+            return self.STATUS_NOTCONNECTED
+        return self.STATUS_SOCKETCLOSED
+
+    # *************************** SOCKET SETUP ****************************
+
+    async def socket_connect(
+        self,
+        conntype: str,
+        remote: str,
+        remote_port: int,
+        *,
+        keepalive: int = 10,
+        retries: int = 1,
+    ) -> bool:
+        """Open a socket, conntype can be TYPE_TCP, TYPE_UDP, or TYPE_SSL"""
+        if not conntype:
+            conntype = self._conntype or (
+                self.TYPE_SSL if remote_port == 443 else self.TYPE_TCP
+            )
+        if not conntype in (self.TYPE_TCP, self.TYPE_UDP, self.TYPE_SSL):
+            raise RuntimeError("Connection type must be TCP, UDL or SSL")
+        if self._socket_args:
+            await self.socket_disconnect()
+        self._ipd = []
+        reply = await self.at_command(
+            _CIPSTART, conntype, remote, remote_port, timeout=10, retries=retries
+        )
+        if b"CONNECT" in reply or b"ALREADY CONNECTED" in reply:
+            self._conntype = conntype
+            self._socket_args = (conntype, remote, remote_port)
+            return True
+        return False
+
+    async def socket_send(
+        self, buffer: bytes, timeout: int = 1, *, link_id: Optional[int] = None
+    ) -> bool:
+        """Send data over the already-opened socket, buffer must be bytes.
+        In server mode 'link_id' says which client it is for"""
+        async with self._lock:
+            self._prompt.clear()
+            self._want_prompt = True
+            if link_id is None:
+                await self._command("AT+CIPSEND=%d" % len(buffer), 5)
+            else:
+                await self._command("AT+CIPSEND=%d,%d" % (link_id, len(buffer)), 5)
+            try:
+                await asyncio.wait_for(self._prompt.wait(), timeout)
+            except asyncio.TimeoutError as err:
+                raise RuntimeError("Didn't get data prompt for sending") from err
+            finally:
+                self._want_prompt = False
+            if self._conntype == self.TYPE_UDP:
+                await self._send(buffer)
+                return True
+            self._reply = []
+            self._reply_done = False
+            self._reply_event.clear()
+            await self._send(buffer)
+            try:
+                await asyncio.wait_for(self._wait_reply(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            response = b"".join(self._reply)
+            self._reply = None
+            return b"SEND OK" in response
+
+    async def socket_receive(self, timeout: int = 5) -> bytearray:
+        """Wait up to 'timeout' seconds for socket data and return whatever
+        has arrived, empty if nothing came or the socket closed"""
+        if not self._ipd:
+            self._ipd_event.clear()
+            try:
+                await asyncio.wait_for(self._ipd_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        ret = bytearray(b"".join(self._ipd))
+        self._ipd = []
+        return ret
+
+    async def socket_disconnect(self) -> None:
+        """Close any open socket, if there is one"""
+        self._conntype = None
+        self._socket_args = None
+        await self.at_response("AT+CIPCLOSE", retries=1)
+
+    # *************************** SERVER ****************************
+
+    async def start_server(
+        self, handler, port: int = 80, *, max_clients: int = 4, idle_timeout: int = 60
+    ) -> "TCPServer":
+        """Listen on 'port' and run the coroutine handler(connection) in a
+        task of its own for each client, see ServerConnection. Clients past
+        max_clients are turned away (the firmware takes at most 5 at once),
+        and the firmware drops a client idle for idle_timeout seconds
+        (AT+CIPSTO). Client sockets can't be used while the server runs"""
+        if self._server is not None:
+            raise RuntimeError("Server already running")
+        if self._socket_args:
+            await self.socket_disconnect()
+        self._server = TCPServer(self, handler, port, max_clients)
+        self._mux = True
+        for at_cmd in (
+            "AT+CIPMUX=1",
+            "AT+CIPSERVERMAXCONN=%d" % max_clients,
+            "AT+CIPSERVER=1,%d" % port,
+            "AT+CIPSTO=%d" % idle_timeout,
+        ):
+            reply = await self.at_response(at_cmd)
+            if not reply.endswith(b"OK\r\n"):
+                await self.stop_server()
+                raise RuntimeError("Couldn't start server", at_cmd)
+        return self._server
+
+    async def stop_server(self) -> None:
+        """Close every client, stop listening and go back to one socket"""
+        server = self._server
+        if server is None:
+            return
+        for task in list(server._tasks.values()):
+            task.cancel()
+        await self.at_response("AT+CIPSERVER=0,1", retries=1)
+        await self.at_response("AT+CIPMUX=0", retries=1)
+        self._mux = False
+        self._server = None
+
+
+class ServerConnection:
+    """One client of a TCPServer, what the handler coroutine is given"""
+
+    def __init__(self, esp: AsyncESP_ATcontrol, link_id: int):
+        self.link_id = link_id
+        self.closed = False
+        self._esp = esp
+        self._data = []
+        self._event = asyncio.Event()
+
+    def _feed(self, data: bytes) -> None:
+        self._data.append(data)
+        self._event.set()
+
+    def _gone(self) -> None:
+        self.closed = True
+        self._event.set()
+
+    async def read(self, timeout: Optional[float] = None) -> bytes:
+        """Whatever the client has sent since the last read, waiting for
+        something if need be. b"" once the client has gone, or if nothing
+        came within 'timeout' seconds"""
+        while not self._data and not self.closed:
+            self._event.clear()
+            if timeout is None:
+                await self._event.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return b""
+        data = b"".join(self._data)
+        self._data = []
+        return data
+
+    async def readuntil(
+        self, separator: bytes = b"\r\n", timeout: Optional[float] = None, limit: int = 2048
+    ) -> bytes:
+        """Read up to and including 'separator', anything after it is kept
+        for the next read. Returns what there is if the client goes first"""
+        data = b""
+        while True:
+            end = data.find(separator)
+            if end >= 0:
+                end += len(separator)
+                if end < len(data):
+                    self._data.insert(0, data[end:])
+                return data[:end]
+            if len(data) > limit:
+                raise RuntimeError("No separator within limit", separator)
+            more = await self.read(timeout)
+            if not more:
+                return data
+            data += more
+
+    async def write(self, data: bytes) -> bool:
+        """Send to the client, a CIPSEND per 2048 bytes"""
+        for start in range(0, len(data), 2048):
+            if self.closed:
+                return False
+            if not await self._esp.socket_send(data[start : start + 2048], 5, link_id=self.link_id):
+                return False
+        return True
+
+    async def close(self) -> None:
+        """Hang up on the client, if it hasn't already gone"""
+        if not self.closed:
+            self.closed = True
+            await self._esp.at_response("AT+CIPCLOSE=%d" % self.link_id, retries=1)
+
+
+class TCPServer:
+    """The clients of AsyncESP_ATcontrol.start_server() and the tasks
+    serving them, fed by the reader task"""
+
+    def __init__(self, esp: AsyncESP_ATcontrol, handler, port: int, max_clients: int):
+        self.port = port
+        self.max_clients = max_clients
+        self.connections = {}  # link id -> ServerConnection
+        self.accepted = 0
+        self.rejected = 0
+        self._esp = esp
+        self._handler = handler
+        self._tasks = {}
+
+    def _connected(self, link_id: int) -> None:
+        old = self.connections.get(link_id)
+        if old is not None and old.closed:
+            del self.connections[link_id]
+        if link_id in self.connections or len(self.connections) >= self.max_clients:
+            self.rejected += 1
+            asyncio.create_task(
+                self._esp.at_response("AT+CIPCLOSE=%d" % link_id, retries=1)
+            )
+            return
+        conn = ServerConnection(self._esp, link_id)
+        self.connections[link_id] = conn
+        self.accepted += 1
+        self._tasks[link_id] = asyncio.create_task(self._serve(conn))
+
+    def _data(self, link_id: int, data: bytes) -> None:
+        conn = self.connections.get(link_id)
+        if conn is not None:
+            conn._feed(data)
+
+    def _closed(self, link_id: int) -> None:
+        conn = self.connections.get(link_id)
+        if conn is not None:
+            conn._gone()
+
+    async def _serve(self, conn: ServerConnection) -> None:
+        try:
+            await self._handler(conn)
+        except Exception as err:  # pylint: disable=broad-except
+            print("Server: handler for link", conn.link_id, "failed:", err)
+        finally:
+            try:
+                await conn.close()
+            except (RuntimeError, OSError):
+                pass
+            if self.connections.get(conn.link_id) is conn:
+                del self.connections[conn.link_id]
+                del self._tasks[conn.link_id]
+
+    async def close(self) -> None:
+        """Same as AsyncESP_ATcontrol.stop_server()"""
+        await self._esp.stop_server()
+
+
+class _APScan:
+    """Async iterator over one AT+CWLAP run, see AsyncESP_ATcontrol.iter_APs"""
+
+    def __init__(self, esp, rssi_min, sort_rssi, timeout):
+        self.rssi_min = rssi_min
+        self.sort_rssi = sort_rssi
+        self.timeout = timeout
+        self.lines = []
+        self.event = asyncio.Event()
+        self.done = False
+        self._esp = esp
+        self._task = None
+        self._seen = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> AccessPoint:
+        if self._task is None:
+            self._task = asyncio.create_task(self._esp._run_scan(self))
+        while True:
+            while self._seen < len(self.lines):
+                access_point = AccessPoint.from_cwlap(self.lines[self._seen])
+                self._seen += 1
+                if access_point and (
+                    self.rssi_min is None or access_point.rssi >= self.rssi_min
+                ):
+                    return access_point
+            if self.done:
+                raise StopAsyncIteration
+            self.event.clear()
+            await self.event.wait()
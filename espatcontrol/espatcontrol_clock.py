@@ -0,0 +1,172 @@
+"""
+`espatcontrol.espatcontrol_clock`
+====================================================
+
+Wall clock time without a UART round trip per read. SNTPClock asks the
+module for AT+CIPSNTPTIME? once, then counts forward on the local tick
+counter. Calling poll() from the main loop resyncs every resync_interval
+seconds, and each resync also measures how far the local oscillator has
+drifted from SNTP so the time between syncs stays accurate.
+
+Until the module has a real answer from its SNTP server it reports 1970
+dates; those are rejected, so 'synced' stays False instead of the clock
+silently starting from the epoch.
+"""
+
+try:
+    from utime import ticks_ms, ticks_diff, ticks_add
+except ImportError:
+    from time import monotonic as _monotonic
+
+    def ticks_ms() -> int:
+        """Millisecond counter, as utime.ticks_ms"""
+        return int(_monotonic() * 1000)
+
+    def ticks_diff(new: int, old: int) -> int:
+        """Difference between two ticks_ms values, as utime.ticks_diff"""
+        return new - old
+
+    def ticks_add(ticks: int, delta: int) -> int:
+        """Offset a ticks_ms value, as utime.ticks_add"""
+        return ticks + delta
+
+
+from espatcontrol.espatcontrol import OKError
+
+try:
+    from typing import Optional, Union
+except ImportError:
+    pass
+
+_MONTHS = (b"Jan", b"Feb", b"Mar", b"Apr", b"May", b"Jun",
+           b"Jul", b"Aug", b"Sep", b"Oct", b"Nov", b"Dec")  # fmt: skip
+
+# Anything before this is the firmware's "not synced yet" answer
+_EARLIEST_VALID = 946684800  # 2000-01-01
+
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    """Days since 1970-01-01, proleptic Gregorian. Doesn't use time.mktime
+    as MicroPython's counts from 2000 and assumes local time"""
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def timezone_offset(timezone: int) -> int:
+    """Seconds east of UTC for an AT+CIPSNTPCFG timezone, which is either
+    whole hours (-12..14) or [+|-]hhmm, e.g. 530 for UTC+05:30"""
+    sign = -1 if timezone < 0 else 1
+    timezone = abs(timezone)
+    if timezone < 100:
+        return sign * timezone * 3600
+    return sign * ((timezone // 100) * 3600 + (timezone % 100) * 60)
+
+
+def parse_sntp_time(reply: Union[bytes, bytearray], timezone: int = 0) -> Optional[int]:
+    """Turn an AT+CIPSNTPTIME? date such as b'Thu Aug 04 14:48:05 2016',
+    which is local time for 'timezone', into UTC epoch seconds. Returns None
+    for the 1970 dates the module reports before it has synced"""
+    fields = bytes(reply).split()
+    if len(fields) != 5 or fields[1] not in _MONTHS:
+        return None
+    try:
+        hour, minute, second = (int(x) for x in fields[3].split(b":"))
+        days = _days_from_civil(int(fields[4]), _MONTHS.index(fields[1]) + 1, int(fields[2]))
+    except ValueError:
+        return None
+    epoch = days * 86400 + hour * 3600 + minute * 60 + second - timezone_offset(timezone)
+    if epoch < _EARLIEST_VALID:
+        return None
+    return epoch
+
+
+class SNTPClock:
+    """Epoch seconds from the local tick counter, disciplined by the ESP's
+    SNTP client"""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(
+        self,
+        esp,
+        *,
+        resync_interval: float = 3600,
+        retry_interval: float = 30,
+        max_drift: float = 0.001,
+        debug: bool = False,
+    ):
+        self._esp = esp
+        self._resync_ms = int(resync_interval * 1000)
+        self._retry_ms = int(retry_interval * 1000)
+        self._max_drift = max_drift
+        self._debug = debug
+        self._base_epoch = 0
+        self._base_ticks = 0
+        self._next_sync = None
+        self.synced = False
+        self.drift = 0.0  # local oscillator error, positive when it runs slow
+        self.syncs = 0
+        self.last_error = 0.0  # seconds local time was off at the last resync
+
+    def _elapsed(self, now: int) -> float:
+        return ticks_diff(now, self._base_ticks) / 1000
+
+    def sync(self) -> bool:
+        """Read the time from the module now. Returns True if it had a valid
+        SNTP time"""
+        reply = self._esp.sntp_time
+        now = ticks_ms()
+        epoch = parse_sntp_time(reply, self._esp.sntp_timezone) if reply else None
+        if epoch is None:
+            self._next_sync = ticks_add(now, self._retry_ms)
+            if self._debug:
+                print("SNTPClock: module not synced yet", reply)
+            return False
+        if self.synced:
+            elapsed = self._elapsed(now)
+            self.last_error = epoch - self._predict(elapsed)
+            # One second resolution from the module, so the estimate is only
+            # worth making over a long enough gap
+            if elapsed > 600:
+                drift = self.drift + self.last_error / elapsed
+                if -self._max_drift <= drift <= self._max_drift:
+                    self.drift = (self.drift + drift) / 2 if self.syncs > 1 else drift
+        self._base_epoch = epoch
+        self._base_ticks = now
+        self._next_sync = ticks_add(now, self._resync_ms)
+        self.synced = True
+        self.syncs += 1
+        if self._debug:
+            print("SNTPClock: synced", epoch, "error", self.last_error, "drift", self.drift)
+        return True
+
+    def poll(self) -> bool:
+        """Resync if one is due, call it from the main loop. Returns 'synced'"""
+        if self._next_sync is None or ticks_diff(ticks_ms(), self._next_sync) >= 0:
+            try:
+                self.sync()
+            except (RuntimeError, OSError, OKError) as err:
+                self._next_sync = ticks_add(ticks_ms(), self._retry_ms)
+                if self._debug:
+                    print("SNTPClock: resync failed", err)
+        return self.synced
+
+    def _predict(self, elapsed: float) -> float:
+        return self._base_epoch + elapsed * (1 + self.drift)
+
+    def time(self) -> Optional[float]:
+        """UTC epoch seconds, or None until the first good sync"""
+        if not self.synced:
+            return None
+        return self._predict(self._elapsed(ticks_ms()))
+
+    def localtime(self) -> Optional[float]:
+        """Epoch seconds shifted into the module's configured timezone"""
+        now = self.time()
+        if now is None:
+            return None
+        return now + timezone_offset(self._esp.sntp_timezone)
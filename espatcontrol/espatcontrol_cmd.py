@@ -0,0 +1,169 @@
+"""
+`espatcontrol.espatcontrol_cmd`
+====================================================
+
+AT command rendering without building strings. A Template is parsed once,
+then CommandEncoder renders it with its arguments straight into one
+reusable bytearray, CRLF included, so each command goes out in a single
+UART write and the only allocation is the view handed to write().
+
+Template placeholders:
+  %q  a string parameter, double quoted with '"', ',' and backslash
+      escaped, which is what the firmware expects for SSIDs, passwords,
+      topics and the like
+  %s  a string copied as is
+  %d  an integer
+"""
+
+try:
+    from typing import Union
+except ImportError:
+    pass
+
+_QUOTE = 34  # '"'
+_ESCAPED = (34, 44, 92)  # '"' ',' '\\'
+
+
+def command_verb(at_cmd: str) -> str:
+    """What a command is, without its arguments: 'AT+CWMODE?' and
+    'AT+CWMODE=1' are different verbs, 'AT+CWMODE=1' and 'AT+CWMODE=2' not"""
+    for i, char in enumerate(at_cmd):
+        if char in "=?":
+            return at_cmd[: i + 1]
+    return at_cmd
+
+
+def quote(text: str) -> str:
+    """A double quoted AT command parameter with the characters the firmware
+    treats specially escaped, for code that builds command strings"""
+    return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"').replace(",", "\\,")
+
+
+class Template:
+    """An AT command format, split up front into literal bytes and
+    placeholders (see the module docstring)"""
+
+    def __init__(self, fmt: str):
+        self.fmt = fmt
+        self.verb = command_verb(fmt)
+        parts = []
+        kinds = []
+        literal = ""
+        i = 0
+        while i < len(fmt):
+            char = fmt[i]
+            if char == "%" and i + 1 < len(fmt):
+                kind = fmt[i + 1]
+                if kind == "%":
+                    literal += "%"
+                elif kind in "qsd":
+                    parts.append(bytes(literal, "utf-8"))
+                    kinds.append(kind)
+                    literal = ""
+                else:
+                    raise ValueError("Unknown placeholder %" + kind)
+                i += 2
+                continue
+            literal += char
+            i += 1
+        parts.append(bytes(literal, "utf-8") + b"\r\n")
+        self.parts = tuple(parts)
+        self.kinds = "".join(kinds)
+
+    def __repr__(self) -> str:
+        return "Template(%r)" % self.fmt
+
+
+class CommandEncoder:
+    """Renders commands into one preallocated buffer. A render is only good
+    until the next one, which is fine for a driver that sends one command
+    at a time"""
+
+    def __init__(self, size: int = 256):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._len = 0
+
+    def _grow(self, need: int) -> None:
+        size = len(self._buf)
+        while size < need:
+            size *= 2
+        buf = bytearray(size)
+        buf[: self._len] = self._buf[: self._len]
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def _put_bytes(self, data: bytes) -> None:
+        end = self._len + len(data)
+        if end > len(self._buf):
+            self._grow(end)
+        self._buf[self._len : end] = data
+        self._len = end
+
+    def _put_byte(self, byte: int) -> None:
+        if self._len >= len(self._buf):
+            self._grow(self._len + 1)
+        self._buf[self._len] = byte
+        self._len += 1
+
+    def _put_text(self, text: str, escape: bool) -> None:
+        for char in text:
+            code = ord(char)
+            if code >= 128:
+                self._put_bytes(bytes(char, "utf-8"))
+                continue
+            if escape and code in _ESCAPED:
+                self._put_byte(92)
+            self._put_byte(code)
+
+    def _put_int(self, value: int) -> None:
+        value = int(value)  # a float timeout goes in as whole seconds, as %d would
+        if value < 0:
+            self._put_byte(45)  # '-'
+            value = -value
+        start = self._len
+        while True:
+            self._put_byte(48 + value % 10)
+            value //= 10
+            if not value:
+                break
+        # digits went in backwards, turn them round
+        end = self._len - 1
+        buf = self._buf
+        while start < end:
+            buf[start], buf[end] = buf[end], buf[start]
+            start += 1
+            end -= 1
+
+    def render(self, template: Template, *args: Union[str, int]) -> memoryview:
+        """The command with its arguments filled in and CRLF on the end"""
+        kinds = template.kinds
+        if len(args) != len(kinds):
+            raise ValueError("%r takes %d arguments" % (template, len(kinds)))
+        parts = template.parts
+        self._len = 0
+        for i, kind in enumerate(kinds):
+            self._put_bytes(parts[i])
+            arg = args[i]
+            if kind == "d":
+                self._put_int(arg)
+            elif kind == "q":
+                self._put_byte(_QUOTE)
+                self._put_text(arg, True)
+                self._put_byte(_QUOTE)
+            else:
+                self._put_text(arg, False)
+        self._put_bytes(parts[-1])
+        return self._view[: self._len]
+
+    def render_text(self, at_cmd: str) -> memoryview:
+        """An already formatted command, just CRLF added"""
+        self._len = 0
+        self._put_text(at_cmd, False)
+        self._put_bytes(b"\r\n")
+        return self._view[: self._len]
+
+    @property
+    def rendered(self) -> memoryview:
+        """The last command rendered"""
+        return self._view[: self._len]
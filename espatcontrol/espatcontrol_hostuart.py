@@ -0,0 +1,154 @@
+"""
+`espatcontrol.espatcontrol_hostuart`
+====================================================
+
+Runs ESP_ATcontrol on CPython, for example on a Linux gateway with the
+module on a USB serial adapter. HostUART wraps a pyserial port in the
+machine.UART calls the driver makes (any(), readinto(), write()) and adds
+wait(), which the driver uses while it waits for a reply: it blocks in
+select() until data arrives or the deadline passes, so an idle driver
+uses next to no CPU instead of polling any() in a loop. Reads take
+whatever the OS has buffered in one go, up to read_size bytes.
+
+    from espatcontrol import espatcontrol
+    from espatcontrol.espatcontrol_hostuart import HostUART
+
+    uart = HostUART("/dev/ttyUSB0", 115200)
+    esp = espatcontrol.ESP_ATcontrol(uart, 115200)
+
+A gateway with several modules can run each driver on its own thread,
+or serve them all from one with HostUART.select(). Without a fileno()
+(pyserial on Windows) wait() falls back to a blocking read on the port.
+"""
+
+import selectors
+
+import serial
+
+try:
+    from typing import List, Optional
+except ImportError:
+    pass
+
+
+class HostUART:
+    """A pyserial port that looks like a machine.UART to the driver"""
+
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 115200,
+        *,
+        rtscts: bool = False,
+        read_size: int = 4096,
+        serial_port: Optional[serial.Serial] = None,
+    ):
+        if serial_port is None:
+            serial_port = serial.Serial(port, baudrate, rtscts=rtscts)
+        self.serial = serial_port
+        self.serial.timeout = 0  # reads return what's there, wait() does the blocking
+        self._buf = bytearray(read_size)
+        self._view = memoryview(self._buf)
+        self._pos = 0
+        self._len = 0
+        self._selector = None
+        try:
+            fileno = self.serial.fileno()
+        except (AttributeError, OSError):
+            fileno = None
+        if fileno is not None:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(fileno, selectors.EVENT_READ)
+
+    def fileno(self) -> int:
+        return self.serial.fileno()
+
+    @property
+    def baudrate(self) -> int:
+        return self.serial.baudrate
+
+    @baudrate.setter
+    def baudrate(self, value: int) -> None:
+        self.serial.baudrate = value
+
+    def _fill(self) -> int:
+        """Top up the buffer with whatever the OS has, in one read"""
+        if self._pos < self._len:
+            return self._len - self._pos
+        data = self.serial.read(len(self._buf))
+        self._pos = 0
+        self._len = len(data)
+        if data:
+            self._buf[: self._len] = data
+        return self._len
+
+    def any(self) -> int:
+        """Bytes that can be read without blocking"""
+        return self._fill()
+
+    def readinto(self, buf, nbytes: Optional[int] = None) -> int:
+        """Copy up to nbytes of what has arrived into buf, never blocks"""
+        if nbytes is None:
+            nbytes = len(buf)
+        count = min(nbytes, self._fill())
+        if count:
+            buf[:count] = self._view[self._pos : self._pos + count]
+            self._pos += count
+        return count
+
+    def read(self, nbytes: Optional[int] = None) -> bytes:
+        """Up to nbytes of what has arrived, all of it if nbytes is None"""
+        if nbytes is None:
+            nbytes = len(self._buf)
+        count = min(nbytes, self._fill())
+        data = bytes(self._view[self._pos : self._pos + count])
+        self._pos += count
+        return data
+
+    def write(self, data) -> int:
+        return self.serial.write(data)
+
+    def wait(self, timeout: float) -> bool:
+        """Block until there is something to read or timeout seconds have
+        passed. Returns whether there is"""
+        if self._pos < self._len:
+            return True
+        if timeout <= 0:
+            return self._fill() > 0
+        if self._selector is not None:
+            if self._selector.select(timeout):
+                return self._fill() > 0
+            return False
+        # no fileno() to select on, let the port block instead
+        self.serial.timeout = timeout
+        try:
+            data = self.serial.read(1)
+        finally:
+            self.serial.timeout = 0
+        if data:
+            self._buf[0] = data[0]
+            self._pos = 0
+            self._len = 1
+        return bool(data)
+
+    @staticmethod
+    def select(uarts: List["HostUART"], timeout: Optional[float] = None) -> List["HostUART"]:
+        """The ones of 'uarts' with something to read, waiting up to timeout
+        seconds (forever for None) for at least one, so one thread can look
+        after many modules"""
+        ready = [uart for uart in uarts if uart._pos < uart._len]
+        if ready:
+            return ready
+        with selectors.DefaultSelector() as selector:
+            for uart in uarts:
+                selector.register(uart.fileno(), selectors.EVENT_READ, uart)
+            return [key.data for key, _ in selector.select(timeout) if key.data._fill()]
+
+    def deinit(self) -> None:
+        """Close the port, as machine.UART.deinit()"""
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        self.serial.close()
+
+    close = deinit
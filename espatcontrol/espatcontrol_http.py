@@ -0,0 +1,367 @@
+"""
+`espatcontrol.espatcontrol_http`
+====================================================
+
+A small HTTP/1.0 client over an ESP_ATcontrol socket that asks for
+compressed bodies. The UART is the bottleneck for anything fetched through
+socket_receive, and JSON compresses several times over, so request() sends
+'Accept-Encoding: gzip, deflate' and the response body is inflated as the
++IPD packets arrive: only one pool block of compressed data and one small
+output block are held at a time.
+
+inflate() is usable on its own, it turns any iterator of compressed chunks
+into plain ones with whatever the platform has: MicroPython's deflate
+module, the older zlib.DecompIO, or CPython's zlib.decompressobj.
+
+download() saves a body straight to a file in fixed size blocks, hashing
+it with SHA-256 as it goes. A dropped connection is picked up again with
+an HTTP Range request from the last block written, so a large firmware
+image never has to fit in RAM or start again from zero.
+"""
+
+import os
+import time
+
+try:
+    import deflate  # MicroPython 1.21 and later
+except ImportError:
+    deflate = None
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+try:
+    from binascii import hexlify
+except ImportError:
+    from ubinascii import hexlify
+
+try:
+    from typing import Dict, Iterator, Optional, Tuple, Union
+except ImportError:
+    pass
+
+
+class _ChunkStream:
+    """A readable stream over an iterator of chunks, so the MicroPython
+    decompressors can pull compressed data as they need it"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b""
+        self._pos = 0
+
+    def readinto(self, buf) -> int:
+        while self._pos >= len(self._chunk):
+            try:
+                self._chunk = next(self._chunks)
+            except StopIteration:
+                return 0
+            self._pos = 0
+        count = min(len(buf), len(self._chunk) - self._pos)
+        buf[:count] = self._chunk[self._pos : self._pos + count]
+        self._pos += count
+        return count
+
+    def read(self, size: int) -> bytes:
+        buf = bytearray(size)
+        return bytes(buf[: self.readinto(buf)])
+
+
+def inflate(
+    chunks, encoding: str, *, block_size: int = 512, wbits: int = 0
+) -> Iterator[Union[bytes, memoryview]]:
+    """Decompress a 'gzip' or 'deflate' (zlib wrapped, as HTTP means it)
+    stream given as an iterator of chunks. Yields plain data no bigger than
+    block_size at a time; views into one reused block on MicroPython. wbits
+    is the window size (9..15), 0 takes it from the stream header where the
+    decompressor can; the window is the bulk of the memory used, so a smaller
+    one is worth it when the server is known to compress with one"""
+    gzip = encoding == "gzip"
+    if deflate is not None:
+        stream = deflate.DeflateIO(
+            _ChunkStream(chunks), deflate.GZIP if gzip else deflate.ZLIB, wbits
+        )
+    elif zlib is not None and hasattr(zlib, "decompressobj"):
+        decomp = zlib.decompressobj((wbits or 15) + (16 if gzip else 0))
+        for chunk in chunks:
+            data = decomp.decompress(chunk, block_size)
+            while data:
+                yield data
+                data = decomp.decompress(decomp.unconsumed_tail, block_size)
+        data = decomp.flush()
+        if data:
+            yield data
+        return
+    elif zlib is not None:
+        stream = zlib.DecompIO(_ChunkStream(chunks), (wbits or 15) + (16 if gzip else 0))
+    else:
+        raise RuntimeError("No zlib or deflate module to decompress with")
+    block = memoryview(bytearray(block_size))
+    while True:
+        count = stream.readinto(block)
+        if not count:
+            return
+        yield block[:count]
+
+
+class HTTPResponse:
+    """The reply to request(). status and headers are ready straight away,
+    the body is read as you iterate over iter_content()"""
+
+    def __init__(self, esp, timeout: float):
+        self._esp = esp
+        self._timeout = timeout
+        self._block = esp.buffers.acquire()
+        self._body_start = 0
+        self._body_end = 0
+        self.status = None
+        self.reason = ""
+        self.headers = {}
+        self._read_headers()
+
+    def _read_headers(self) -> None:
+        head = bytearray()
+        try:
+            while True:
+                size = self._esp.socket_receive_into(self._block, self._timeout)
+                if not size:
+                    raise RuntimeError("No HTTP response")
+                head.extend(self._block[:size])
+                end = head.find(b"\r\n\r\n")
+                if end >= 0:
+                    break
+                if len(head) > 4 * self._esp.buffers.block_size:
+                    raise RuntimeError("HTTP headers too long")
+            # the start of the body is still sitting at the end of the block
+            self._body_start = size - (len(head) - end - 4)
+            self._body_end = size
+            lines = str(head[:end], "utf-8").split("\r\n")
+            status = lines[0].split(" ", 2)
+            if len(status) < 2:
+                raise ValueError("Bad HTTP status line", lines[0])
+            self.status = int(status[1])
+            self.reason = status[2] if len(status) > 2 else ""
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+        except Exception:  # pylint: disable=broad-except
+            # no response object for the caller to close, so give it all back here
+            self.close()
+            raise
+
+    def _iter_raw(self) -> Iterator[memoryview]:
+        """The body as it came off the wire, stopping as soon as
+        Content-Length bytes are in rather than waiting for the close"""
+        # finally, so an abandoned or failed read still hands the block back
+        try:
+            remaining = self.headers.get("content-length")
+            remaining = int(remaining) if remaining is not None else -1
+            start, end = self._body_start, self._body_end
+            while self._block is not None:
+                if remaining >= 0:
+                    end = min(end, start + remaining)
+                    remaining -= end - start
+                if end > start:
+                    yield self._block[start:end]
+                if not remaining:
+                    break
+                start = 0
+                end = self._esp.socket_receive_into(self._block, self._timeout)
+                if not end:
+                    break  # closed by the server, that's the end of an HTTP/1.0 body
+        finally:
+            self.close()
+
+    def iter_content(self, block_size: int = 512) -> Iterator[Union[bytes, memoryview]]:
+        """The body in chunks, decompressed if the server compressed it. Each
+        chunk may be a view that's only good until the next one"""
+        encoding = self.headers.get("content-encoding", "identity")
+        if encoding in ("gzip", "deflate"):
+            return self._iter_inflated(encoding, block_size)
+        return self._iter_raw()
+
+    def _iter_inflated(self, encoding: str, block_size: int) -> Iterator[Union[bytes, memoryview]]:
+        try:
+            for chunk in inflate(self._iter_raw(), encoding, block_size=block_size):
+                yield chunk
+        finally:
+            self.close()  # a bad stream or an abandoned read
+
+    def read(self) -> bytes:
+        """The whole body at once"""
+        body = bytearray()
+        for chunk in self.iter_content():
+            body.extend(chunk)
+        return bytes(body)
+
+    @property
+    def text(self) -> str:
+        """The whole body, decoded as UTF-8"""
+        return str(self.read(), "utf-8")
+
+    def close(self) -> None:
+        """Give the buffer back and drop the socket, safe to call twice"""
+        if self._block is not None:
+            self._esp.buffers.release(self._block)
+            self._block = None
+            self._esp.socket_disconnect()
+
+
+def request(
+    esp,
+    method: str,
+    url: str,
+    *,
+    data: Optional[bytes] = None,
+    headers: Optional[Dict[str, str]] = None,
+    compressed: bool = True,
+    timeout: float = 5,
+) -> HTTPResponse:
+    """Send an HTTP/1.0 request over a fresh socket, asking for a
+    compressed body unless 'compressed' is False. HTTP/1.0 keeps the
+    server from using chunked transfer encoding"""
+    scheme, _, rest = url.partition("://")
+    host, slash, path = rest.partition("/")
+    path = slash + path or "/"
+    conntype = esp.TYPE_SSL if scheme == "https" else esp.TYPE_TCP
+    port = 443 if conntype == esp.TYPE_SSL else 80
+    if ":" in host:
+        host, port = host.split(":")
+        port = int(port)
+    lines = [
+        "%s %s HTTP/1.0" % (method, path),
+        "Host: %s" % host,
+        "User-Agent: %s" % esp.USER_AGENT,
+    ]
+    if compressed:
+        lines.append("Accept-Encoding: gzip, deflate")
+    if data is not None:
+        lines.append("Content-Length: %d" % len(data))
+    for name, value in (headers or {}).items():
+        lines.append("%s: %s" % (name, value))
+    if not esp.socket_connect(conntype, host, port, retries=3):
+        raise RuntimeError("Couldn't connect to " + host)
+    payload = bytes("\r\n".join(lines) + "\r\n\r\n", "utf-8")
+    esp.socket_send(payload + data if data is not None else payload)
+    return HTTPResponse(esp, timeout)
+
+
+def _content_range(value: str) -> Tuple[int, Optional[int]]:
+    """(first byte, total size or None) from 'bytes 100-999/1000'"""
+    span, _, total = value.partition(" ")[2].partition("/")
+    return int(span.partition("-")[0]), None if total in ("", "*") else int(total)
+
+
+def download(  # pylint: disable=too-many-branches, too-many-statements
+    esp,
+    url: str,
+    path: str,
+    *,
+    sha256: Optional[str] = None,
+    resume: bool = False,
+    retries: int = 5,
+    block_size: int = 4096,
+    headers: Optional[Dict[str, str]] = None,
+    timeout: float = 5,
+) -> str:
+    """Save the body of 'url' to the file 'path' and return its SHA-256 as
+    hex. The body goes to the file a block_size block at a time and into
+    the hash as each block is written, so that's all the RAM it needs. If
+    the connection drops the download carries on with a Range request from
+    the last block written; 'retries' is how many attempts in a row may
+    fail to move it forward. With 'resume' a partial file left by an
+    earlier run is hashed and continued rather than started again. Raises
+    RuntimeError if the result doesn't match an expected 'sha256'"""
+    offset = 0
+    if resume:
+        try:
+            offset = os.stat(path)[6]
+        except OSError:
+            pass
+    digest = hashlib.sha256()
+    block = bytearray(block_size)
+    view = memoryview(block)
+    if offset:
+        with open(path, "rb") as file:  # the hash has to catch up with the file
+            while True:
+                count = file.readinto(block)
+                if not count:
+                    break
+                digest.update(view[:count])
+    file = open(path, "ab" if offset else "wb")  # pylint: disable=consider-using-with
+    total = None
+    failures = 0
+    try:
+        while total is None or offset < total:
+            fields = dict(headers or {})
+            if offset:
+                fields["Range"] = "bytes=%d-" % offset
+            start = offset
+            try:
+                response = request(esp, "GET", url, headers=fields, compressed=False, timeout=timeout)
+            except (RuntimeError, OSError, ValueError) as err:
+                response = None
+                error = err
+            if response is not None:
+                try:
+                    if response.status == 206:
+                        first, total = _content_range(response.headers.get("content-range", ""))
+                        if first != offset:
+                            raise RuntimeError("Server resumed from the wrong place", first)
+                    elif response.status == 200:
+                        if offset:
+                            # no Range support, it's the whole thing again
+                            file.close()
+                            file = open(path, "wb")  # pylint: disable=consider-using-with
+                            digest = hashlib.sha256()
+                            offset = start = 0
+                        length = response.headers.get("content-length")
+                        total = int(length) if length is not None else None
+                    elif response.status == 416 and total is None:
+                        break  # nothing past the end, the file was already complete
+                    else:
+                        raise RuntimeError("HTTP error", response.status)
+                    fill = 0
+                    for chunk in response.iter_content():
+                        size = len(chunk)
+                        taken = 0
+                        while taken < size:
+                            count = min(size - taken, block_size - fill)
+                            view[fill : fill + count] = chunk[taken : taken + count]
+                            fill += count
+                            taken += count
+                            if fill == block_size:
+                                file.write(block)
+                                digest.update(block)
+                                offset += fill
+                                fill = 0
+                    if fill:
+                        file.write(view[:fill])
+                        digest.update(view[:fill])
+                        offset += fill
+                    file.flush()
+                    if total is None:
+                        break  # no length given, the close was the end
+                    error = RuntimeError("Connection dropped at %d of %d" % (offset, total))
+                except (RuntimeError, OSError, ValueError) as err:
+                    error = err
+                finally:
+                    response.close()
+            if offset > start:
+                failures = 0
+            elif total is None or offset < total:
+                failures += 1
+                if failures > retries:
+                    raise RuntimeError("Download failed", error)
+                time.sleep(min(2**failures, 30))
+    finally:
+        file.close()
+    result = str(hexlify(digest.digest()), "ascii")
+    if sha256 is not None and result != sha256.lower():
+        raise RuntimeError("SHA-256 mismatch", result)
+    return result
@@ -0,0 +1,485 @@
+"""
+`espatcontrol.espatcontrol_mqtt`
+====================================================
+
+An MQTT 3.1.1 client that speaks the protocol itself over an ESP_ATcontrol
+TCP or SSL socket, rather than through the firmware's AT+MQTT commands.
+Every AT+MQTTPUB is a round trip to the firmware's MQTT stack with the
+payload squeezed into a quoted command argument. Here publish() only
+appends the PUBLISH packet to a batch buffer and flush() sends the whole
+batch with one AT+CIPSEND, so a burst of readings costs one round trip.
+
+QoS 1 messages are pipelined: up to max_inflight of them can be waiting for
+their PUBACK at once, each tracked by packet id and resent with the DUP flag
+if the PUBACK hasn't come within ack_timeout. publish() only blocks when the
+window is full. A resend re-encodes the message from the topic and payload
+it was given, so don't change a payload buffer until its PUBACK is in.
+
+Subscriptions are kept in a SubscriptionTable. When the broker comes back
+without our session, everything in it is resubscribed with one SUBSCRIBE
+packet carrying all the filters, rather than one round trip per topic.
+"""
+
+from espatcontrol.espatcontrol import monotonic
+from espatcontrol.espatcontrol_topics import SubscriptionTable
+
+try:
+    from typing import Dict, List, Optional, Union
+except ImportError:
+    pass
+
+_CONNECT = 0x10
+_CONNACK = 0x20
+_PUBLISH = 0x30
+_PUBACK = 0x40
+_SUBSCRIBE = 0x82
+_SUBACK = 0x90
+_UNSUBSCRIBE = 0xA2
+_UNSUBACK = 0xB0
+_PINGREQ = 0xC0
+_PINGRESP = 0xD0
+_DISCONNECT = 0xE0
+
+_DUP = 0x08
+_MAX_SEND = 2048  # the most AT+CIPSEND takes on an ESP8266, ESP32s take 8192
+_WINDOW_RESENDS = 3  # ack_timeouts a full window waits before giving up
+
+
+def _length_size(length: int) -> int:
+    """Bytes the 'remaining length' varint takes for 'length'"""
+    if length < 128:
+        return 1
+    if length < 16384:
+        return 2
+    if length < 2097152:
+        return 3
+    return 4
+
+
+class MQTTClient:
+    """A pipelining MQTT 3.1.1 client on top of an ESP_ATcontrol socket.
+    Call loop() often: it sends what publish() batched up, handles whatever
+    the broker sent, resends unacknowledged messages and keeps the
+    connection alive"""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(
+        self,
+        esp,
+        client_id: str,
+        *,
+        keepalive: int = 60,
+        max_inflight: int = 16,
+        batch_size: int = 1024,
+        ack_timeout: float = 5,
+        debug: bool = False,
+    ):
+        self._esp = esp
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self._debug = debug
+        self.batch_size = batch_size
+        self._batch = bytearray(batch_size)
+        self._batch_len = 0
+        self._rx = b""  # the start of a packet whose end hasn't arrived yet
+        # packet id -> [topic, payload, retain, time sent] of unacked QoS 1
+        self._inflight = {}
+        self._next_id = 0
+        self._acks = {}  # SUBACK/UNSUBACK results by packet id
+        self._connack = None
+        self._session_present = False
+        self._last_send = 0.0
+        self._ping_sent = None
+        self.on_message = None  # on_message(topic, payload, retain)
+        self.subscriptions = SubscriptionTable()
+        self.connected = False
+        self.published = 0
+        self.acked = 0
+        self.resent = 0
+        self.batches = 0
+
+    # *************************** ENCODING ****************************
+
+    def _reserve(self, size: int) -> int:
+        """Make room for a packet of 'size' bytes in the batch, sending what
+        is already there if it won't fit. Returns where the packet goes"""
+        if self._batch_len + size > len(self._batch):
+            self.flush()
+            if size > len(self._batch):
+                self._batch = bytearray(size)  # one oversized message
+        return self._batch_len
+
+    def _put_header(self, pos: int, first: int, length: int) -> int:
+        batch = self._batch
+        batch[pos] = first
+        pos += 1
+        while True:
+            byte = length & 0x7F
+            length >>= 7
+            batch[pos] = byte | 0x80 if length else byte
+            pos += 1
+            if not length:
+                return pos
+
+    def _put_u16(self, pos: int, value: int) -> int:
+        self._batch[pos] = value >> 8
+        self._batch[pos + 1] = value & 0xFF
+        return pos + 2
+
+    def _put_bytes(self, pos: int, data: Union[bytes, bytearray, memoryview]) -> int:
+        end = pos + len(data)
+        self._batch[pos:end] = data
+        return end
+
+    def _put_string(self, pos: int, data: bytes) -> int:
+        return self._put_bytes(self._put_u16(pos, len(data)), data)
+
+    def _add_publish(
+        self, topic: bytes, payload: bytes, qos: int, retain: bool, packet_id: int, dup: bool
+    ) -> None:
+        length = 2 + len(topic) + len(payload) + (2 if qos else 0)
+        pos = self._reserve(1 + _length_size(length) + length)
+        first = _PUBLISH | qos << 1 | (1 if retain else 0) | (_DUP if dup else 0)
+        pos = self._put_string(self._put_header(pos, first, length), topic)
+        if qos:
+            pos = self._put_u16(pos, packet_id)
+        self._batch_len = self._put_bytes(pos, payload)
+
+    def _add_short(self, first: int, packet_id: int) -> None:
+        """PUBACK and the like, a packet id and nothing else"""
+        pos = self._reserve(4)
+        self._batch_len = self._put_u16(self._put_header(pos, first, 2), packet_id)
+
+    def _new_id(self) -> int:
+        while True:
+            self._next_id = self._next_id % 65535 + 1
+            if self._next_id not in self._inflight and self._next_id not in self._acks:
+                return self._next_id
+
+    # *************************** SENDING ****************************
+
+    def flush(self) -> None:
+        """Send everything batched up so far, one AT+CIPSEND per _MAX_SEND
+        bytes"""
+        if not self._batch_len:
+            return
+        view = memoryview(self._batch)
+        pos = 0
+        try:
+            while pos < self._batch_len:
+                end = min(self._batch_len, pos + _MAX_SEND)
+                self._esp.socket_send(view[pos:end])
+                pos = end
+                self.batches += 1
+        finally:
+            self._batch_len = 0
+            if len(self._batch) > self.batch_size:
+                self._batch = bytearray(self.batch_size)  # the oversized one is gone
+        self._last_send = monotonic()
+
+    def connect(
+        self,
+        host: str,
+        port: int = 1883,
+        *,
+        ssl: bool = False,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        clean_session: bool = True,
+        timeout: float = 10,
+    ) -> None:
+        """Open the socket and log in to the broker. With clean_session False
+        the messages still waiting for a PUBACK from before are resent"""
+        conntype = self._esp.TYPE_SSL if ssl else self._esp.TYPE_TCP
+        if not self._esp.socket_connect(conntype, host, port, retries=3):
+            raise RuntimeError("Couldn't connect to MQTT broker " + host)
+        self._rx = b""
+        self._batch_len = 0
+        self._connack = None
+        self._ping_sent = None
+        client_id = bytes(self.client_id, "utf-8")
+        user = bytes(username, "utf-8") if username is not None else None
+        secret = bytes(password, "utf-8") if password is not None else None
+        flags = 0x02 if clean_session else 0
+        length = 10 + 2 + len(client_id)
+        if user is not None:
+            flags |= 0x80
+            length += 2 + len(user)
+        if secret is not None:
+            flags |= 0x40
+            length += 2 + len(secret)
+        pos = self._reserve(1 + _length_size(length) + length)
+        pos = self._put_header(pos, _CONNECT, length)
+        pos = self._put_bytes(self._put_string(pos, b"MQTT"), b"\x04")
+        self._batch[pos] = flags
+        pos = self._put_string(self._put_u16(pos + 1, self.keepalive), client_id)
+        if user is not None:
+            pos = self._put_string(pos, user)
+        if secret is not None:
+            pos = self._put_string(pos, secret)
+        self._batch_len = pos
+        self.flush()
+        stamp = monotonic()
+        while self._connack is None:
+            if monotonic() - stamp > timeout:
+                self._esp.socket_disconnect()
+                raise RuntimeError("No CONNACK from MQTT broker")
+            self._receive(timeout - (monotonic() - stamp))
+        if self._connack:
+            self._esp.socket_disconnect()
+            raise RuntimeError("MQTT broker refused the connection", self._connack)
+        self.connected = True
+        self.subscriptions.reconnected()
+        if clean_session:
+            self._inflight = {}
+        else:
+            self._resend(0)
+        if not self._session_present and len(self.subscriptions):
+            self.resubscribe(timeout)
+
+    def publish(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        qos: int = 0,
+        retain: bool = False,
+    ) -> int:
+        """Add a message to the batch, it goes out on the next flush() or
+        loop(), or now if the batch is full. Returns the packet id of a QoS
+        1 message, to look for in 'pending', otherwise 0"""
+        if qos not in (0, 1):
+            raise ValueError("Only QoS 0 and 1 are supported")
+        if isinstance(payload, str):
+            payload = bytes(payload, "utf-8")
+        topic = bytes(topic, "utf-8")
+        packet_id = 0
+        if qos:
+            stamp = monotonic()
+            while len(self._inflight) >= self.max_inflight:
+                # the window is full, wait for the broker to catch up, but
+                # a broker that acks nothing through a few resends is gone
+                if monotonic() - stamp > self.ack_timeout * _WINDOW_RESENDS:
+                    self.connected = False
+                    raise RuntimeError("MQTT broker stopped acknowledging")
+                self.flush()
+                self._receive(self.ack_timeout)
+                self._resend(monotonic())
+            packet_id = self._new_id()
+            self._inflight[packet_id] = [topic, payload, retain, monotonic()]
+        self._add_publish(topic, payload, qos, retain, packet_id, False)
+        self.published += 1
+        return packet_id
+
+    def _resend(self, now: float) -> None:
+        """Resend, as duplicates, QoS 1 messages sent before 'now' minus
+        ack_timeout; 0 resends them all"""
+        for packet_id, message in self._inflight.items():
+            if now and now - message[3] < self.ack_timeout:
+                continue
+            self._add_publish(message[0], message[1], 1, message[2], packet_id, True)
+            message[3] = monotonic()
+            self.resent += 1
+
+    @property
+    def pending(self) -> List[int]:
+        """Packet ids of the QoS 1 messages still waiting for a PUBACK"""
+        return list(self._inflight)
+
+    # *************************** RECEIVING ****************************
+
+    def _receive(self, timeout: float) -> int:
+        """Read one +IPD packet and handle every MQTT packet completed by it.
+        Returns how many were handled"""
+        esp = self._esp
+        block = esp.buffers.acquire()
+        try:
+            size = esp.socket_receive_into(block, max(timeout, 0.01))
+            if not size:
+                return 0
+            data = self._rx + bytes(block[:size]) if self._rx else block[:size]
+            handled = 0
+            pos = 0
+            while True:
+                end = self._packet_end(data, pos)
+                if end < 0:
+                    break
+                self._handle(data, pos, end)
+                handled += 1
+                pos = end
+            self._rx = bytes(data[pos:])
+            return handled
+        finally:
+            esp.buffers.release(block)
+
+    @staticmethod
+    def _packet_end(data, pos: int) -> int:
+        """Where the packet starting at data[pos] ends, -1 if it isn't all
+        here yet"""
+        length = 0
+        shift = 0
+        i = pos + 1
+        while True:
+            if i >= len(data):
+                return -1
+            byte = data[i]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            i += 1
+            if not byte & 0x80:
+                break
+        end = i + length
+        return end if end <= len(data) else -1
+
+    def _handle(self, data, pos: int, end: int) -> None:
+        kind = data[pos] & 0xF0
+        start = pos + 1
+        while data[start] & 0x80:
+            start += 1
+        start += 1  # past the remaining length
+        if kind == _PUBACK:
+            if self._inflight.pop(data[start] << 8 | data[start + 1], None) is not None:
+                self.acked += 1
+        elif kind == _PUBLISH:
+            self._on_publish(data, pos, start, end)
+        elif kind == _PINGRESP:
+            self._ping_sent = None
+        elif kind == _CONNACK:
+            self._session_present = bool(data[start] & 1)
+            self._connack = data[start + 1]
+        elif kind in (_SUBACK, _UNSUBACK):
+            self._acks[data[start] << 8 | data[start + 1]] = bytes(data[start + 2 : end])
+        elif self._debug:
+            print("MQTT: ignoring packet type", kind)
+
+    def _on_publish(self, data, pos: int, start: int, end: int) -> None:
+        qos = (data[pos] >> 1) & 3
+        topic_len = data[start] << 8 | data[start + 1]
+        topic = str(bytes(data[start + 2 : start + 2 + topic_len]), "utf-8")
+        start += 2 + topic_len
+        if qos:
+            self._add_short(_PUBACK, data[start] << 8 | data[start + 1])
+            start += 2
+        latency = self.subscriptions.message_received(topic)
+        if latency is not None and self._debug:
+            print("MQTT: first message %.2fs after connecting" % latency)
+        if self.on_message is not None:
+            self.on_message(topic, bytes(data[start:end]), bool(data[pos] & 1))
+
+    def _wait_ack(self, packet_id: int, timeout: float) -> bytes:
+        self.flush()
+        stamp = monotonic()
+        while packet_id not in self._acks:
+            if monotonic() - stamp > timeout:
+                raise RuntimeError("No reply from MQTT broker")
+            self._receive(timeout - (monotonic() - stamp))
+        return self._acks.pop(packet_id)
+
+    # *************************** SESSION ****************************
+
+    def _subscribe(self, filters: Dict[str, int], timeout: float) -> bytes:
+        """One SUBSCRIBE for every filter in 'filters', returns the QoS
+        granted for each, in order"""
+        names = [bytes(name, "utf-8") for name in filters]
+        packet_id = self._new_id()
+        length = 2 + sum(2 + len(name) + 1 for name in names)
+        pos = self._reserve(1 + _length_size(length) + length)
+        pos = self._put_u16(self._put_header(pos, _SUBSCRIBE, length), packet_id)
+        for name, qos in zip(names, filters.values()):
+            pos = self._put_string(pos, name)
+            self._batch[pos] = qos
+            pos += 1
+        self._batch_len = pos
+        granted = self._wait_ack(packet_id, timeout)
+        for i, name in enumerate(filters):
+            if i >= len(granted) or granted[i] == 0x80:
+                raise RuntimeError("MQTT broker refused subscription", name)
+        return granted
+
+    def _unsubscribe(self, filters: List[str], timeout: float) -> None:
+        names = [bytes(name, "utf-8") for name in filters]
+        packet_id = self._new_id()
+        length = 2 + sum(2 + len(name) for name in names)
+        pos = self._reserve(1 + _length_size(length) + length)
+        pos = self._put_u16(self._put_header(pos, _UNSUBSCRIBE, length), packet_id)
+        for name in names:
+            pos = self._put_string(pos, name)
+        self._batch_len = pos
+        self._wait_ack(packet_id, timeout)
+
+    def subscribe(self, topic: str, qos: int = 0, timeout: float = 5) -> int:
+        """Subscribe and wait for the broker's answer, returns the QoS it
+        granted. A filter that a wider one already covers at the same QoS
+        isn't sent at all, and the filters a new wildcard covers are
+        unsubscribed so nothing is delivered twice"""
+        if qos not in (0, 1):
+            raise ValueError("Only QoS 0 and 1 are supported")
+        needed, redundant = self.subscriptions.add(topic, qos)
+        if not needed:
+            return qos
+        granted = self._subscribe({topic: qos}, timeout)[0]
+        if redundant:
+            self._unsubscribe(redundant, timeout)
+        return granted
+
+    def unsubscribe(self, topic: str, timeout: float = 5) -> None:
+        if topic not in self.subscriptions:
+            return
+        uncovered = self.subscriptions.remove(topic)
+        if uncovered:
+            effective = self.subscriptions.effective()
+            self._subscribe({name: effective[name] for name in uncovered}, timeout)
+        self._unsubscribe([topic], timeout)
+
+    def resubscribe(self, timeout: float = 5) -> bytes:
+        """Subscribe to everything in the table again with a single
+        SUBSCRIBE, returns the granted QoS of each filter"""
+        effective = self.subscriptions.effective()
+        if not effective:
+            return b""
+        return self._subscribe(effective, timeout)
+
+    def loop(self, timeout: float = 0) -> int:
+        """Send the batch, handle what the broker sent (waiting up to
+        'timeout' for something if nothing is there yet), resend overdue
+        QoS 1 messages and ping when the connection has been quiet. Returns
+        how many packets came in"""
+        self.flush()
+        handled = 0
+        if timeout or self._esp.in_waiting:
+            handled += self._receive(timeout)
+        while self._esp.in_waiting:
+            handled += self._receive(0.1)
+        now = monotonic()
+        self._resend(now)
+        if self._ping_sent is not None and now - self._ping_sent > self.keepalive:
+            self.connected = False
+            raise RuntimeError("MQTT broker stopped answering")
+        if self._ping_sent is None and now - self._last_send > self.keepalive / 2:
+            pos = self._reserve(2)
+            self._batch_len = self._put_header(pos, _PINGREQ, 0)
+            self._ping_sent = now
+        self.flush()
+        return handled
+
+    def wait_for_acks(self, timeout: float = 10) -> bool:
+        """Send the batch and wait until every QoS 1 message is acknowledged.
+        False if some still aren't after 'timeout'"""
+        stamp = monotonic()
+        while self._inflight and monotonic() - stamp < timeout:
+            self.loop(min(self.ack_timeout, timeout - (monotonic() - stamp)))
+        return not self._inflight
+
+    def disconnect(self) -> None:
+        """Say goodbye to the broker and close the socket"""
+        if self.connected:
+            self.flush()
+            pos = self._reserve(2)
+            self._batch_len = self._put_header(pos, _DISCONNECT, 0)
+            try:
+                self.flush()
+            except (RuntimeError, OSError):
+                pass
+        self.connected = False
+        self._esp.socket_disconnect()
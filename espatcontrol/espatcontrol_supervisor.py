@@ -0,0 +1,137 @@
+"""
+`espatcontrol.espatcontrol_supervisor`
+====================================================
+
+Keeps an ESP_ATcontrol connection up. Call poll() from the main loop: it
+only reads what the module has already sent us (WIFI DISCONNECT, CLOSED)
+so an idle, healthy link costs no AT traffic at all. When the link drops it
+rejoins with jittered exponential backoff, hard resets the module if plain
+rejoins keep failing, then runs the callbacks you registered with
+on_reconnect() to restore anything else. With reopen_socket=True a socket
+that was open when the link dropped, or that the far end closed, is
+reopened too; leave it off for one-shot sockets such as HTTP requests.
+"""
+
+import random
+
+from espatcontrol.espatcontrol import OKError, monotonic
+
+try:
+    from typing import Callable, Dict, Union
+except ImportError:
+    pass
+
+
+class WiFiSupervisor:
+    """Event driven reconnect logic for a blocking ESP_ATcontrol"""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(
+        self,
+        esp,
+        secrets: Dict[str, Union[str, int]],
+        *,
+        backoff_min: float = 1,
+        backoff_max: float = 60,
+        reset_after: int = 3,
+        reopen_socket: bool = False,
+        debug: bool = False,
+    ):
+        self._esp = esp
+        self._secrets = secrets
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+        self._reset_after = reset_after
+        self._reopen_socket = reopen_socket
+        self._debug = debug
+        self._callbacks = []
+        self._down = False
+        self._socket_closed = False
+        self._socket_args = None
+        self._attempts = 0
+        self._next_attempt = 0
+        self._down_since = None
+        self.reconnects = 0
+        self.downtime = 0.0  # seconds spent disconnected, summed
+
+    @property
+    def connected(self) -> bool:
+        """False from the moment we notice the link is down until it is back"""
+        return not self._down
+
+    def on_reconnect(self, callback: Callable[[], None]) -> None:
+        """Call 'callback' after every successful reconnect, e.g. to
+        resubscribe or resend state the far end has lost"""
+        self._callbacks.append(callback)
+
+    def link_lost(self) -> None:
+        """Tell the supervisor the link is gone, e.g. after a command raised"""
+        if not self._down:
+            self._down = True
+            self._down_since = monotonic()
+            self._socket_args = self._esp._socket_args
+            self._next_attempt = 0
+            if self._debug:
+                print("WiFiSupervisor: link lost")
+
+    def poll(self) -> bool:
+        """Handle pending link events and, if a reconnect attempt is due,
+        make it. Returns True if the link is up"""
+        for event in self._esp.poll_urc():
+            if event == b"WIFI DISCONNECT":
+                self.link_lost()
+            elif event == b"CLOSED" and self._esp._socket_args:
+                self._socket_args = self._esp._socket_args
+                self._socket_closed = True
+        if self._down:
+            if monotonic() >= self._next_attempt:
+                self._reconnect()
+        elif self._socket_closed:
+            self._socket_closed = False
+            self._restore_socket()
+        return not self._down
+
+    def _reconnect(self) -> None:
+        esp = self._esp
+        try:
+            if self._attempts >= self._reset_after:
+                if self._debug:
+                    print("WiFiSupervisor: rejoins keep failing, hard reset")
+                esp.hard_reset()
+                self._attempts = 0
+            esp.connect(self._secrets)
+        except (RuntimeError, OKError) as exp:
+            self._attempts += 1
+            delay = self._backoff_delay()
+            self._next_attempt = monotonic() + delay
+            if self._debug:
+                print("WiFiSupervisor: reconnect failed (%s), next in %.1fs" % (exp, delay))
+            return
+        self._down = False
+        self._attempts = 0
+        self.reconnects += 1
+        if self._down_since is not None:
+            self.downtime += monotonic() - self._down_since
+            self._down_since = None
+        self._restore_socket()
+        for callback in self._callbacks:
+            callback()
+
+    def _restore_socket(self) -> None:
+        args = self._socket_args
+        self._socket_args = None
+        if not (self._reopen_socket and args):
+            return
+        try:
+            if self._esp.socket_connect(*args):
+                return
+        except (RuntimeError, OKError):
+            pass
+        self.link_lost()
+        self._socket_args = args
+
+    def _backoff_delay(self) -> float:
+        """Exponential backoff, randomised over its upper half so a room
+        full of devices does not hammer the AP in lockstep"""
+        delay = min(self._backoff_max, self._backoff_min * 2 ** self._attempts)
+        return delay / 2 + delay / 2 * random.getrandbits(16) / 65536
@@ -0,0 +1,297 @@
+"""
+`espatcontrol.espatcontrol_telemetry`
+====================================================
+
+A compact binary encoding for status records published over MQTT, in
+place of their text form. A Schema lists a record's fields once, so
+nothing but values goes on the wire: integers as varints, fixed point
+numbers as scaled integers, floats as 4 bytes, strings length prefixed.
+Several samples go in one frame, and every record after a frame's first
+only carries the fields that changed, integers as the difference from
+the previous record. Frames carry on from the last one published, so a
+counter that ticks up once a sample costs a byte or two.
+
+Frame layout, all numbers varints:
+  version, schema id, sequence number, record count, then per record
+  (field bitmap << 1 | delta flag) followed by the fields in the bitmap.
+
+A keyframe record (delta flag clear) holds every field that has a value.
+The first record of a frame is a keyframe every keyframe_interval frames
+and after reset(), which is what lets a decoder that missed a frame, or
+started late, pick up again. The backend side is TelemetryDecoder:
+
+    decoder = TelemetryDecoder([STATUS])
+    for record in decoder.decode(payload):
+        print(record["time"], record["rssi"])
+
+Plain Python with no driver imports, so the host side tools use it too.
+"""
+
+import struct
+
+try:
+    from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+except ImportError:
+    pass
+
+VERSION = 1
+
+_INT_KINDS = "iu"  # i signed, u unsigned, both varints
+_KINDS = "iufs?"  # plus f float32, s string, ? bool
+
+
+class TelemetryError(ValueError):
+    """A frame that can't be decoded"""
+
+
+def _put_varint(out: bytearray, value: int) -> None:
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise TelemetryError("Frame cut short")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    # small negative numbers to small varints: 0, -1, 1, -2 -> 0, 1, 2, 3
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+class Schema:
+    """The fields of one kind of record, in wire order. Each field is
+    (name, kind) or (name, kind, scale): kinds are 'i' signed and 'u'
+    unsigned integers, 'f' float32, 's' string and '?' bool. A scale on an
+    integer field makes it fixed point, ('temperature', 'i', 10) sends
+    21.37 as 214 and decodes it as 21.4"""
+
+    def __init__(self, schema_id: int, fields: Iterable[tuple]):
+        self.schema_id = schema_id
+        self.names = []
+        self.kinds = ""
+        self.scales = []
+        for field in fields:
+            name, kind = field[0], field[1]
+            if kind not in _KINDS:
+                raise ValueError("Unknown field kind " + kind)
+            scale = field[2] if len(field) > 2 else 1
+            if scale != 1 and kind not in _INT_KINDS:
+                raise ValueError("Only integer fields take a scale")
+            self.names.append(name)
+            self.kinds += kind
+            self.scales.append(scale)
+
+    def __repr__(self) -> str:
+        return "Schema(%d, %r)" % (self.schema_id, self.names)
+
+    def values(self, record: Any) -> list:
+        """The record's field values in wire form, None for a missing one.
+        A record is a dict or any object with the fields as attributes"""
+        result = []
+        for i, name in enumerate(self.names):
+            if isinstance(record, dict):
+                value = record.get(name)
+            else:
+                value = getattr(record, name, None)
+            if value is not None:
+                kind = self.kinds[i]
+                if kind in _INT_KINDS:
+                    value = int(round(value * self.scales[i]))
+                elif kind == "f":
+                    value = struct.unpack("<f", struct.pack("<f", value))[0]
+                elif kind == "?":
+                    value = bool(value)
+                else:
+                    value = str(value)
+            result.append(value)
+        return result
+
+
+class TelemetryEncoder:
+    """Collects samples and packs them into frames of batch_size records.
+    Publish every frame it hands back, in order: each one is a delta on
+    the one before"""
+
+    def __init__(self, schema: Schema, *, batch_size: int = 10, keyframe_interval: int = 10):
+        self.schema = schema
+        self.batch_size = batch_size
+        self.keyframe_interval = keyframe_interval
+        self._pending = []  # wire values of the samples in the next frame
+        self._last = None  # wire values of the last record published
+        self._frames_since_key = keyframe_interval  # first frame starts with a keyframe
+        self._seq = 0
+        self.bytes_out = 0
+        self.samples = 0
+
+    def __len__(self) -> int:
+        """Samples waiting for the next frame"""
+        return len(self._pending)
+
+    def reset(self) -> None:
+        """Start the next frame with a keyframe, for instance after the
+        broker connection dropped and a frame might have been lost"""
+        self._last = None
+
+    def add(self, record: Any) -> Optional[bytes]:
+        """Add a sample. Returns a frame to publish once batch_size are in"""
+        self._pending.append(self.schema.values(record))
+        self.samples += 1
+        if len(self._pending) >= self.batch_size:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[bytes]:
+        """The samples batched so far as a frame, None if there are none"""
+        if not self._pending:
+            return None
+        frame = bytearray()
+        frame.append(VERSION)
+        _put_varint(frame, self.schema.schema_id)
+        _put_varint(frame, self._seq)
+        _put_varint(frame, len(self._pending))
+        last = self._last
+        if self._frames_since_key >= self.keyframe_interval:
+            last = None
+        self._frames_since_key = 1 if last is None else self._frames_since_key + 1
+        for values in self._pending:
+            if last is not None:
+                for i, value in enumerate(values):
+                    if value is None and last[i] is not None:
+                        last = None  # a field going missing can't be said as a delta
+                        break
+            self._put_record(frame, values, last)
+            last = values
+        self._last = last
+        self._pending = []
+        self._seq = (self._seq + 1) & 0xFFFF
+        self.bytes_out += len(frame)
+        return bytes(frame)
+
+    def _put_record(self, out: bytearray, values: list, last: Optional[list]) -> None:
+        kinds = self.schema.kinds
+        bitmap = 0
+        for i, value in enumerate(values):
+            if value is not None and (last is None or value != last[i]):
+                bitmap |= 1 << i
+        _put_varint(out, bitmap << 1 | (last is not None))
+        for i, value in enumerate(values):
+            if not bitmap & (1 << i):
+                continue
+            kind = kinds[i]
+            if kind in _INT_KINDS:
+                if last is not None and last[i] is not None:
+                    _put_varint(out, _zigzag(value - last[i]))
+                elif kind == "i":
+                    _put_varint(out, _zigzag(value))
+                else:
+                    _put_varint(out, value)
+            elif kind == "f":
+                out.extend(struct.pack("<f", value))
+            elif kind == "?":
+                out.append(1 if value else 0)
+            else:
+                text = value.encode("utf-8")
+                _put_varint(out, len(text))
+                out.extend(text)
+
+
+class TelemetryDecoder:
+    """Turns frames back into records, one dict per sample. Keeps the last
+    record of each schema to apply the next frame's deltas to"""
+
+    def __init__(self, schemas: Iterable[Schema]):
+        self.schemas = {schema.schema_id: schema for schema in schemas}
+        self._last = {}  # schema id -> wire values
+        self._next_seq = {}  # schema id -> sequence number expected next
+        self.lost_frames = 0
+
+    def decode(self, frame: Union[bytes, bytearray, memoryview]) -> List[Dict[str, Any]]:
+        """The records in a frame. Raises TelemetryError for a frame that
+        isn't ours or that deltas on one that never arrived, in which case
+        decoding picks up again at the next keyframe"""
+        data = bytes(frame)
+        if not data or data[0] != VERSION:
+            raise TelemetryError("Not a version %d telemetry frame" % VERSION)
+        schema_id, pos = _get_varint(data, 1)
+        schema = self.schemas.get(schema_id)
+        if schema is None:
+            raise TelemetryError("Unknown schema %d" % schema_id)
+        seq, pos = _get_varint(data, pos)
+        count, pos = _get_varint(data, pos)
+        last = self._last.get(schema_id)
+        expected = self._next_seq.get(schema_id)
+        self._next_seq[schema_id] = (seq + 1) & 0xFFFF
+        if expected is not None and seq != expected:
+            self.lost_frames += (seq - expected) & 0xFFFF
+            last = None  # whatever we missed, our reference is stale
+        records = []
+        for _ in range(count):
+            values, pos = self._get_record(schema, data, pos, last)
+            records.append(self._as_dict(schema, values))
+            last = values
+        if pos != len(data):
+            raise TelemetryError("%d bytes left over" % (len(data) - pos))
+        self._last[schema_id] = last
+        return records
+
+    def _get_record(self, schema: Schema, data: bytes, pos: int, last: Optional[list]) -> Tuple[list, int]:
+        head, pos = _get_varint(data, pos)
+        bitmap = head >> 1
+        delta = head & 1
+        if delta and last is None:
+            self._last.pop(schema.schema_id, None)
+            raise TelemetryError("Delta without the record it's based on, waiting for a keyframe")
+        values = list(last) if delta else [None] * len(schema.names)
+        for i, kind in enumerate(schema.kinds):
+            if not bitmap & (1 << i):
+                continue
+            if kind in _INT_KINDS:
+                value, pos = _get_varint(data, pos)
+                if delta and last[i] is not None:
+                    value = last[i] + _unzigzag(value)
+                elif kind == "i":
+                    value = _unzigzag(value)
+                values[i] = value
+            elif kind == "f":
+                if pos + 4 > len(data):
+                    raise TelemetryError("Frame cut short")
+                values[i] = struct.unpack("<f", data[pos : pos + 4])[0]
+                pos += 4
+            elif kind == "?":
+                if pos >= len(data):
+                    raise TelemetryError("Frame cut short")
+                values[i] = bool(data[pos])
+                pos += 1
+            else:
+                size, pos = _get_varint(data, pos)
+                if pos + size > len(data):
+                    raise TelemetryError("Frame cut short")
+                values[i] = data[pos : pos + size].decode("utf-8")
+                pos += size
+        return values, pos
+
+    @staticmethod
+    def _as_dict(schema: Schema, values: list) -> Dict[str, Any]:
+        record = {}
+        for i, name in enumerate(schema.names):
+            value = values[i]
+            if value is not None and schema.scales[i] != 1:
+                value = value / schema.scales[i]
+            record[name] = value
+        return record
@@ -0,0 +1,132 @@
+"""
+`espatcontrol.espatcontrol_topics`
+====================================================
+
+MQTT topic filter matching and a table of what we're subscribed to.
+SubscriptionTable remembers every filter asked for, and effective() boils
+them down to the ones the broker actually needs: 'sensors/+/temp' isn't
+worth a subscription of its own next to 'sensors/#' at the same or a
+higher QoS, it would only get every message delivered twice. After a
+reconnect the effective set is what gets resubscribed, and the table
+times how long the first message then takes to arrive.
+
+Plain Python with no driver imports, so the host side tools use it too.
+"""
+
+try:
+    from time import monotonic
+except ImportError:  # MicroPython
+    from time import ticks_ms
+
+    def monotonic() -> float:
+        """Seconds from an arbitrary start, as time.monotonic"""
+        return ticks_ms() / 1000
+
+
+try:
+    from typing import Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Whether a message published to 'topic' is delivered to a
+    subscription to 'topic_filter', '+' and '#' wildcards and all"""
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False  # wildcards don't reach $SYS and friends
+    levels = topic.split("/")
+    for i, level in enumerate(topic_filter.split("/")):
+        if level == "#":
+            return True
+        if i >= len(levels) or (level != "+" and level != levels[i]):
+            return False
+    return len(levels) == len(topic_filter.split("/"))
+
+
+def filter_covers(wide: str, narrow: str) -> bool:
+    """Whether every topic 'narrow' matches is matched by 'wide' too"""
+    if narrow.startswith("$") and wide[:1] in ("+", "#"):
+        return False
+    narrow_levels = narrow.split("/")
+    for i, level in enumerate(wide.split("/")):
+        if level == "#":
+            return True  # 'a/#' also matches plain 'a'
+        if i >= len(narrow_levels):
+            return False
+        other = narrow_levels[i]
+        if other == "#" or (level != "+" and (other == "+" or level != other)):
+            return False
+    return len(narrow_levels) == len(wide.split("/"))
+
+
+class SubscriptionTable:
+    """Every filter subscribed to and its QoS, with the overlap taken out
+    for the broker"""
+
+    def __init__(self):
+        self._filters = {}  # filter -> qos, everything asked for
+        self._reconnected = None
+        self.first_message_latency = None  # seconds, reconnect to first message
+        self.reconnects = 0
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def __contains__(self, topic_filter: str) -> bool:
+        return topic_filter in self._filters
+
+    def add(self, topic_filter: str, qos: int = 0) -> Tuple[bool, List[str]]:
+        """Remember a subscription. Returns whether the broker needs to be
+        told about it, and the filters it makes redundant there"""
+        before = self.effective()
+        self._filters[topic_filter] = max(qos, self._filters.get(topic_filter, 0))
+        after = self.effective()
+        needed = after.get(topic_filter) is not None and after != before
+        return needed, [name for name in before if name not in after]
+
+    def remove(self, topic_filter: str) -> List[str]:
+        """Forget a subscription. Returns the filters the broker now needs
+        to be subscribed to that it wasn't before"""
+        before = self.effective()
+        self._filters.pop(topic_filter, None)
+        return [name for name in self.effective() if name not in before]
+
+    def clear(self) -> None:
+        self._filters = {}
+
+    def effective(self) -> Dict[str, int]:
+        """The filters the broker needs: those not covered by another one
+        with at least their QoS"""
+        result = {}
+        for name, qos in self._filters.items():
+            for other, other_qos in self._filters.items():
+                if other != name and other_qos >= qos and filter_covers(other, name):
+                    # of two filters that cover each other keep the first
+                    if not filter_covers(name, other) or other < name:
+                        break
+            else:
+                result[name] = qos
+        return result
+
+    def qos(self, topic: str) -> Optional[int]:
+        """The QoS a message on 'topic' is delivered at, None if nothing we
+        subscribed to matches it"""
+        best = None
+        for name, qos in self._filters.items():
+            if (best is None or qos > best) and topic_matches(name, topic):
+                best = qos
+        return best
+
+    def reconnected(self) -> None:
+        """The broker connection is back, start timing the first message"""
+        self._reconnected = monotonic()
+        self.reconnects += 1
+
+    def message_received(self, topic: str) -> Optional[float]:
+        """Note a delivered message. Returns the time since the reconnect
+        for the first one after it, otherwise None"""
+        if self._reconnected is None or self.qos(topic) is None:
+            return None
+        self.first_message_latency = monotonic() - self._reconnected
+        self._reconnected = None
+        return self.first_message_latency
@@ -0,0 +1,231 @@
+import asyncio
+import sys
+import time
+from espwrapper import AsyncESP32ATWrapper
+from espatcontrol.espatcontrol_cmd import quote
+
+
+class DeviceMetrics:
+    """Health and counters for one module"""
+
+    def __init__(self):
+        self.commands = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.busy_time = 0.0  # seconds spent waiting on replies
+        self.last_ok = None  # time.monotonic() of the last good reply
+        self.healthy = False
+
+    @property
+    def mean_latency(self):
+        return self.busy_time / self.commands if self.commands else 0.0
+
+    def as_dict(self):
+        return {
+            "commands": self.commands,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "mean_latency": self.mean_latency,
+            "healthy": self.healthy,
+        }
+
+
+class ManagedDevice:
+    # One wrapper, its own command queue and the worker task that drains it.
+    # Each device only ever waits on itself, so a slow or dead module can't
+    # hold up the others and every module gets a fair share of the loop.
+
+    def __init__(self, port, baudrate, queue_size):
+        self.port = port
+        self.esp32 = AsyncESP32ATWrapper(port, baudrate=baudrate, verbose=False)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.metrics = DeviceMetrics()
+        self.worker = None
+
+
+class ESPManager:
+    """Drives any number of AsyncESP32ATWrapper modules, one per serial port,
+    from a single event loop. Commands go through a bounded queue per device
+    so a busy device pushes back on its callers rather than piling up work,
+    and broadcast() fans one command out to every healthy device at once."""
+
+    def __init__(self, ports, baudrate=115200, command_timeout=5, queue_size=32,
+                 unhealthy_after=3, health_interval=30):
+        self.command_timeout = command_timeout
+        self.unhealthy_after = unhealthy_after
+        self.health_interval = health_interval
+        self.devices = {port: ManagedDevice(port, baudrate, queue_size) for port in ports}
+        self._health_task = None
+        self._started = None
+
+    async def start(self):
+        # Open every port at once; a port that fails just stays unhealthy
+        results = await asyncio.gather(
+            *(device.esp32.connect() for device in self.devices.values()),
+            return_exceptions=True)
+        for device, result in zip(self.devices.values(), results):
+            if isinstance(result, Exception):
+                print(f"Manager: couldn't open {device.port}: {result}")
+                continue
+            device.metrics.healthy = True
+            device.worker = asyncio.create_task(self._worker(device))
+        self._started = time.monotonic()
+        if self.health_interval:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+        for device in self.devices.values():
+            if device.worker:
+                device.worker.cancel()
+                device.esp32.stop_listening()
+                device.esp32.listen_task.cancel()
+                await device.esp32.close()
+
+    async def _worker(self, device):
+        metrics = device.metrics
+        while True:
+            command, future = await device.queue.get()
+            if future.done():
+                continue  # the caller gave up waiting
+            stamp = time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    device.esp32.execute_command(command), self.command_timeout)
+            except asyncio.TimeoutError:
+                metrics.timeouts += 1
+                self._failed(device)
+                if not future.done():
+                    future.set_exception(TimeoutError(f"{device.port}: {command} timed out"))
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                self._failed(device)
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            finally:
+                metrics.commands += 1
+                metrics.busy_time += time.monotonic() - stamp
+            if response.endswith("ERROR"):
+                metrics.errors += 1
+            metrics.consecutive_failures = 0
+            metrics.last_ok = time.monotonic()
+            metrics.healthy = True
+            if not future.done():
+                future.set_result(response)
+
+    def _failed(self, device):
+        metrics = device.metrics
+        metrics.errors += 1
+        metrics.consecutive_failures += 1
+        if metrics.consecutive_failures >= self.unhealthy_after and metrics.healthy:
+            metrics.healthy = False
+            print(f"Manager: {device.port} marked unhealthy")
+
+    async def _health_loop(self):
+        # Ping devices that have been quiet for a while, a busy device proves
+        # itself with its own traffic. Unhealthy ones are pinged too so they
+        # come back as soon as they answer
+        while True:
+            await asyncio.sleep(self.health_interval)
+            now = time.monotonic()
+            for device in self.devices.values():
+                if device.worker is None:
+                    continue
+                last_ok = device.metrics.last_ok
+                if last_ok is None or now - last_ok > self.health_interval:
+                    if device.queue.empty():
+                        asyncio.ensure_future(self._ping(device))
+
+    async def _ping(self, device):
+        try:
+            await self.submit(device.port, "AT")
+        except (TimeoutError, RuntimeError, OSError):
+            pass
+
+    async def submit(self, port, command):
+        # Queue a command on one device and wait for its reply
+        device = self.devices[port]
+        if device.worker is None:
+            raise RuntimeError(f"{port} is not open")
+        future = asyncio.get_running_loop().create_future()
+        await device.queue.put((command, future))
+        return await future
+
+    def healthy_ports(self):
+        return [port for port, device in self.devices.items() if device.metrics.healthy]
+
+    async def broadcast(self, command, ports=None):
+        # Send one command to every healthy device (or 'ports') concurrently,
+        # returns {port: reply or the exception it raised}
+        ports = self.healthy_ports() if ports is None else ports
+        results = await asyncio.gather(*(self.submit(port, command) for port in ports),
+                                       return_exceptions=True)
+        return dict(zip(ports, results))
+
+    async def survey_versions(self):
+        # {port: 'AT version:...' line} across the rack
+        versions = {}
+        for port, reply in (await self.broadcast("AT+GMR")).items():
+            if isinstance(reply, Exception):
+                versions[port] = None
+                continue
+            versions[port] = next(
+                (line for line in reply.split("\n") if line.startswith("AT version:")), None)
+        return versions
+
+    async def publish_batch(self, messages, qos=0, retain=False):
+        # messages is {port: [(topic, payload), ...]}. Each device works
+        # through its own list while the others do the same
+        async def publish_all(port, items):
+            retain_flag = 1 if retain else 0
+            replies = []
+            for topic, payload in items:
+                replies.append(await self.submit(
+                    port, f'AT+MQTTPUB=0,{quote(topic)},{quote(payload)},{qos},{retain_flag}'))
+            return replies
+        ports = list(messages)
+        results = await asyncio.gather(*(publish_all(port, messages[port]) for port in ports),
+                                       return_exceptions=True)
+        return dict(zip(ports, results))
+
+    def stats(self):
+        # Per device metrics plus rack wide totals and rates
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        per_device = {}
+        totals = {"commands": 0, "errors": 0, "timeouts": 0,
+                  "bytes_sent": 0, "bytes_received": 0}
+        for port, device in self.devices.items():
+            entry = device.metrics.as_dict()
+            entry["bytes_sent"] = device.esp32.bytes_sent
+            entry["bytes_received"] = device.esp32.bytes_received
+            entry["queued"] = device.queue.qsize()
+            per_device[port] = entry
+            for key in totals:
+                totals[key] += entry[key]
+        totals["healthy"] = len(self.healthy_ports())
+        totals["devices"] = len(self.devices)
+        if elapsed:
+            totals["commands_per_s"] = totals["commands"] / elapsed
+            totals["bytes_per_s"] = (totals["bytes_sent"] + totals["bytes_received"]) / elapsed
+        return {"devices": per_device, "totals": totals}
+
+
+async def main():
+    # python espmanager.py /dev/ttyUSB0 /dev/ttyUSB1 ...
+    manager = ESPManager(sys.argv[1:] or ['/dev/tty.usbserial-110'])
+    await manager.start()
+    try:
+        for port, version in (await manager.survey_versions()).items():
+            print(f"{port}: {version}")
+        for _ in range(10):
+            await manager.broadcast("AT+CWJAP?")
+            await asyncio.sleep(1)
+        print(manager.stats()["totals"])
+    finally:
+        await manager.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,5 +1,9 @@
 import asyncio
+import random
 import serial_asyncio
+from espatcontrol.espatcontrol_ap import AccessPoint, CWLAP_COMPACT
+from espatcontrol.espatcontrol_cmd import quote
+from espatcontrol.espatcontrol_topics import SubscriptionTable
 try:
     from secrets import secrets
 except Exception as e:
@@ -7,37 +11,71 @@ except Exception as e:
     print("No Secrets")
 
 class AsyncESP32ATWrapper:
-    def __init__(self, port, baudrate=115200, timeout=1):
+    # Unsolicited lines, handed to the URC handlers as soon as they arrive
+    URC_PREFIXES = ("WIFI DISCONNECT", "WIFI CONNECTED", "WIFI GOT IP", "CLOSED",
+                    "+MQTTCONNECTED", "+MQTTDISCONNECTED", "+MQTTSUBRECV")
+    # '<prefix><len>,<data>' frames, the data is binary and read by length
+    HTTP_FRAMES = (b"+HTTPCLIENT:", b"+HTTPCGET:")
+    HTTP_METHODS = {"HEAD": 1, "GET": 2, "POST": 3, "PUT": 4, "DELETE": 5}
+
+    def __init__(self, port, baudrate=115200, timeout=1, verbose=True):
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
+        self.verbose = verbose
         self.reader = None
         self.writer = None
         self.keep_listening = True
-        self.listen_task = asyncio.create_task(self.listen_for_at_messages())
-
-        
-
+        self.listen_task = None
+        self._responses = asyncio.Queue()
+        self._urc_handlers = []
+        self._mqtt_config = None
+        self.subscriptions = SubscriptionTable()
+        self._pending = b""  # read past the end of an HTTP frame
+        self._ipd = asyncio.Queue()  # +IPD socket data, None once the peer closes
+        self.bytes_sent = 0
+        self.bytes_received = 0
 
     async def connect(self):
         self.reader, self.writer = await serial_asyncio.open_serial_connection(
             url=self.port, baudrate=self.baudrate)
         print(f"Connected to {self.port} at {self.baudrate} bps.")
+        # The listener owns the reader, everything else gets lines from it
+        self.listen_task = asyncio.create_task(self.listen_for_at_messages())
+
+    async def hard_reset(self):
+        # Pulse EN through the USB-serial RTS line the way esptool does,
+        # fall back to AT+RST if the transport has no modem control lines
+        serial_port = getattr(self.writer.transport, "serial", None)
+        if serial_port is not None:
+            serial_port.dtr = False
+            serial_port.rts = True
+            await asyncio.sleep(0.1)
+            serial_port.rts = False
+        else:
+            await self.send_command('AT+RST')
+        await asyncio.sleep(3)  # give it a few seconds to boot
 
     async def send_command(self, command):
         if not command.endswith('\r\n'):
             command += '\r\n'
-        self.writer.write(command.encode())
+        data = command.encode()
+        self.bytes_sent += len(data)
+        self.writer.write(data)
         await self.writer.drain()
-        print(f"Sent: {command.strip()}")
+        if self.verbose:
+            print(f"Sent: {command.strip()}")
 
     async def read_response(self):
-        response = await self.reader.readline()
-        response = response.decode('utf-8').strip()
-        print(f"Received: {response}")
+        response = await self._responses.get()
+        if self.verbose:
+            print(f"Received: {response}")
         return response
 
     async def execute_command(self, command):
+        # Drop stale lines nobody asked for so they don't end up in this reply
+        while not self._responses.empty():
+            self._responses.get_nowait()
         await self.send_command(command)
         response = []
         while True:
@@ -55,7 +93,7 @@ class AsyncESP32ATWrapper:
 
     # WiFi Management Methods
     async def join_wifi(self, ssid, password):
-        command = f'AT+CWJAP="{ssid}","{password}"'
+        command = f'AT+CWJAP={quote(ssid)},{quote(password)}'
         return await self.execute_command(command)
 
     async def disconnect_wifi(self):
@@ -70,78 +108,365 @@ class AsyncESP32ATWrapper:
         command = 'AT+CWLAP'
         return await self.execute_command(command)
 
+    async def iter_wifi_networks(self, rssi_min=None, sort_rssi=True):
+        # Yield an AccessPoint per +CWLAP line as it arrives, instead of one joined string
+        command = f'AT+CWLAPOPT={1 if sort_rssi else 0},{CWLAP_COMPACT}'
+        if rssi_min is not None:
+            command += f',{rssi_min}'
+        await self.execute_command(command)
+        await self.send_command('AT+CWLAP')
+        while True:
+            line = await self.read_response()
+            if line in ["OK", "ERROR"]:
+                break
+            access_point = AccessPoint.from_cwlap(line.encode())
+            if access_point and (rssi_min is None or access_point.rssi >= rssi_min):
+                yield access_point
+
+
+    async def http_stream(self, url, method="GET", data=None, content_type=0, headers=()):
+        # Let the firmware do the request (AT+HTTPCLIENT): it builds it, does
+        # TLS and strips the headers. Yields the body as bytes chunks
+        transport = 2 if url.startswith("https:") else 1
+        command = f'AT+HTTPCLIENT={self.HTTP_METHODS[method]},{content_type},{quote(url)},,,{transport}'
+        if data is not None:
+            command += ',' + quote(data)
+        for header in headers:
+            command += ',' + quote(header)
+        while not self._responses.empty():
+            self._responses.get_nowait()
+        await self.send_command(command)
+        while True:
+            item = await self._responses.get()
+            if isinstance(item, bytes):
+                yield item
+            elif item == "OK":
+                return
+            elif item == "ERROR":
+                raise RuntimeError("HTTP request failed")
+
+    async def http_get(self, url, port=80, offload=False, stream=False, timeout=10):
+        # offload=True hands the request to the firmware, see http_stream(),
+        # and returns just the body rather than the raw response.
+        # stream=True returns the AsyncHTTPResponse itself, so the body can
+        # be read a packet at a time with 'async for chunk in response'
+        if offload:
+            body = bytearray()
+            async for chunk in self.http_stream(url):
+                body += chunk
+            return body.decode('utf-8', 'replace')
 
-    async def http_get(self, url, port=80):
-        # Extract host and path from the URL
         protocol, rest = url.split("://")
-        host, path = rest.split("/", 1)
-        path = "/" + path
-
-        # Start TCP connection
-        await self.execute_command(f'AT+CIPSTART="TCP","{host}",{port}')
-        
-        # Formulate the HTTP GET request
-        http_request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n"
-        
-        # Send the HTTP request
+        host, slash, path = rest.partition("/")
+        path = slash + path
+        conntype = "SSL" if protocol == "https" else "TCP"
+        if conntype == "SSL" and port == 80:
+            port = 443
+        if ":" in host:
+            host, port = host.split(":")
+
+        # Anything still queued belongs to an earlier connection
+        while not self._ipd.empty():
+            self._ipd.get_nowait()
+        response = await self.execute_command(f'AT+CIPSTART={quote(conntype)},{quote(host)},{port}')
+        if not response.endswith("OK"):
+            raise RuntimeError(f"Couldn't connect to {host}")
+
+        # HTTP/1.0 so the server can't answer with a chunked body
+        http_request = f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n"
         await self.execute_command(f'AT+CIPSEND={len(http_request)}')
         await self.send_command(http_request)
-        
-        # Read the HTTP response
-        response = []
-        while True:
-            line = await self.read_response()
-            if line == "0, CLOSE OK" or line == "CLOSED":  # Connection closed
-                break
-            response.append(line)
 
-        # Close TCP connection
-        await self.execute_command('AT+CIPCLOSE')
-        
-        return "\n".join(response)
+        response = AsyncHTTPResponse(self, timeout)
+        await response.read_headers()
+        if stream:
+            return response
+        return (await response.read()).decode('utf-8', 'replace')
 
     async def listen_for_at_messages(self):
         print("LISTENING FOR MESSAGES................................")
         while self.keep_listening:
-            response = await self.read_response()
-            if response.startswith("+MQTTRECV"):  # MQTT message received
-                print(f"MQTT Message: {response}")
-            # Additional handling for other types of responses can go here
-            else:
-                print("DUNNO----------> ", response)
-            print("><><><><><")
+            response = await self._readline()
+            if response.startswith(self.HTTP_FRAMES):
+                head, _, data = response.partition(b",")
+                size = int(head[head.index(b":") + 1:])
+                await self._responses.put(await self._read_frame(size, data))
+                continue
+            if response.startswith(b"+IPD,"):
+                # '+IPD,<len>:<data>', the data goes to whoever has the socket
+                head, _, data = response.partition(b":")
+                await self._ipd.put(await self._read_frame(int(head[5:]), data))
+                continue
+            response = response.decode('utf-8', 'replace').strip()
+            if response == "CLOSED":
+                await self._ipd.put(None)
+            if response.startswith(self.URC_PREFIXES):
+                if response.startswith("+MQTTSUBRECV"):  # MQTT message received
+                    print(f"MQTT Message: {response}")
+                    topic = response.split(",", 2)[1].strip('"')
+                    latency = self.subscriptions.message_received(topic)
+                    if latency is not None:
+                        print(f"First MQTT message {latency:.2f}s after (re)connecting")
+                elif response.startswith("+MQTTCONNECTED"):
+                    self.subscriptions.reconnected()
+                for handler in self._urc_handlers:
+                    handler(response)
+            # URCs are queued too, http_get() waits for CLOSED
+            await self._responses.put(response)
         print(" listen_for_at_messages TASK has STOPPED!!!!!!!!!!!!!*********************")
 
+    async def _readline(self):
+        line = b""
+        if self._pending:
+            line, newline, rest = self._pending.partition(b"\n")
+            if newline:
+                self._pending = rest
+                return line + newline
+            self._pending = b""
+        more = await self.reader.readline()
+        self.bytes_received += len(more)
+        return line + more
+
+    async def _read_frame(self, size, data):
+        # readline() stopped at the first newline, which may be inside the
+        # data or past its end, so use the length to put that right
+        if len(data) < size and self._pending:
+            more = self._pending[:size - len(data)]
+            self._pending = self._pending[len(more):]
+            data += more
+        if len(data) < size:
+            more = await self.reader.readexactly(size - len(data))
+            self.bytes_received += len(more)
+            data += more
+        self._pending = data[size:] + self._pending
+        return data[:size]
+
     def stop_listening(self):
         self.keep_listening = False
 
+    def add_urc_handler(self, handler):
+        # handler(line) is called from the listener task for every unsolicited line
+        self._urc_handlers.append(handler)
+
+    def remove_urc_handler(self, handler):
+        self._urc_handlers.remove(handler)
+
     # MQTT Methods
 
 
     async def mqtt_connect(self, broker, port, client_id, username=None, password=None):
+        self._mqtt_config = (broker, port, client_id, username, password)
         if username and password:
             print("Setting up MQTT credentials")
-            command = f'AT+MQTTUSERCFG=0,1,"{client_id}","{username}","{password}",0,0,""'
+            command = f'AT+MQTTUSERCFG=0,1,{quote(client_id)},{quote(username)},{quote(password)},0,0,""'
             response = await self.execute_command(command)
             print(f"USER AND PASSWORD RESPONSE {response}")
                             
-        command = f'AT+MQTTCONN=0,"{broker}",{port},1'
+        command = f'AT+MQTTCONN=0,{quote(broker)},{port},1'
 
         return await self.execute_command(command)
 
     async def mqtt_subscribe(self, topic, qos=0):
-        command = f'AT+MQTTSUB=0,"{topic}",{qos}'
-        return await self.execute_command(command)
+        # Only filters a wider one doesn't already cover go to the broker,
+        # and a new wildcard retires the narrower filters it covers, so no
+        # message is delivered twice
+        needed, redundant = self.subscriptions.add(topic, qos)
+        if not needed:
+            return "OK"
+        response = await self.execute_command(f'AT+MQTTSUB=0,{quote(topic)},{qos}')
+        for name in redundant:
+            await self.execute_command(f'AT+MQTTUNSUB=0,{quote(name)}')
+        return response
+
+    async def mqtt_unsubscribe(self, topic):
+        if topic not in self.subscriptions:
+            return "OK"
+        # whatever the filter was covering needs a subscription of its own again
+        for name in self.subscriptions.remove(topic):
+            await self.execute_command(f'AT+MQTTSUB=0,{quote(name)},{self.subscriptions.effective()[name]}')
+        return await self.execute_command(f'AT+MQTTUNSUB=0,{quote(topic)}')
+
+    async def mqtt_resubscribe(self):
+        # Every filter in the table straight after one another. The firmware
+        # only takes one AT command at a time, so this is as close to a
+        # pipelined burst as AT+MQTTSUB gets
+        replies = []
+        for topic, qos in self.subscriptions.effective().items():
+            replies.append(await self.execute_command(f'AT+MQTTSUB=0,{quote(topic)},{qos}'))
+        return replies
 
     async def mqtt_publish(self, topic, message, qos=0, retain=False):
         retain_flag = 1 if retain else 0
-        command = f'AT+MQTTPUB=0,"{topic}","{message}",{qos},{retain_flag}'
+        command = f'AT+MQTTPUB=0,{quote(topic)},{quote(message)},{qos},{retain_flag}'
         return await self.execute_command(command)
 
     async def mqtt_disconnect(self):
+        self._mqtt_config = None
+        self.subscriptions.clear()
         command = 'AT+MQTTCLEAN=0'
         return await self.execute_command(command)
 
+    async def mqtt_restore(self):
+        # Reconnect to the last broker and resubscribe every topic
+        if not self._mqtt_config:
+            return None
+        # With reconnect=1 the firmware may already be back on the broker
+        state = 0
+        for line in (await self.execute_command('AT+MQTTCONN?')).split("\n"):
+            if line.startswith("+MQTTCONN:"):
+                state = int(line.split(",")[1])
+        response = "OK"
+        if state < 4:  # not connected
+            response = await self.mqtt_connect(*self._mqtt_config)
+        if state != 6:  # connected, but without our subscriptions
+            await self.mqtt_resubscribe()
+        return response
+
+
+class AsyncHTTPResponse:
+    """The reply to an AsyncESP32ATWrapper.http_get(stream=True). The body
+    comes straight from the +IPD packets: 'async for chunk in response'
+    yields each one as bytes as it arrives, and the response is complete as
+    soon as Content-Length bytes are in rather than when the server gets
+    round to closing the socket."""
+
+    def __init__(self, esp32, timeout=10):
+        self.esp32 = esp32
+        self.timeout = timeout
+        self.status = None
+        self.reason = ""
+        self.headers = {}
+        self.closed = False
+        self._body = b""  # the part of the body that came in with the headers
+
+    async def _packet(self):
+        # The next +IPD payload, or None once the server has closed
+        try:
+            return await asyncio.wait_for(self.esp32._ipd.get(), self.timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise RuntimeError("HTTP response timed out")
+
+    async def read_headers(self):
+        head = b""
+        while True:
+            packet = await self._packet()
+            if packet is None:
+                self.closed = True
+                raise RuntimeError("No HTTP response")
+            head += packet
+            end = head.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+        self._body = head[end + 4:]
+        lines = head[:end].decode('utf-8', 'replace').split("\r\n")
+        status = lines[0].split(" ", 2)
+        self.status = int(status[1])
+        self.reason = status[2] if len(status) > 2 else ""
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            self.headers[name.strip().lower()] = value.strip()
+
+    async def __aiter__(self):
+        remaining = self.headers.get("content-length")
+        remaining = int(remaining) if remaining is not None else -1
+        packet, self._body = self._body, b""
+        while not self.closed:
+            if remaining >= 0:
+                packet = packet[:remaining]
+                remaining -= len(packet)
+            if packet:
+                yield packet
+            if not remaining:
+                break
+            packet = await self._packet()
+            if packet is None:
+                self.closed = True  # the end of an HTTP/1.0 body without a length
+        await self.close()
+
+    async def read(self):
+        body = bytearray()
+        async for chunk in self:
+            body += chunk
+        return bytes(body)
+
+    async def close(self):
+        # Drop the connection if the server hasn't already
+        if not self.closed:
+            self.closed = True
+            await self.esp32.execute_command('AT+CIPCLOSE')
+
+
+class AsyncConnectionSupervisor:
+    """Reconnects an AsyncESP32ATWrapper as soon as the module reports the
+    WiFi or MQTT link is gone, with jittered exponential backoff, a hard
+    reset when rejoins keep failing, and MQTT session/subscription restore.
+    Nothing is polled while the link is healthy."""
+
+    def __init__(self, esp32, ssid, password, backoff_min=1, backoff_max=60, reset_after=3):
+        self.esp32 = esp32
+        self.ssid = ssid
+        self.password = password
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.reset_after = reset_after
+        self.reconnects = 0
+        self.task = None
+        self._wifi_lost = asyncio.Event()
+        self._mqtt_lost = asyncio.Event()
+        esp32.add_urc_handler(self._on_urc)
+
+    def _on_urc(self, line):
+        if line.startswith("WIFI DISCONNECT"):
+            self._wifi_lost.set()
+        elif line.startswith("+MQTTDISCONNECTED"):
+            self._mqtt_lost.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        self.esp32.remove_urc_handler(self._on_urc)
+        if self.task:
+            self.task.cancel()
+
+    def _backoff_delay(self, attempt):
+        delay = min(self.backoff_max, self.backoff_min * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def run(self):
+        while True:
+            lost = asyncio.ensure_future(self._wifi_lost.wait())
+            mqtt_lost = asyncio.ensure_future(self._mqtt_lost.wait())
+            await asyncio.wait([lost, mqtt_lost], return_when=asyncio.FIRST_COMPLETED)
+            lost.cancel()
+            mqtt_lost.cancel()
+            rejoin = self._wifi_lost.is_set()
+            self._wifi_lost.clear()
+            self._mqtt_lost.clear()
+            attempt = 0
+            while True:
+                try:
+                    if rejoin:
+                        if attempt and attempt % self.reset_after == 0:
+                            print("Supervisor: rejoins keep failing, hard reset")
+                            await self.esp32.hard_reset()
+                        response = await self.esp32.join_wifi(self.ssid, self.password)
+                        if not response.endswith("OK"):
+                            raise RuntimeError(f"Couldn't rejoin {self.ssid}")
+                    response = await self.esp32.mqtt_restore()
+                    if response is not None and not response.endswith("OK"):
+                        raise RuntimeError("Couldn't reconnect to the MQTT broker")
+                    break
+                except (RuntimeError, OSError) as e:
+                    delay = self._backoff_delay(attempt)
+                    attempt += 1
+                    print(f"Supervisor: {e}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+            self.reconnects += 1
+            print(f"Supervisor: link restored after {attempt} failed attempts")
+
 
 
 
@@ -169,8 +494,8 @@ async def main():
         response = await esp32.execute_command("AT+GMR")  # Get version info
         print(response)
 
-        response = await esp32.scan_wifi_networks()
-        print(response)
+        async for access_point in esp32.iter_wifi_networks(rssi_min=-80):
+            print(access_point)
         print("Finished - Initiating Scan")
         print(f"Secrets {secrets}")
 
@@ -184,9 +509,11 @@ async def main():
 
         url = "http://example.com/index.html"
         print(f"Fetching: {url}")
-        webpage = await esp32.http_get(url)
-        print("Web Page Response from {url}:")
-        print(webpage)
+        response = await esp32.http_get(url, stream=True)
+        print(f"Web Page Response from {url}: {response.status} {response.reason}")
+        async for chunk in response:
+            print(chunk.decode('utf-8', 'replace'), end="")
+        print()
 
         # Example using MQTT.
         #resp = await esp32.mqtt_disconnect()
@@ -200,6 +527,10 @@ async def main():
         topic = "opportunities/111283278/status/#"
         await esp32.mqtt_subscribe(topic, qos=1)
 
+        # Rejoin WiFi and restore the MQTT session whenever the module reports a drop
+        supervisor = AsyncConnectionSupervisor(esp32, secrets['ssid'], secrets['password'])
+        supervisor.start()
+
         # Publish a message
         #message = "Hello, MQTT!"
         #await esp32.mqtt_publish("greet", message, qos=1)
@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+
+class JobStats:
+    """What one scheduled job has been up to"""
+
+    def __init__(self, name, period=None):
+        self.name = name
+        self.period = period
+        self.runs = 0
+        self.run_time = 0.0  # seconds spent in the job, all runs together
+        self.max_run_time = 0.0
+        self.missed = 0  # deadlines that went by while the job was still busy
+        self.max_lateness = 0.0  # worst start after its deadline, seconds
+
+    def record(self, seconds):
+        self.runs += 1
+        self.run_time += seconds
+        self.max_run_time = max(self.max_run_time, seconds)
+
+    def as_dict(self):
+        return {
+            "period": self.period,
+            "runs": self.runs,
+            "mean_run_time": self.run_time / self.runs if self.runs else 0.0,
+            "max_run_time": self.max_run_time,
+            "missed": self.missed,
+            "max_lateness": self.max_lateness,
+        }
+
+
+class _Timed:
+    # with scheduler.timed("name"): ... adds the block's time to that job
+    def __init__(self, stats):
+        self._stats = stats
+        self._stamp = 0.0
+
+    def __enter__(self):
+        self._stamp = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self._stats.record(time.monotonic() - self._stamp)
+        return False
+
+
+class Scheduler:
+    """Runs periodic jobs against absolute deadlines instead of sleeping a
+    fixed time after each run, so a job's period doesn't stretch by its
+    own run time and slow runs don't pile up: a deadline that passes while
+    the job is still busy is counted as missed and skipped. A probe task
+    measures how late the event loop wakes it (the loop lag), which is
+    what shows that something is hogging the loop and starving the UART.
+    Event driven tasks report their own run time with timed()."""
+
+    def __init__(self, lag_interval=0.1):
+        self.lag_interval = lag_interval
+        self.jobs = {}  # name -> JobStats
+        self.lag = 0.0  # how late the last probe woke, seconds
+        self.max_lag = 0.0
+        self.mean_lag = 0.0  # smoothed
+        self._tasks = []
+
+    def every(self, period, job, *args, name=None, delay=0.0):
+        # job(*args) is a coroutine function, first run 'delay' seconds from now
+        stats = JobStats(name or job.__name__, period)
+        self.jobs[stats.name] = stats
+        self._tasks.append(asyncio.create_task(self._periodic(stats, job, args, delay)))
+        return stats
+
+    def spawn(self, coro, name):
+        # A long running task, it reports its run time through timed(name)
+        self.jobs.setdefault(name, JobStats(name))
+        task = asyncio.create_task(coro)
+        self._tasks.append(task)
+        return task
+
+    def timed(self, name):
+        stats = self.jobs.get(name)
+        if stats is None:
+            stats = self.jobs[name] = JobStats(name)
+        return _Timed(stats)
+
+    def start(self):
+        self._tasks.append(asyncio.create_task(self._lag_probe()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _periodic(self, stats, job, args, delay):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        while True:
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            now = loop.time()
+            stats.max_lateness = max(stats.max_lateness, now - deadline)
+            try:
+                await job(*args)
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Scheduler: {stats.name} failed: {e}")
+            finished = loop.time()
+            stats.record(finished - now)
+            deadline += stats.period
+            if finished > deadline:
+                # Overran one or more periods: skip them rather than run
+                # back to back to catch up
+                skipped = int((finished - deadline) // stats.period) + 1
+                stats.missed += skipped
+                deadline += skipped * stats.period
+
+    async def _lag_probe(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            deadline += self.lag_interval
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            self.lag = max(0.0, loop.time() - deadline)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.mean_lag += (self.lag - self.mean_lag) / 16
+            if self.lag > self.lag_interval:
+                deadline = loop.time()  # don't try to make up a stall
+
+    def stats(self):
+        return {
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+            "mean_lag": self.mean_lag,
+            "jobs": {name: job.as_dict() for name, job in self.jobs.items()},
+        }
+
+    def report(self):
+        print(f"Loop lag {self.lag * 1000:.1f}ms (mean {self.mean_lag * 1000:.1f}ms, "
+              f"max {self.max_lag * 1000:.1f}ms)")
+        for name, job in self.jobs.items():
+            mean = job.run_time / job.runs if job.runs else 0.0
+            print(f"  {name}: {job.runs} runs, mean {mean * 1000:.1f}ms, "
+                  f"max {job.max_run_time * 1000:.1f}ms, {job.missed} missed")
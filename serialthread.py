@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import threading
+
+
+class RingBuffer:
+    """Fixed size byte ring for exactly one producer thread and one consumer.
+    Each side only ever moves its own counter, and a counter is only moved
+    after the bytes it covers are in place, so no lock is needed"""
+
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._size = size
+        self._written = 0  # total bytes ever put in, producer side only
+        self._read = 0  # total bytes ever taken out, consumer side only
+
+    def __len__(self):
+        return self._written - self._read
+
+    def space(self):
+        return self._size - len(self)
+
+    def write(self, data):
+        # Copy in as much of data as fits, returns how much that was
+        count = min(len(data), self.space())
+        start = self._written % self._size
+        first = min(count, self._size - start)
+        self._buf[start:start + first] = data[:first]
+        self._buf[:count - first] = data[first:count]
+        self._written += count
+        return count
+
+    def _peek(self, count):
+        start = self._read % self._size
+        first = min(count, self._size - start)
+        return bytes(self._buf[start:start + first]) + bytes(self._buf[:count - first])
+
+    def read(self, count):
+        # Take up to count bytes out
+        data = self._peek(min(count, len(self)))
+        self._read += len(data)
+        return data
+
+    def find(self, byte):
+        # Offset of the first 'byte' waiting to be read, or -1
+        available = len(self)
+        start = self._read % self._size
+        first = min(available, self._size - start)
+        index = self._buf.find(byte, start, start + first)
+        if index >= 0:
+            return index - start
+        index = self._buf.find(byte, 0, available - first)
+        return first + index if index >= 0 else -1
+
+
+class SerialThread:
+    """Runs a pyserial port's reads and writes on their own threads so the
+    event loop never blocks on the device. The reader pulls whatever has
+    arrived in large chunks into a RingBuffer and wakes the loop with
+    call_soon_threadsafe; writes are queued and go out on the writer thread.
+    Coroutines read with readline()/readexactly(), which only ever wait on
+    an asyncio.Event."""
+
+    def __init__(self, serial_port, ring_size=65536, chunk_size=4096):
+        self.serial = serial_port
+        self.serial.timeout = 0.05  # how long a read waits for a first byte
+        self._ring = RingBuffer(ring_size)
+        self._chunk_size = chunk_size
+        self._loop = None
+        self._data = asyncio.Event()
+        self._wakeup_pending = threading.Event()
+        self._space = threading.Event()
+        self._outgoing = collections.deque()
+        self._write_ready = threading.Event()
+        self._running = False
+        self._threads = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.overruns = 0  # times the reader had to wait for the loop to catch up
+
+    def start(self):
+        # Call from inside the running event loop
+        self._loop = asyncio.get_running_loop()
+        self._running = True
+        for target in (self._reader, self._writer):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        self._running = False
+        self._space.set()
+        self._write_ready.set()
+        for thread in self._threads:
+            thread.join()
+        self.serial.close()
+
+    @property
+    def in_waiting(self):
+        # Bytes read from the device that nobody has consumed yet
+        return len(self._ring)
+
+    # ---- device side, runs on the I/O threads ----
+
+    def _reader(self):
+        while self._running:
+            data = self.serial.read(max(1, min(self.serial.in_waiting, self._chunk_size)))
+            while data and self._running:
+                count = self._ring.write(data)
+                data = data[count:]
+                self.bytes_read += count
+                if count and not self._wakeup_pending.is_set():
+                    self._wakeup_pending.set()
+                    self._loop.call_soon_threadsafe(self._wake)
+                if data:
+                    # Ring full: wait for the loop rather than drop bytes,
+                    # the OS and the device buffer in the meantime
+                    self.overruns += 1
+                    self._space.clear()
+                    self._space.wait(0.1)
+
+    def _writer(self):
+        while self._running:
+            self._write_ready.wait()
+            self._write_ready.clear()
+            while self._outgoing:
+                data = self._outgoing.popleft()
+                self.serial.write(data)
+                self.bytes_written += len(data)
+
+    # ---- event loop side ----
+
+    def _wake(self):
+        self._wakeup_pending.clear()
+        self._data.set()
+
+    def _consumed(self):
+        self._space.set()
+
+    def write(self, data):
+        # Never blocks, the writer thread sends it
+        self._outgoing.append(bytes(data))
+        self._write_ready.set()
+
+    async def readline(self, prompt=None):
+        # prompt is a reply with no newline after it, the '>' ESP-AT sends
+        # when it wants data: returned on its own once it's all that's left
+        while True:
+            self._data.clear()  # before looking, so a wakeup can't be missed
+            index = self._ring.find(b"\n")
+            if index >= 0:
+                line = self._ring.read(index + 1)
+                self._consumed()
+                return line
+            if prompt and len(self._ring) >= len(prompt) and self._ring._peek(len(prompt)) == prompt:
+                line = self._ring.read(len(prompt))
+                self._consumed()
+                return line
+            await self._data.wait()
+
+    async def readexactly(self, count):
+        data = b""
+        while len(data) < count:
+            self._data.clear()
+            more = self._ring.read(count - len(data))
+            if more:
+                data += more
+                self._consumed()
+                continue
+            await self._data.wait()
+        return data
+
+    def read_nowait(self, count):
+        # Whatever is already here, up to count bytes
+        data = self._ring.read(count)
+        if data:
+            self._consumed()
+        return data
@@ -4,6 +4,10 @@
 import time
 
 from espatcontrol import espatcontrol
+from espatcontrol.espatcontrol_supervisor import WiFiSupervisor
+from espatcontrol.espatcontrol_clock import SNTPClock
+from espatcontrol import espatcontrol_http
+from espatcontrol.espatcontrol_mqtt import MQTTClient
 
 from machine import UART, Pin
 
@@ -15,18 +19,27 @@ except ImportError:
     raise
 
 
-def get_url(esp, url, port=80):
-    url = "http://example.com/index.html"
-    protocol, rest = url.split("://")
-    host, path = rest.split("/", 1)
-    path = "/" + path
-    socket = esp.socket_connect("TCP",host, port, retries=3)
-    if (socket):
-        http_request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('utf-8')
-        res = esp.socket_send(http_request)
-        response= esp.socket_receive()
-        return response.decode('utf-8')
-    return None
+def get_url(esp, url):
+    # Asks for a gzip/deflate body and inflates it as the packets arrive
+    response = espatcontrol_http.request(esp, "GET", url)
+    return response.text
+
+def get_url_offload(esp, url):
+    # The firmware builds the request and strips the headers, we just get the body
+    body = bytearray()
+    for chunk in esp.http_get(url):
+        body.extend(chunk)
+    return body.decode('utf-8')
+
+def publish_readings(esp, host, count=50):
+    # MQTT over a plain socket, the burst goes out in a handful of AT+CIPSENDs
+    mqtt = MQTTClient(esp, "esp-simpletest")
+    mqtt.connect(host, username=secrets.get("mqtt_username"), password=secrets.get("mqtt_password"))
+    for i in range(count):
+        mqtt.publish("simpletest/reading", str(i), qos=1)
+    acked = mqtt.wait_for_acks()
+    mqtt.disconnect()
+    return acked
 
 # Debug Level
 # Change the Debug Flag if you have issues with AT commands
@@ -40,10 +53,17 @@ uart = UART(0, baudrate=115200, tx=Pin(0), rx=Pin(1), rxbuf=1517, timeout=500)
 print("ESP AT commands")
 # For Boards that do not have an rtspin like challenger_rp2040_wifi set rtspin to False.
 esp = espatcontrol.ESP_ATcontrol(
-    uart, 115200, reset_pin=0, rts_pin=False, debug=debugflag
+    uart,
+    115200,
+    reset_pin=0,
+    rts_pin=False,
+    debug=debugflag,
+    capability_cache="esp_caps.json",
 )
 print("Resetting ESP module")
 esp.hard_reset()
+supervisor = WiFiSupervisor(esp, secrets, debug=debugflag)
+clock = SNTPClock(esp, debug=debugflag)
 
 first_pass = True
 while True:
@@ -53,7 +73,7 @@ while True:
             # See https://github.com/adafruit/Adafruit_CircuitPython_ESP_ATcontrol/issues/48
             # Comment out the next 3 lines if you get a No OK response to AT+CWLAP
             print("Scanning for AP's")
-            for ap in esp.scan_APs():
+            for ap in esp.iter_APs(rssi_min=-80):
                 print(ap)
             print("Checking connection...")
             # secrets dictionary must contain 'ssid' and 'password' at a minimum
@@ -62,14 +82,23 @@ while True:
             print("Connected to AT software version ", esp.version)
             print("IP address ", esp.local_ip)
             first_pass = False
-        print("Pinging 8.8.8.8...", end="")
-        print(esp.ping("8.8.8.8"))
-        res = get_url(esp, "http://example.com/index.htm")
-        print(res)
-        time.sleep(10)
+        # reconnects (with backoff) if the module told us the link dropped
+        if supervisor.poll():
+            if clock.poll():
+                print("UTC epoch", clock.time())
+            print("Pinging 8.8.8.8...", end="")
+            print(esp.ping("8.8.8.8"))
+            res = get_url_offload(esp, "http://example.com/index.htm")
+            print(res)
+            if "mqtt_host" in secrets:
+                print("Published readings:", publish_readings(esp, secrets["mqtt_host"]))
+        time.sleep(10 if supervisor.connected else 1)
 
     except (ValueError, RuntimeError, espatcontrol.OKError) as e:
         print("Failed to get data, retrying\n", e)
-        print("Resetting ESP module")
-        esp.hard_reset()
-        continue
\ No newline at end of file
+        if first_pass:
+            print("Resetting ESP module")
+            esp.hard_reset()
+        else:
+            supervisor.link_lost()
+        continue